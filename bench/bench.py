@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+""" Benchmarks for the metadata, layer-chain and mount orchestration paths.
+
+    Synthetic manifests are generated straight into a temporary metadata dir,
+    every scenario is timed in-process per phase and end to end through the
+    CLI, and the results are written as JSON. With --baseline the results are
+    compared against an earlier run and regressions fail the run.
+
+    Mounts go through the simulated backend, so no root is needed.
+
+    python bench/bench.py --images 10,1000,10000 --output bench_output.json
+    python bench/bench.py --baseline bench/baseline.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+stackoDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'stacko')
+sys.path.insert(0, os.path.abspath(stackoDir))
+
+import classDb
+import image
+import lock
+import mountBackend
+import point
+
+class Scenario(object):
+
+    def __init__(self, images, depth, fanout, points, instances, backend):
+        self.images = images
+        self.depth = depth
+        self.fanout = fanout
+        self.points = points
+        self.instances = instances
+        self.backend = backend
+
+    @property
+    def name(self):
+        return "images={0!s} depth={1!s} fanout={2!s} points={3!s} instances={4!s} backend={5!s}".format(
+            self.images, self.depth, self.fanout, self.points, self.instances, self.backend)
+
+def generateImages(scenario):
+    """ A forest of images: every tree is filled breadth first up to the given
+        depth and fan-out, new roots are started until there are enough images.
+    """
+    images = []
+    while len(images) < scenario.images:
+        rootName = "img{0:06d}".format(len(images))
+        images.append({'name': rootName, 'parent': None, 'version': None, 'instances': []})
+        frontier = [(rootName, 1)]
+        while frontier and len(images) < scenario.images:
+            parent, depth = frontier.pop(0)
+            if depth >= scenario.depth:
+                continue
+            for child in range(scenario.fanout):
+                if len(images) >= scenario.images:
+                    break
+                name = "img{0:06d}".format(len(images))
+                images.append({'name': name, 'parent': parent, 'version': None, 'instances': []})
+                frontier.append((name, depth + 1))
+    return images
+
+def generateManifest(scenario, workDir):
+    rand = random.Random(42)
+    images = generateImages(scenario)
+    byName = dict((record['name'], record) for record in images)
+
+    points = []
+    for index in range(scenario.points):
+        pointName = "point{0:06d}".format(index)
+        history = rand.sample(sorted(byName.keys()), min(scenario.instances, len(images)))
+        for imageName in history:
+            byName[imageName]['instances'].append(pointName)
+        points.append({'name': pointName, 'imageHistory': history, 'currentImage': history[-1]})
+
+    metadataDir = os.path.join(workDir, 'metadata')
+    for path in ('metadata', 'images', 'mounts'):
+        os.mkdir(os.path.join(workDir, path))
+
+    for managerCls, records in ((image.ImageManager, images), (point.PointManager, points)):
+        store = classDb.openStore(metadataDir, managerCls.dbFilename, 'name', managerCls.indexes, scenario.backend)
+        store.replaceAll(records)
+
+def loadManagers(workDir):
+    locks = lock.LockManager(dbLockPath=os.path.join(workDir, 'db.lock'),
+                             lockDir=os.path.join(workDir, 'locks'))
+    backend = mountBackend.SimulatedBackend(os.path.join(workDir, 'metadata', mountBackend.simulatedFilename))
+    imageManager = image.ImageManager.from_db(metadataDir=os.path.join(workDir, 'metadata'),
+                                              itemCls=image.Image,
+                                              imagesDir=os.path.join(workDir, 'images'),
+                                              locks=locks,
+                                              mountBackend=backend,
+                                              legacy=False)
+    pointManager = point.PointManager.from_db(metadataDir=os.path.join(workDir, 'metadata'),
+                                              itemCls=point.Point,
+                                              mountDir=os.path.join(workDir, 'mounts'),
+                                              imageManager=imageManager,
+                                              locks=locks,
+                                              mountBackend=backend)
+    return imageManager, pointManager
+
+@contextlib.contextmanager
+def quiet():
+    saved = sys.stdout
+    sys.stdout = io.StringIO()
+    try:
+        yield
+    finally:
+        sys.stdout = saved
+
+def timed(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+def runPhases(scenario, workDir):
+    """ One in-process pass over the hot paths, returns {metric: seconds}. """
+    result = {}
+    state = {}
+
+    def load():
+        state['images'], state['points'] = loadManagers(workDir)
+    result['load'] = timed(load)
+    imageManager, pointManager = state['images'], state['points']
+    imageNames = sorted(imageManager.db.keys())
+
+    result['layer_chain_cold'] = timed(lambda: [imageManager.getLowerDirs(name) for name in imageNames])
+    result['layer_chain_warm'] = timed(lambda: [imageManager.getLowerDirs(name) for name in imageNames])
+    result['child_images'] = timed(lambda: [imageManager.getChildImages(name) for name in imageNames])
+
+    with quiet():
+        result['list_images'] = timed(lambda: imageManager.listImages())
+        result['list_images_tree'] = timed(lambda: imageManager.listImages(tree=True))
+        result['list_points'] = timed(lambda: pointManager.listPoints())
+
+    def checked(func):
+        # a benchmark of the error path is worthless, fail loudly instead
+        failures = [(name, exc) for name, seconds, exc in func() if exc is not None]
+        if failures:
+            raise RuntimeError("{0!s} failed: {1!s}".format(func.__name__, failures[:3]))
+    result['mount_all'] = timed(lambda: checked(pointManager.mountAll))
+    result['umount_all'] = timed(lambda: checked(pointManager.umountAll))
+
+    def saveOne():
+        pointName = sorted(pointManager.db.keys())[0]
+        pointManager.markDirty(pointName)
+        pointManager.to_db()
+        imageManager.to_db()
+    result['save_one_record'] = timed(saveOne)
+    return result
+
+def runCli(workDir, args, script=None):
+    env = dict(os.environ)
+    env[mountBackend.backendEnvVar] = 'simulated'
+    start = time.perf_counter()
+    subprocess.run([sys.executable, script or os.path.abspath(stackoDir)] + args, cwd=workDir, env=env,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - start
+
+def runEndToEnd(scenario, workDir):
+    result = {}
+    # the bare interpreter, what the CLI startup numbers cannot go below
+    result['cli_interpreter'] = runCli(workDir, ['pass'], script='-c')
+    result['cli_startup'] = runCli(workDir, ['list-instances', 'img000000'])
+    result['cli_get_stackpoint_dir'] = runCli(workDir, ['get-stackpoint-dir', 'point000000'])
+    result['cli_list_images_tree'] = runCli(workDir, ['list-images', '--tree'])
+    result['cli_list_stackpoints'] = runCli(workDir, ['list-stackpoints'])
+    result['cli_mount_stackpoint'] = runCli(workDir, ['mount-stackpoint', 'point000000'])
+    result['cli_is_stackpoint_mounted'] = runCli(workDir, ['is-stackpoint-mounted', 'point000000'])
+    result['cli_umount_stackpoint'] = runCli(workDir, ['umount-stackpoint', 'point000000'])
+    return result
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+def runScenario(scenario, repeat, endToEnd):
+    runs = {}
+    workDir = tempfile.mkdtemp(prefix='stacko-bench-')
+    try:
+        generateManifest(scenario, workDir)
+        for iteration in range(repeat):
+            phases = runPhases(scenario, workDir)
+            if endToEnd:
+                phases.update(runEndToEnd(scenario, workDir))
+            for metric, seconds in list(phases.items()):
+                runs.setdefault(metric, []).append(seconds)
+    finally:
+        shutil.rmtree(workDir)
+
+    return [{'scenario': scenario.name, 'metric': metric, 'seconds': median(values), 'runs': values}
+            for metric, values in sorted(runs.items())]
+
+def compare(results, baseline, threshold):
+    """ Returns the (key, baseline, current) triples slower than threshold x baseline. """
+    previous = dict(((entry['scenario'], entry['metric']), entry['seconds']) for entry in baseline['results'])
+    regressions = []
+    for entry in results:
+        key = (entry['scenario'], entry['metric'])
+        if key in previous and previous[key] > 0 and entry['seconds'] > previous[key] * threshold:
+            regressions.append((key, previous[key], entry['seconds']))
+    return regressions
+
+def parseInts(value):
+    return [int(item) for item in value.split(',') if item]
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark stacko hot paths')
+    parser.add_argument('--images', type=parseInts, default=[10, 1000, 10000])
+    parser.add_argument('--depth', type=parseInts, default=[3, 20])
+    parser.add_argument('--fanout', type=int, default=4)
+    parser.add_argument('--points', type=int, default=None, help='default: images / 10')
+    parser.add_argument('--instances', type=int, default=3, help='instances (history length) per point')
+    parser.add_argument('--backend', choices=sorted(classDb.storeBackends.keys()), action='append')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-cli', action='store_true', help='skip the end to end CLI timings')
+    parser.add_argument('--output', '-o', default=None, help='write the results as JSON')
+    parser.add_argument('--baseline', '-b', default=None, help='compare against an earlier --output')
+    parser.add_argument('--threshold', type=float, default=1.25, help='allowed slowdown factor')
+    args = parser.parse_args(argv)
+
+    results = []
+    for backend in args.backend or ['json']:
+        for images in args.images:
+            for depth in args.depth:
+                points = args.points if args.points is not None else max(1, images // 10)
+                scenario = Scenario(images, depth, args.fanout, points, args.instances, backend)
+                scenarioResults = runScenario(scenario, args.repeat, not args.no_cli)
+                for entry in scenarioResults:
+                    print("{0:<90} {1:<28} {2:10.4f}s".format(entry['scenario'], entry['metric'], entry['seconds']))
+                results.extend(scenarioResults)
+
+    report = {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as theFile:
+            json.dump(report, theFile, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as theFile:
+            baseline = json.load(theFile)
+        regressions = compare(results, baseline, args.threshold)
+        for (scenarioName, metric), before, after in regressions:
+            print("REGRESSION {0!s} {1!s}: {2:.4f}s -> {3:.4f}s".format(scenarioName, metric, before, after))
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
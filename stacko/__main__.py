@@ -1,41 +1,102 @@
 # -*- coding: utf-8 -*-
-import platform
 import argparse
+import json
 import sys
 import os
 
-if platform.system() != "Linux":
+# platform.system() costs more to import than most commands take to run
+if not sys.platform.startswith("linux"):
     print("Unsupported platform")
     sys.exit(1)
 
 class StacksOptions(object):
 
-    def __init__(self, imageManager, pointManager):
+    # commands that leave the manifest untouched and can share the manifest lock
+    sharedCommands = set([
+        'list_images',
+        'list_instances',
+        'list_stackpoints',
+        'export_image',
+        'diff',
+        'get_stackpoint_dir',
+        'is_stackpoint_mounted',
+        'mount_stackpoint',
+        'umount_stackpoint',
+        'mount_all',
+        'umount_all',
+        'reap_mounts',
+        'edit_image',
+        'close_image',
+    ])
+
+    # commands that manage their own locks or stores, they cannot run in a batch
+    unbatchable = set(['batch', 'daemon', 'gc', 'migrate_db'])
+
+    def __init__(self, imageManager, pointManager, argv=None):
         self.imageManager = imageManager
         self.pointManager = pointManager
+        self.argv = argv if argv is not None else sys.argv
+        # set by commands that succeed in saving but report a failure, see batch
+        self.exitStatus = 0
+        # images close-image left to be deduplicated under the exclusive lock
+        self.pendingDedup = []
 
         parser = argparse.ArgumentParser(
             description='Create and manage overlayFS stacks',
-            usage='''stacko <command> [<args>]
+            usage='''stacko [--trace FILE] <command> [<args>]
+
+    --trace FILE  Record timing spans (locks, metadata I/O, image/point operations,
+                  mount calls) as JSON lines, or as a Chrome trace if FILE ends
+                  in .json. STACKO_TRACE=FILE does the same.
 
 Image commands:
     new-image     Create an image
     edit-image    Mount an image for editing
     close-image   Umount an image to stop editing
-    delete-image
-    list-images   Show the existing images
-    import-image
-    export-image
+    delete-image  Moves the image into images/.trash at once, see gc
+    list-images   Show the existing images (--tree, --usage for the disk usage of
+                  each layer and of the instances with list-instances/list-stackpoints)
+    import-image  Create an image from a tar stream (--input FILE|-, --codec)
+    export-image  Write an image layer as a tar stream (--output FILE|-, --codec)
+    diff          Show what an image changes on top of its parents, or an instance on
+                  top of its image (<image> [<instance>] --hash --index --json)
+    set-instance-limit  Limit an instance's CoW layer (<image> <instance> --bytes 10G
+                  --inodes N | --clear), with project quotas where the filesystem
+                  has them, otherwise checked when the instance is mounted
+    clone-instance  Create an instance from a reflinked copy of another instance of
+                  the same image (<image> <source> <new>)
+    squash-image  Flatten an image and its parents into a new root image (--background)
+    enable-dedup  Hardlink identical files across images, close-image keeps
+                  new content deduplicated from then on
+
+Service commands:
+    batch         Run commands read from a file or stdin (one per line, as typed
+                  after "stacko", or JSON) with a single lock hold and save
+                  (--keep-going, --atomic to undo every command if one fails,
+                  --json)
+    daemon        Serve the stacko API over a unix socket (--socket PATH,
+                  --gc-interval SECONDS to also run gc periodically,
+                  --reap-interval SECONDS to also run reap-mounts)
+    gc            Remove deleted images and instances from images/.trash and
+                  unreferenced blobs (--workers N, --rate FILES_PER_SECOND)
+
+Metadata commands:
+    migrate-db    Move the metadata to another storage backend (json, sqlite)
+    fsck          Report differences between the manifest, images/, mounts/ and the
+                  mount table (--repair to fix them, orphans go to the trash)
 
 StackPoint commands:
     new-stackpoint
-    delete-stackpoint
+    delete-stackpoint: delete a stackpoint that is not mounted and all of its instances
 
-    # Nah... let wrappers do cutovers and fallbacks? then what is the point of a history??
+    cutover-stackpoint: mount an instance of the given image (created if it does not
+        exist yet) and swap it in for the current instance, reports how long the
+        stackpoint was unavailable
 
-    #cutover-stackpoint-instance: unmount a current instance, create a new instance of the given image (if it does not already exist), set the current instance, and mount the new current instance
+    fallback-stackpoint: swap the instance used before the current one back in
 
-    #fallback-stackpoint-instance: unmount a current instance, set the current instance to the last known image instance, and mount the new current instance
+    clone-stackpoint: new stackpoint using a reflinked copy of another stackpoint's
+        current instance (<point> <new point>)
 
     new-stackpoint-instance
 
@@ -43,15 +104,23 @@ StackPoint commands:
 
     delete-stackpoint-instance
 
-    mount-stackpoint
+    mount-stackpoint  (--timeout SECONDS per mount, what was mounted is undone if
+                  a mount fails)
     umount-stackpoint
-    get-stackpoint-dir
-    is-stackpoint-mounted
+    mount-all     Mount every stackpoint, independent mounts in parallel (--workers N,
+                  --timeout SECONDS per mount); a failed stackpoint is left unmounted
+    umount-all    Umount every mounted stackpoint in parallel (--workers N)
+    reap-mounts   Umount the shared read-only image mounts (legacy kernels) that no
+                  instance or image has used for --grace SECONDS (default 300);
+                  umount-stackpoint and umount-all do this too
+    get-stackpoint-dir     print the mount directory of a stackpoint
+    is-stackpoint-mounted  print yes/no, exit status 1 if not mounted; both
+        only read the stackpoint records and the mount table, for health checks
 ''')
         parser.add_argument('command', help='Subcommand to run')
         # parse_args defaults to [1:] for args, but you need to
         # exclude the rest of the args too, or validation will fail
-        args = parser.parse_args(sys.argv[1:2])
+        args = parser.parse_args(self.argv[1:2])
         command = args.command.replace("-","_")
         if not hasattr(self, command):
             print('Unrecognized command')
@@ -66,7 +135,7 @@ StackPoint commands:
         parser = argparse.ArgumentParser(description='Create a new point')
         parser.add_argument('pointname')
         parser.add_argument('imagename')
-        args = parser.parse_args(sys.argv[startArg:])
+        args = parser.parse_args(self.argv[startArg:])
 
         self.pointManager.newPoint(args.pointname, args.imagename)
         print('Created point: pointname={0!s} imagename={1!s}'.format(repr(args.pointname), repr(args.imagename)))
@@ -75,35 +144,135 @@ StackPoint commands:
         parser = argparse.ArgumentParser(
             description='Show points')
         parser.add_argument('pointname',  nargs='?', default=None)
-        args = parser.parse_args(sys.argv[2:])
+        parser.add_argument('--usage', '-u', action='store_true', help='show the disk usage of each CoW layer')
+        parser.add_argument('--full', action='store_true', help='recount the usage instead of using the cache')
+        args = parser.parse_args(self.argv[startArg:])
         print('Running list-points')
-        self.pointManager.listPoints(args.pointname)
+        self.pointManager.listPoints(args.pointname, showUsage=args.usage, full=args.full)
 
     def mount_stackpoint(self, startArg=2):
+        import mountBackend
         parser = argparse.ArgumentParser(
             description='Mount a stack points')
         parser.add_argument('pointname')
-        args = parser.parse_args(sys.argv[2:])
+        parser.add_argument('--timeout', '-t', type=float, default=mountBackend.defaultTimeout, help='seconds a single mount may take')
+        args = parser.parse_args(self.argv[startArg:])
         #print('Running mount-stackpoint')
-        mountDir = self.pointManager.mount(args.pointname)
+        mountDir = self.pointManager.mount(args.pointname, timeout=args.timeout)
         if mountDir:
             mountDir = os.path.abspath(mountDir)
             print('Mounted stackpoint: name={0!s}\nmount-point={1!s}'.format(repr(args.pointname), repr(mountDir)))
 
+    def get_stackpoint_dir(self, startArg=2):
+        # normally answered by pointQuery()
+        parser = argparse.ArgumentParser(description=pointQueryDescriptions['get_stackpoint_dir'])
+        parser.add_argument('pointname')
+        args = parser.parse_args(self.argv[startArg:])
+
+        print(os.path.abspath(self._pointDir(args.pointname)))
+
+    def is_stackpoint_mounted(self, startArg=2):
+        # normally answered by pointQuery()
+        parser = argparse.ArgumentParser(description=pointQueryDescriptions['is_stackpoint_mounted'])
+        parser.add_argument('pointname')
+        args = parser.parse_args(self.argv[startArg:])
+
+        printMounted(self.pointManager.mountBackend.isMounted(self._pointDir(args.pointname)))
+
+    def _pointDir(self, pointName):
+        if pointName not in self.pointManager.db:
+            raise error.NotFoundException("Point does not exist: {0!s}".format(str(pointName)))
+        return self.pointManager.getMountPointDir(pointName)
+
+    def mount_all(self, startArg=2):
+        import mountBackend
+        import point
+        parser = argparse.ArgumentParser(
+            description='Mount all stack points')
+        parser.add_argument('--workers', '-w', type=int, default=point.defaultWorkers)
+        parser.add_argument('--timeout', '-t', type=float, default=mountBackend.defaultTimeout, help='seconds a single mount may take')
+        args = parser.parse_args(self.argv[startArg:])
+
+        results = self.pointManager.mountAll(workers=args.workers, timeout=args.timeout)
+        self._printResults('Mounted', results)
+
+    def umount_all(self, startArg=2):
+        import point
+        parser = argparse.ArgumentParser(
+            description='Umount all mounted stack points')
+        parser.add_argument('--workers', '-w', type=int, default=point.defaultWorkers)
+        args = parser.parse_args(self.argv[startArg:])
+
+        results = self.pointManager.umountAll(workers=args.workers)
+        self._printResults('Umounted', results)
+
+    def reap_mounts(self, startArg=2):
+        import mountRefs
+        parser = argparse.ArgumentParser(
+            description='Umount the shared image mounts nothing stacks on anymore')
+        parser.add_argument('--grace', '-g', type=float, default=mountRefs.defaultGrace, help='seconds a mount must have been unused')
+        args = parser.parse_args(self.argv[startArg:])
+
+        for name in self.imageManager.reapIdleMounts(grace=args.grace):
+            print('Umounted image: name={0!s}'.format(repr(name)))
+
+    def _printResults(self, action, results):
+        failures = 0
+        for name, seconds, exc in results:
+            if exc is None:
+                print('{0!s} stackpoint: name={1!s} time={2:.3f}s'.format(action, repr(name), seconds))
+            else:
+                failures += 1
+                print('Failed stackpoint: name={0!s} time={1:.3f}s error={2!s}'.format(repr(name), seconds, str(exc)))
+        print('{0!s} {1!s} of {2!s} stackpoints'.format(action, len(results) - failures, len(results)))
+        if failures > 0:
+            self.exitStatus = 1
+
+    def cutover_stackpoint(self, startArg=2):
+        parser = argparse.ArgumentParser(description='Swap a stackpoint over to an instance of another image')
+        parser.add_argument('pointname')
+        parser.add_argument('imagename')
+        args = parser.parse_args(self.argv[startArg:])
+
+        window = self.pointManager.cutover(args.pointname, args.imagename)
+        self._printSwitch('Cut over', args.pointname, args.imagename, window)
+
+    def fallback_stackpoint(self, startArg=2):
+        parser = argparse.ArgumentParser(description='Swap a stackpoint back to its previous instance')
+        parser.add_argument('pointname')
+        args = parser.parse_args(self.argv[startArg:])
+
+        imageName, window = self.pointManager.fallback(args.pointname)
+        self._printSwitch('Fell back', args.pointname, imageName, window)
+
+    def _printSwitch(self, action, pointName, imageName, window):
+        if window is None:
+            print('{0!s} stackpoint: name={1!s} image={2!s} (was not mounted, mounted now)'.format(action, repr(pointName), repr(imageName)))
+        else:
+            print('{0!s} stackpoint: name={1!s} image={2!s} unavailable={3:.6f}s'.format(action, repr(pointName), repr(imageName), window))
+
     def umount_stackpoint(self, startArg=2):
         parser = argparse.ArgumentParser(
             description='Mount a stack points')
         parser.add_argument('pointname')
-        args = parser.parse_args(sys.argv[2:])
+        args = parser.parse_args(self.argv[startArg:])
         #print('Running umount-stackpoint')
         self.pointManager.umount(args.pointname)
 
+    def delete_stackpoint(self, startArg=2):
+        parser = argparse.ArgumentParser(description='Delete a point and all of its instances')
+        parser.add_argument('pointname')
+        args = parser.parse_args(self.argv[startArg:])
+
+        self.pointManager.deletePoint(args.pointname)
+        print('Deleted point: pointname={0!s}'.format(repr(args.pointname)))
+
     # TEMP TEMP TEMP
     def new_stackpoint_instance(self, startArg=2):
         parser = argparse.ArgumentParser(description='Create a new point instance')
         parser.add_argument('pointname')
         parser.add_argument('imagename')
-        args = parser.parse_args(sys.argv[startArg:])
+        args = parser.parse_args(self.argv[startArg:])
 
         self.pointManager.newPointInstance(args.pointname, args.imagename)
         print('Created point instance: pointname={0!s} imagename={1!s}'.format(repr(args.pointname), repr(args.imagename)))
@@ -113,7 +282,7 @@ StackPoint commands:
         parser = argparse.ArgumentParser(description='Set current point instance')
         parser.add_argument('pointname')
         parser.add_argument('imagename')
-        args = parser.parse_args(sys.argv[startArg:])
+        args = parser.parse_args(self.argv[startArg:])
 
         self.pointManager.setPointInstance(args.pointname, args.imagename)
         print('Set point instance: pointname={0!s} imagename={1!s}'.format(repr(args.pointname), repr(args.imagename)))
@@ -124,7 +293,7 @@ StackPoint commands:
         parser = argparse.ArgumentParser(description='Delete an existing point instance')
         parser.add_argument('pointname')
         parser.add_argument('imagename')
-        args = parser.parse_args(sys.argv[startArg:])
+        args = parser.parse_args(self.argv[startArg:])
 
         self.pointManager.deletePointInstance(args.pointname, args.imagename)
         print('Deleted point instance: pointname={0!s} imagename={1!s}'.format(repr(args.pointname), repr(args.imagename)))
@@ -135,7 +304,7 @@ StackPoint commands:
         parser = argparse.ArgumentParser(description='Create a new image')
         parser.add_argument('name')
         parser.add_argument('parent',  nargs='?', default=None)
-        args = parser.parse_args(sys.argv[startArg:])
+        args = parser.parse_args(self.argv[startArg:])
 
         self.imageManager.newImage(args.name, args.parent)
         print('Added image: name={0!s} parent={1!s}'.format(repr(args.name), repr(args.parent)))
@@ -143,7 +312,7 @@ StackPoint commands:
     def delete_image(self, startArg=2):
         parser = argparse.ArgumentParser(description='Delete an existing image')
         parser.add_argument('name')
-        args = parser.parse_args(sys.argv[startArg:])
+        args = parser.parse_args(self.argv[startArg:])
 
         self.imageManager.deleteImage(args.name)
         print('Deleted image: name={0!s} '.format(repr(args.name)) )
@@ -152,43 +321,86 @@ StackPoint commands:
         parser = argparse.ArgumentParser(description='Mount an image')
         parser.add_argument('name')
         parser.add_argument('--read-only', '-r', action='store_true')
-        args = parser.parse_args(sys.argv[startArg:])
+        args = parser.parse_args(self.argv[startArg:])
 
-        if os.geteuid() != 0:
+        if os.geteuid() != 0 and self.imageManager.mountBackend.requiresRoot:
             print("You need to have root privileges to mount images.")
             sys.exit(1)
 
-        mountDir = self.imageManager.mountImage(args.name, not args.read_only)
-        mountDir = os.path.abspath(mountDir)
+        # an image that is mounted already is left as it is
+        self.imageManager.mountImage(args.name, not args.read_only)
+        mountDir = os.path.abspath(self.imageManager.getInstanceMountDir(args.name, self.imageManager.ownInstance))
         print('Mount image: name={0!s} read-only={1!s}\nmount-point={2!s}'.format(repr(args.name), repr(args.read_only), repr(mountDir)))
 
     def close_image(self, startArg=2):
         parser = argparse.ArgumentParser(description='Mount an image')
         parser.add_argument('name')
-        args = parser.parse_args(sys.argv[startArg:])
+        args = parser.parse_args(self.argv[startArg:])
 
-        if os.geteuid() != 0:
+        if os.geteuid() != 0 and self.imageManager.mountBackend.requiresRoot:
             print("You need to have root privileges to mount images.")
             sys.exit(1)
 
         self.imageManager.umountImage(args.name)
         print('Umount image: name={0!s} '.format(repr(args.name) ))
+        if self.imageManager.blobStore.isEnabled():
+            self.pendingDedup.append(args.name)
+
+    def export_image(self, startArg=2):
+        import archive
+        parser = argparse.ArgumentParser(description='Write an image layer as a tar stream')
+        parser.add_argument('name')
+        parser.add_argument('--output', '-o', default='-', help='file to write, "-" for stdout')
+        parser.add_argument('--codec', '-c', default='none', choices=sorted(archive.codecs.keys()))
+        args = parser.parse_args(self.argv[startArg:])
+
+        if args.output == '-':
+            self.imageManager.exportImage(args.name, sys.stdout.buffer, args.codec)
+        else:
+            with open(args.output, 'wb') as theFile:
+                self.imageManager.exportImage(args.name, theFile, args.codec)
+        # stdout may be carrying the archive
+        sys.stderr.write('Exported image: name={0!s} codec={1!s}\n'.format(repr(args.name), repr(args.codec)))
+
+    def import_image(self, startArg=2):
+        import archive
+        parser = argparse.ArgumentParser(description='Create an image from a tar stream')
+        parser.add_argument('name')
+        parser.add_argument('parent',  nargs='?', default=None)
+        parser.add_argument('--input', '-i', default='-', help='file to read, "-" for stdin')
+        parser.add_argument('--codec', '-c', default='auto', choices=['auto'] + sorted(archive.codecs.keys()))
+        args = parser.parse_args(self.argv[startArg:])
+
+        if os.geteuid() != 0 and self.imageManager.mountBackend.requiresRoot:
+            print("You need to have root privileges to import images.")
+            sys.exit(1)
+
+        if args.input == '-':
+            self.imageManager.importImage(args.name, args.parent, sys.stdin.buffer, args.codec)
+        else:
+            with open(args.input, 'rb') as theFile:
+                self.imageManager.importImage(args.name, args.parent, theFile, args.codec)
+        print('Imported image: name={0!s} parent={1!s}'.format(repr(args.name), repr(args.parent)))
 
     def list_images(self, startArg=2):
         parser = argparse.ArgumentParser(
             description='Show installed images')
         parser.add_argument('--tree', '-t', action='store_true')
-        args = parser.parse_args(sys.argv[2:])
+        parser.add_argument('--usage', '-u', action='store_true', help='show the disk usage of each image layer')
+        parser.add_argument('--full', action='store_true', help='recount the usage instead of using the cache')
+        args = parser.parse_args(self.argv[startArg:])
         print('Running list-images')
-        self.imageManager.listImages(tree=args.tree)
+        self.imageManager.listImages(tree=args.tree, showUsage=args.usage, full=args.full)
 
     def list_instances(self, startArg=2):
         parser = argparse.ArgumentParser(
             description='Show instances generated')
         parser.add_argument('imagename',  nargs='?', default=None)
-        args = parser.parse_args(sys.argv[2:])
+        parser.add_argument('--usage', '-u', action='store_true', help='show the disk usage of each CoW layer')
+        parser.add_argument('--full', action='store_true', help='recount the usage instead of using the cache')
+        args = parser.parse_args(self.argv[startArg:])
         print('Running list-instances')
-        self.imageManager.listInstances(args.imagename)
+        self.imageManager.listInstances(args.imagename, showUsage=args.usage, full=args.full)
 
 
 
@@ -197,7 +409,7 @@ StackPoint commands:
         parser = argparse.ArgumentParser(description='Create a new image')
         parser.add_argument('imagename')
         parser.add_argument('pointname')
-        args = parser.parse_args(sys.argv[startArg:])
+        args = parser.parse_args(self.argv[startArg:])
 
         self.imageManager.newImageInstance(args.imagename, args.pointname)
         print('Added instnace: name={0!s} point={1!s}'.format(repr(args.imagename), repr(args.pointname)))
@@ -207,11 +419,265 @@ StackPoint commands:
         parser = argparse.ArgumentParser(description='Delete an existing image')
         parser.add_argument('imagename')
         parser.add_argument('pointname')
-        args = parser.parse_args(sys.argv[startArg:])
+        args = parser.parse_args(self.argv[startArg:])
 
         self.imageManager.deleteImageInstance(args.imagename, args.pointname)
         print('Deleted instance: name={0!s} point={1!s}'.format(repr(args.imagename), repr(args.pointname)))
 
+    def clone_instance(self, startArg=2):
+        import layerUtils
+        parser = argparse.ArgumentParser(description='Create an instance holding a copy of another instance\'s changes')
+        parser.add_argument('imagename')
+        parser.add_argument('source')
+        parser.add_argument('name')
+        parser.add_argument('--workers', '-w', type=int, default=layerUtils.defaultWorkers)
+        args = parser.parse_args(self.argv[startArg:])
+
+        stats = self.imageManager.cloneInstance(args.imagename, args.source, args.name, args.workers)
+        self._printClone('instance', args.source, args.name, stats)
+
+    def clone_stackpoint(self, startArg=2):
+        parser = argparse.ArgumentParser(description='Create a stackpoint from a copy of another stackpoint\'s current instance')
+        parser.add_argument('pointname')
+        parser.add_argument('newpointname')
+        args = parser.parse_args(self.argv[startArg:])
+
+        stats = self.pointManager.clonePoint(args.pointname, args.newpointname)
+        self._printClone('stackpoint', args.pointname, args.newpointname, stats)
+
+    def _printClone(self, kind, source, name, stats):
+        print('Cloned {0!s}: source={1!s} name={2!s} files={3!s} dirs={4!s} reflinked={5!s} copied={6!s}B'.format(
+            kind, repr(source), repr(name), stats.files, stats.dirs, stats.reflinked, stats.bytesCopied))
+
+    def diff(self, startArg=2):
+        parser = argparse.ArgumentParser(description='Show what an image or instance layer changes')
+        parser.add_argument('imagename')
+        parser.add_argument('instancename', nargs='?', default=None, help='diff the instance against its image')
+        parser.add_argument('--hash', action='store_true', help='show the sha256 of added and modified files')
+        parser.add_argument('--index', action='store_true', help='use and update the layer\'s file index, '
+                                                                  'lists the files changed since the last --index run')
+        parser.add_argument('--json', action='store_true')
+        args = parser.parse_args(self.argv[startArg:])
+
+        result = self.imageManager.diffLayer(args.imagename, args.instancename, args.hash, args.index)
+        if args.json:
+            print(json.dumps(result.summary(), indent=2, sort_keys=True))
+            return
+
+        changes = [('A', path) for path in result.added] + [('M', path) for path in result.modified] + \
+                  [('D', path) for path in result.deleted] + [('O', path + os.sep) for path in result.opaque]
+        for kind, path in sorted(changes, key=lambda change: change[1]):
+            digest = result.hashes.get(path)
+            print('{0!s} {1!s}{2!s}'.format(kind, path, '' if digest is None else '  ' + digest))
+        if args.index:
+            print('Changed since the last index: {0!s}'.format(len(result.changed)))
+            for path in result.changed:
+                print('* {0!s}'.format(path))
+
+    def set_instance_limit(self, startArg=2):
+        import usage
+        parser = argparse.ArgumentParser(description='Limit the size of an instance\'s CoW layer')
+        parser.add_argument('imagename')
+        parser.add_argument('instancename')
+        parser.add_argument('--bytes', '-b', type=usage.parseSize, default=None, help='e.g. 512M, 10G')
+        parser.add_argument('--inodes', '-i', type=int, default=None)
+        parser.add_argument('--clear', action='store_true', help='remove the limit')
+        args = parser.parse_args(self.argv[startArg:])
+
+        if args.clear == (args.bytes is not None or args.inodes is not None):
+            parser.error('give --bytes and/or --inodes, or --clear')
+        enforcedBy = self.imageManager.setInstanceLimit(args.imagename, args.instancename, args.bytes, args.inodes)
+        if enforcedBy is None:
+            print('Cleared instance limit: image={0!s} instance={1!s}'.format(repr(args.imagename), repr(args.instancename)))
+        else:
+            print('Set instance limit: image={0!s} instance={1!s} bytes={2!s} inodes={3!s} enforced-by={4!s}'.format(
+                repr(args.imagename), repr(args.instancename), args.bytes, args.inodes, enforcedBy))
+
+    def squash_image(self, startArg=2):
+        import subprocess
+        parser = argparse.ArgumentParser(description='Flatten an image and its parents into a new root image')
+        parser.add_argument('name')
+        parser.add_argument('newname')
+        parser.add_argument('--background', '-b', action='store_true')
+        args = parser.parse_args(self.argv[startArg:])
+
+        if args.background:
+            # the detached copy waits for the manifest lock this process holds
+            logPath = os.path.join(self.imageManager.metadataDir, "squash-{0!s}.log".format(args.newname))
+            with open(logPath, 'a') as logFile:
+                proc = subprocess.Popen([sys.executable, self.argv[0], 'squash-image', args.name, args.newname],
+                                        stdin=subprocess.DEVNULL, stdout=logFile, stderr=logFile,
+                                        start_new_session=True)
+            print('Squashing image in background: name={0!s} new-name={1!s} pid={2!s} log={3!s}'.format(repr(args.name), repr(args.newname), proc.pid, repr(logPath)))
+            return
+
+        self.imageManager.squashImage(args.name, args.newname)
+        print('Squashed image: name={0!s} new-name={1!s}'.format(repr(args.name), repr(args.newname)))
+
+    def enable_dedup(self, startArg=2):
+        parser = argparse.ArgumentParser(description='Deduplicate identical files across images')
+        args = parser.parse_args(self.argv[startArg:])
+
+        result = self.imageManager.dedupImages()
+        print('Deduplicated images: files={0!s} linked={1!s} bytes-saved={2!s}'.format(result.files,
+                                                                                     result.linked,
+                                                                                     result.bytesSaved))
+
+    # Service Commands
+    def batch(self, startArg=2):
+        parser = argparse.ArgumentParser(description='Run many commands with one manifest load, lock hold and save')
+        parser.add_argument('input', nargs='?', default='-', help='file with one command per line, "-" for stdin')
+        parser.add_argument('--keep-going', '-k', action='store_true', help='run the remaining commands after a failure')
+        parser.add_argument('--atomic', action='store_true', help='undo every command unless all of them succeed')
+        parser.add_argument('--json', action='store_true', help='print one JSON result per command '
+                                                                '(the command output is captured)')
+        args = parser.parse_args(self.argv[startArg:])
+
+        if args.input == '-':
+            lines = sys.stdin.read().splitlines()
+        else:
+            with open(args.input, 'r') as theFile:
+                lines = theFile.read().splitlines()
+
+        commands = []
+        for lineNumber, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                commands.append((lineNumber, parseBatchLine(line)))
+            except ValueError as e:
+                raise error.StacksException("Invalid batch line {0!s}: {1!s}".format(lineNumber, str(e)))
+
+        failed = 0
+        for lineNumber, commandArgv in commands:
+            result = self._runBatchCommand(commandArgv, checkpoint=not args.atomic, capture=args.json)
+            result['line'] = lineNumber
+            if args.json:
+                print(json.dumps(result, sort_keys=True))
+            elif result['ok']:
+                print('[{0!s}] ok: {1!s}'.format(lineNumber, ' '.join(commandArgv)))
+            else:
+                print('[{0!s}] failed: {1!s}: {2!s}'.format(lineNumber, ' '.join(commandArgv), result['error']))
+
+            if not result['ok']:
+                failed += 1
+                if args.atomic:
+                    # leaving the transaction with an error drops every change
+                    raise error.StacksException("Batch failed at line {0!s}, every command was undone".format(lineNumber))
+                if not args.keep_going:
+                    break
+
+        if not args.json:
+            print('Batch done: commands={0!s} failed={1!s}'.format(len(commands), failed))
+        if failed:
+            self.exitStatus = 1
+
+    def _runBatchCommand(self, commandArgv, checkpoint=True, capture=False):
+        """ Runs one batch command against the loaded managers. With
+            checkpoint a failing command leaves no manifest or directory
+            changes behind, like a failing stacko call.
+        """
+        import contextlib
+        import io
+        import time
+
+        command = commandArgv[0].replace("-","_") if commandArgv else None
+        result = {'command': commandArgv, 'ok': False, 'error': None}
+        if command in StacksOptions.unbatchable:
+            result['error'] = "Cannot run {0!s} in a batch".format(commandArgv[0])
+            return result
+
+        states = None
+        if checkpoint:
+            states = (self.imageManager.checkpoint(), self.pointManager.checkpoint(),
+                      self.imageManager.intents.mark())
+        output = io.StringIO()
+        start = time.perf_counter()
+        try:
+            with tracing.span('batch.command', command=command, argv=commandArgv):
+                with contextlib.redirect_stdout(output) if capture else contextlib.nullcontext():
+                    options = StacksOptions(self.imageManager, self.pointManager, [self.argv[0]] + commandArgv)
+                    # a batch holds the exclusive lock already
+                    for name in options.pendingDedup:
+                        self.imageManager.dedupImage(name)
+            result['ok'] = options.exitStatus == 0
+        except error.StacksException as e:
+            result['error'] = str(e)
+        except SystemExit as e:
+            # argparse errors and commands that report through the exit status
+            result['ok'] = e.code in (None, 0)
+            if not result['ok']:
+                result['error'] = "exit status {0!s}".format(e.code)
+        except Exception as e:
+            # e.g. an unreadable --input, it fails this command alone
+            result['error'] = "{0!s}: {1!s}".format(type(e).__name__, str(e))
+        result['seconds'] = time.perf_counter() - start
+        if capture:
+            result['output'] = output.getvalue()
+
+        if not result['ok'] and states is not None:
+            self.imageManager.restore(states[0])
+            self.pointManager.restore(states[1])
+            self.imageManager.intents.rollbackSince(states[2], self.imageManager)
+        return result
+
+    # Metadata Commands
+    def fsck(self, startArg=2):
+        import fsck
+        parser = argparse.ArgumentParser(description='Compare the manifest with images/, mounts/ and the mount table')
+        parser.add_argument('--repair', action='store_true', help='fix what can be fixed, orphan dirs go to the trash')
+        parser.add_argument('--workers', '-w', type=int, default=fsck.defaultWorkers)
+        args = parser.parse_args(self.argv[startArg:])
+
+        checker = fsck.Checker(self.imageManager, self.pointManager)
+        problems = checker.check(args.workers)
+        if args.repair:
+            checker.repair(problems, args.workers)
+
+        for problem in problems:
+            if problem.repaired:
+                status = 'repaired'
+            elif problem.error is not None:
+                status = 'failed: {0!s}'.format(str(problem.error))
+            elif problem.repair is None:
+                status = 'manual'
+            else:
+                status = 'repairable'
+            print('{0!s}: {1!s} [{2!s}]'.format(problem.kind, problem.detail, status))
+        print('{0!s} problems, {1!s} repaired'.format(len(problems), len([problem for problem in problems if problem.repaired])))
+
+    def migrate_db(self, startArg=2):
+        import classDb
+        import layerDiff
+        import mountRefs
+        import usage
+        parser = argparse.ArgumentParser(description='Move the metadata to another storage backend')
+        parser.add_argument('backend', choices=sorted(classDb.storeBackends.keys()))
+        args = parser.parse_args(self.argv[startArg:])
+
+        if classDb.detectBackend(self.imageManager.metadataDir) == args.backend:
+            raise error.StacksException("Metadata already uses the {0!s} backend".format(args.backend))
+
+        imageManager = self.imageManager
+        metadataDir = imageManager.metadataDir
+        # the mount reference counts and the caches are written under their
+        # own locks by commands that only share the manifest lock
+        with imageManager.locks.mountRefs(), imageManager.locks.usage(), imageManager.locks.layerIndex():
+            imageManager.mountRefs = mountRefs.MountRefManager.from_db(metadataDir=metadataDir, itemCls=mountRefs.MountRef)
+            imageManager.usageCache = usage.UsageManager.from_db(metadataDir=metadataDir, itemCls=usage.Usage,
+                                                                 imagesDir=imageManager.imagesDir)
+            imageManager.layerIndexes = layerDiff.LayerIndexManager.from_db(metadataDir=metadataDir,
+                                                                            itemCls=layerDiff.LayerIndex)
+            managers = [imageManager, self.pointManager, imageManager.mountRefs, imageManager.usageCache,
+                        imageManager.layerIndexes]
+            oldStores = [manager.migrate(args.backend) for manager in managers]
+            for store in oldStores:
+                store.retire()
+        print('Migrated metadata: backend={0!s} images={1!s} points={2!s}'.format(repr(args.backend),
+                                                                                 len(self.imageManager.db),
+                                                                                 len(self.pointManager.db)))
+
 
     """
     def new_image(self):
@@ -221,37 +687,164 @@ StackPoint commands:
         parser.add_argument('--amend', action='store_true')
         # now that we're inside a subcommand, ignore the first
         # TWO argvs, ie the command (git) and the subcommand (commit)
-        args = parser.parse_args(sys.argv[2:])
+        args = parser.parse_args(self.argv[startArg:])
         print 'Running git commit, amend=%s' % args.amend
     """
 
-import image
-import point
+# everything else is imported by the commands that need it, see pointQuery()
 import error
-
-import fasteners
+import tracing
 
 # Only serial access should be allowed for modifying data structures. This should
 # be true regarding general access, not just when writing the DB. This is because
 # two concurrent instances of this application, even when the DB is valid, could
 # result in the state of an image/instance/etc to be "forked" and one instance
 # may be using a stale copy of what is in the DB --wrong decisions could be made.
-@fasteners.interprocess_locked('/tmp/stacksDb.lock')
-def main():
-    imageManager = image.ImageManager.from_db(metadataDir="metadata",
-                                              itemCls=image.Image,
-                                              imagesDir="images")
-
-    pointManager = point.PointManager.from_db(metadataDir="metadata",
-                                              itemCls=point.Point,
-                                              mountDir="mounts",
-                                              imageManager=imageManager)
+#
+# Commands that never change the manifest only take the manifest lock shared, so
+# they can run alongside each other. Mount commands do not change the manifest
+# either; they serialize on the per-point/per-instance locks they touch instead.
+def popTraceOption(argv):
+    # --trace FILE may appear anywhere, the subcommand parsers never see it
+    argv = list(argv)
+    for index, arg in enumerate(argv):
+        if arg == '--trace' and index + 1 < len(argv):
+            path = argv[index + 1]
+            del argv[index:index + 2]
+            return argv, path
+        if arg.startswith('--trace='):
+            del argv[index]
+            return argv, arg[len('--trace='):]
+    return argv, None
+
+# health checks run these every few seconds per point
+pointQueries = set(['get_stackpoint_dir', 'is_stackpoint_mounted'])
+
+def pointQuery(command, argv):
+    """ Answer get-stackpoint-dir/is-stackpoint-mounted from the points store
+        and the mount table alone: no manifest lock, no images, none of the
+        image/point modules. Both stores are safe to read without the lock
+        (atomic renames, a torn journal tail is ignored). Returns False to let
+        the regular command answer, e.g. with the error for an unknown point.
+    """
+    import classDb
+    import mountBackend
+
+    parser = argparse.ArgumentParser(description=pointQueryDescriptions[command])
+    parser.add_argument('pointname')
+    args = parser.parse_args(argv)
+
+    # the api.Stacko defaults and PointManager.dbFilename
+    metadataDir = os.path.abspath("metadata")
+    if not classDb.openStore(metadataDir, "points.json").has(args.pointname):
+        return False
+    pointDir = os.path.join(os.path.abspath("mounts"), args.pointname)
+
+    if command == 'get_stackpoint_dir':
+        print(pointDir)
+    else:
+        printMounted(mountBackend.fromEnvironment(metadataDir).isMounted(pointDir))
+    return True
+
+pointQueryDescriptions = {
+    'get_stackpoint_dir': 'Print the directory a stack point is mounted at',
+    'is_stackpoint_mounted': 'Tell if a stack point is mounted (exit status 1 if not)',
+}
+
+def printMounted(mounted):
+    print('yes' if mounted else 'no')
+    if not mounted:
+        sys.exit(1)
+
+def parseBatchLine(line):
+    """ A batch line is a command as typed after "stacko" (shell quoting
+        applies), a JSON list of arguments, or a JSON object with "command"
+        and "args".
+    """
+    import shlex
+
+    if line.startswith('['):
+        commandArgv = json.loads(line)
+    elif line.startswith('{'):
+        entry = json.loads(line)
+        commandArgv = [entry['command']] + list(entry.get('args', []))
+    else:
+        commandArgv = shlex.split(line)
+        if commandArgv and commandArgv[0] == 'stacko':
+            commandArgv = commandArgv[1:]
+    if not commandArgv:
+        raise ValueError("no command")
+    return [str(arg) for arg in commandArgv]
+
+def gc(argv):
+    import api
+    import trash
+
+    parser = argparse.ArgumentParser(description='Remove deleted images and instances for good')
+    parser.add_argument('--workers', '-w', type=int, default=trash.defaultWorkers)
+    parser.add_argument('--rate', '-r', type=int, default=0, help='max files removed per second (0: unlimited)')
+    args = parser.parse_args(argv)
 
     try:
-        StacksOptions(imageManager, pointManager)
-        imageManager.to_db()
-        pointManager.to_db()
+        result = api.Stacko().gc(workers=args.workers, rate=args.rate)
+    except error.StacksException as e:
+        print("Error:\n\t{0!s}".format(str(e)))
+        return
+    print('Collected garbage: entries={0!s} files={1!s} dirs={2!s} freed={3!s}B blobs-freed={4!s}B'.format(
+        result['entries'], result['files'], result['dirs'], result['bytesFreed'], result['blobBytesFreed']))
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    argv, tracePath = popTraceOption(argv)
+    if tracePath:
+        tracing.enable(tracePath)
+    else:
+        tracing.fromEnvironment()
+    try:
+        run(argv)
+    finally:
+        tracing.disable()
+
+def run(argv):
+    command = None
+    if len(argv) > 1:
+        command = argv[1].replace("-","_")
+
+    # the daemon takes the locks per request, not for its whole lifetime
+    if command == 'daemon':
+        import daemon
+        daemon.main(argv[2:])
+        return
+
+    # gc only needs the manifest lock for a moment at the end
+    if command == 'gc':
+        gc(argv[2:])
+        return
+
+    if command in pointQueries and pointQuery(command, argv[2:]):
+        return
+
+    import api
+    stacko = api.Stacko()
+    try:
+        with tracing.span('command', command=command, argv=argv[1:]):
+            with stacko.transaction(shared=command in StacksOptions.sharedCommands):
+                options = StacksOptions(stacko.imageManager, stacko.pointManager, argv)
+            if options.pendingDedup:
+                with stacko.transaction():
+                    for name in options.pendingDedup:
+                        stacko.imageManager.dedupImage(name)
     except error.StacksException as e:
         print("Error:\n\t{0!s}".format(str(e)))
+        # batch reports failures through the exit status, --atomic ones too,
+        # and a health check must not pass for an unknown point
+        if command == 'batch' or command in pointQueries:
+            sys.exit(1)
+        return
+    if options.exitStatus:
+        sys.exit(options.exitStatus)
 
-main()
+if __name__ == '__main__':
+    main()
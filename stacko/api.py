@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+import contextlib
+import os
+import threading
+
+import error
+import image
+import intentLog
+import lock
+import mountBackend
+import mountRefs
+import point
+import tracing
+import trash
+
+class Stacko(object):
+    """ In-process API over ImageManager and PointManager.
+
+        Every call takes the manifest lock (shared for queries, exclusive for
+        changes), reloads the metadata only if another process changed it
+        since the last call, and persists whatever the call changed before
+        returning. Failures raise error.StacksException subclasses.
+    """
+
+    def __init__(self, metadataDir="metadata", imagesDir="images", mountDir="mounts",
+                 locks=None, watchMounts=False, backend=None):
+        self.metadataDir = os.path.abspath(metadataDir)
+        self.imagesDir = os.path.abspath(imagesDir)
+        self.mountDir = os.path.abspath(mountDir)
+        self.locks = locks or lock.LockManager()
+        self.intents = intentLog.IntentLog(self.metadataDir)
+        # what the last recovery of the intent log did, see _recover()
+        self.recovered = []
+
+        # a long running process keeps the mount table and only rereads it
+        # when the kernel reports a change
+        self.mountBackend = backend or mountBackend.fromEnvironment(self.metadataDir)
+        if watchMounts:
+            self.mountBackend.watch()
+
+        # the managers are not thread safe, calls are serialized per object
+        self.guard = threading.RLock()
+        self.imageManager = None
+        self.pointManager = None
+
+    def _load(self):
+        self.imageManager = image.ImageManager.from_db(metadataDir=self.metadataDir,
+                                                       itemCls=image.Image,
+                                                       imagesDir=self.imagesDir,
+                                                       locks=self.locks,
+                                                       mountBackend=self.mountBackend,
+                                                       intents=self.intents)
+
+        self.pointManager = point.PointManager.from_db(metadataDir=self.metadataDir,
+                                                       itemCls=point.Point,
+                                                       mountDir=self.mountDir,
+                                                       imageManager=self.imageManager,
+                                                       locks=self.locks,
+                                                       mountBackend=self.mountBackend)
+
+    def _isLoaded(self):
+        if self.imageManager is None or self.pointManager is None:
+            return False
+        return not (self.imageManager.isStale() or self.pointManager.isStale())
+
+    @contextlib.contextmanager
+    def transaction(self, shared=False):
+        with self.guard:
+            with self.locks.db(shared=shared):
+                if not self._isLoaded():
+                    with tracing.span('api.load'):
+                        self._load()
+                # a process died halfway through a change, only an exclusive
+                # holder can put that right
+                if not shared and self.intents.pending():
+                    self._recover()
+                self.mountBackend.refresh()
+                try:
+                    yield self
+                    with tracing.span('api.save'):
+                        self.imageManager.to_db()
+                        self.intents.saved(self.imageManager.dbFilename)
+                        self.pointManager.to_db()
+                        self.intents.saved(self.pointManager.dbFilename)
+                    self.intents.commit()
+                except:
+                    # forget partial changes, the next call reloads from disk
+                    self.imageManager = None
+                    self.pointManager = None
+                    if not shared:
+                        self._rollback()
+                    raise
+
+    def _recover(self):
+        self.recovered = self.intents.recover(self.imageManager, self.pointManager)
+        self.imageManager.to_db()
+        self.pointManager.to_db()
+        self.intents.clear()
+
+    def _rollback(self):
+        # undo the directory changes of the failed transaction right away,
+        # whatever cannot be undone now is left to the next transaction
+        if not self.intents.pending():
+            self.intents.clear()
+            return
+        try:
+            self._load()
+            self._recover()
+        except Exception:
+            self.imageManager = None
+            self.pointManager = None
+
+    # Image API
+    def newImage(self, name, parent=None):
+        with self.transaction():
+            self.imageManager.newImage(name, parent)
+
+    def deleteImage(self, name):
+        with self.transaction():
+            self.imageManager.deleteImage(name)
+
+    def editImage(self, name, readOnly=False):
+        """ Returns the mount dir, the existing one if the image is mounted already. """
+        with self.transaction(shared=True):
+            self.imageManager.mountImage(name, not readOnly)
+            return os.path.abspath(self.imageManager.getInstanceMountDir(name, self.imageManager.ownInstance))
+
+    def closeImage(self, name):
+        with self.transaction(shared=True):
+            self.imageManager.umountImage(name)
+            dedup = self.imageManager.blobStore.isEnabled()
+        if dedup:
+            with self.transaction():
+                self.imageManager.dedupImage(name)
+
+    def squashImage(self, name, newName):
+        with self.transaction():
+            self.imageManager.squashImage(name, newName)
+
+    def exportImage(self, name, fileobj, codec='none'):
+        with self.transaction(shared=True):
+            self.imageManager.exportImage(name, fileobj, codec)
+
+    def importImage(self, name, fileobj, parent=None, codec='auto'):
+        with self.transaction():
+            self.imageManager.importImage(name, parent, fileobj, codec)
+
+    def cloneInstance(self, name, sourceInstance, instanceName):
+        with self.transaction():
+            stats = self.imageManager.cloneInstance(name, sourceInstance, instanceName)
+            return dict(stats.__dict__)
+
+    def gc(self, workers=trash.defaultWorkers, rate=0):
+        """ Remove deleted image and instance dirs and unreferenced blobs.
+            Only the blob collection takes the manifest lock. Dirs moved by
+            operations in the intent log (running, or pending recovery) are
+            left for a later run.
+        """
+        stats = trash.Trash(os.path.join(self.imagesDir, image.ImageManager.trashDir)).reap(
+            workers, rate, keep=self.intents.trashEntries)
+        with self.transaction():
+            blobBytes = self.imageManager.blobStore.collect()
+        result = dict(stats.__dict__)
+        result['blobBytesFreed'] = blobBytes
+        return result
+
+    def listImages(self):
+        with self.transaction(shared=True):
+            return sorted(self.imageManager.db.keys())
+
+    def imageTree(self):
+        """ {rootName: {childName: {...}}} """
+        with self.transaction(shared=True):
+
+            def subtree(name):
+                return dict((child.name, subtree(child.name))
+                            for child in self.imageManager.getChildImages(name))
+
+            roots = [name for name, obj in list(self.imageManager.db.items()) if obj.parent is None]
+            return dict((root, subtree(root)) for root in roots)
+
+    def getLayerChain(self, name):
+        with self.transaction(shared=True):
+            if name not in self.imageManager.db:
+                raise error.NotFoundException("Image does not exist: {0!s}".format(str(name)))
+            return list(self.imageManager.getLayerChain(name))
+
+    def diskUsage(self, imageName=None, full=False):
+        """ {imageName: {'image': usage, 'instances': {instanceName: usage}}}
+            where usage is {'bytes', 'sharedBytes', 'files', 'scanned'}.
+        """
+        with self.transaction(shared=True):
+            result = self.imageManager.diskUsage(None if imageName is None else [imageName], full)
+            return dict((name, {'image': entry['image'].summary(),
+                                'instances': dict((instance, instanceUsage.summary())
+                                                  for instance, instanceUsage in entry['instances'].items())})
+                        for name, entry in result.items())
+
+    def setInstanceLimit(self, name, instanceName, limitBytes=None, limitInodes=None):
+        """ Both limits None clears the limit. Returns 'kernel', 'mount' or None. """
+        with self.transaction():
+            return self.imageManager.setInstanceLimit(name, instanceName, limitBytes, limitInodes)
+
+    def instanceLimits(self, imageName=None):
+        """ {imageName: {instanceName: {'bytes', 'inodes', 'projectId', 'enforcedBy'}}} """
+        with self.transaction(shared=True):
+            names = sorted(self.imageManager.db.keys()) if imageName is None else [imageName]
+            for name in names:
+                if name not in self.imageManager.db:
+                    raise error.NotFoundException("Image does not exist: {0!s}".format(str(name)))
+            return dict((name, dict(self.imageManager.db[name].limits)) for name in names)
+
+    def diff(self, name, instanceName=None, hashes=False, useIndex=False):
+        """ {'added', 'modified', 'deleted', 'opaque', 'changed': [path, ...], 'hashes': {path: sha256}} """
+        with self.transaction(shared=True):
+            return self.imageManager.diffLayer(name, instanceName, hashes, useIndex).summary()
+
+    def listInstances(self, imageName=None):
+        """ {imageName: [instanceName, ...]} """
+        with self.transaction(shared=True):
+            if imageName is not None:
+                if imageName not in self.imageManager.db:
+                    raise error.NotFoundException("Image does not exist: {0!s}".format(str(imageName)))
+                names = [imageName]
+            else:
+                names = sorted(self.imageManager.db.keys())
+            return dict((name, list(self.imageManager.db[name].instances)) for name in names)
+
+    # StackPoint API
+    def newPoint(self, pointName, imageName):
+        with self.transaction():
+            self.pointManager.newPoint(pointName, imageName)
+
+    def deletePoint(self, pointName):
+        with self.transaction():
+            self.pointManager.deletePoint(pointName)
+
+    def newPointInstance(self, pointName, imageName):
+        with self.transaction():
+            self.pointManager.newPointInstance(pointName, imageName)
+
+    def setPointInstance(self, pointName, imageName):
+        with self.transaction():
+            self.pointManager.setPointInstance(pointName, imageName)
+
+    def deletePointInstance(self, pointName, imageName):
+        with self.transaction():
+            self.pointManager.deletePointInstance(pointName, imageName)
+
+    def mount(self, pointName, timeout=mountBackend.defaultTimeout):
+        with self.transaction(shared=True):
+            return os.path.abspath(self.pointManager.mount(pointName, verbose=False, timeout=timeout))
+
+    def umount(self, pointName):
+        with self.transaction(shared=True):
+            self.pointManager.umount(pointName)
+
+    def cutover(self, pointName, imageName):
+        """ Returns the seconds the point was unavailable (None if it was not mounted). """
+        with self.transaction():
+            return self.pointManager.cutover(pointName, imageName, verbose=False)
+
+    def fallback(self, pointName):
+        """ Returns {'image': imageName, 'seconds': unavailable seconds or None}. """
+        with self.transaction():
+            imageName, window = self.pointManager.fallback(pointName, verbose=False)
+            return {'image': imageName, 'seconds': window}
+
+    def clonePoint(self, pointName, newPointName):
+        with self.transaction():
+            return dict(self.pointManager.clonePoint(pointName, newPointName).__dict__)
+
+    def mountAll(self, workers=point.defaultWorkers, timeout=mountBackend.defaultTimeout):
+        with self.transaction(shared=True):
+            return self._results(self.pointManager.mountAll(workers=workers, timeout=timeout))
+
+    def umountAll(self, workers=point.defaultWorkers):
+        with self.transaction(shared=True):
+            return self._results(self.pointManager.umountAll(workers=workers))
+
+    def reapMounts(self, grace=mountRefs.defaultGrace):
+        """ Names of the images whose idle shared mounts were umounted """
+        with self.transaction(shared=True):
+            return self.imageManager.reapIdleMounts(grace=grace)
+
+    def listPoints(self, pointName=None):
+        """ {pointName: {'current': imageName, 'history': [...], 'instances': [...]}} """
+        with self.transaction(shared=True):
+            if pointName is not None:
+                if pointName not in self.pointManager.db:
+                    raise error.NotFoundException("Point does not exist: {0!s}".format(str(pointName)))
+                names = [pointName]
+            else:
+                names = sorted(self.pointManager.db.keys())
+
+            result = {}
+            for name in names:
+                pointObj = self.pointManager.db[name]
+                instances = self.imageManager.getImagesWithInstanceName(name)
+                result[name] = {
+                    'current': pointObj.currentImage,
+                    'history': list(pointObj.imageHistory),
+                    'instances': sorted([obj.name for obj in instances]),
+                }
+            return result
+
+    def fsck(self, repair=False, workers=None):
+        """ [{'kind', 'detail', 'repairable', 'repaired', 'error'}] """
+        import fsck
+        if workers is None:
+            workers = fsck.defaultWorkers
+        with self.transaction(shared=not repair):
+            checker = fsck.Checker(self.imageManager, self.pointManager)
+            problems = checker.check(workers)
+            if repair:
+                checker.repair(problems, workers)
+            return [{'kind': problem.kind, 'detail': problem.detail, 'repairable': problem.repair is not None,
+                     'repaired': problem.repaired, 'error': None if problem.error is None else str(problem.error)}
+                    for problem in problems]
+
+    def _results(self, results):
+        return [{'name': name, 'seconds': seconds, 'error': None if exc is None else str(exc)}
+                for name, seconds, exc in results]
+
+    # methods that may be called over the daemon socket
+    exported = set([
+        'newImage', 'deleteImage', 'editImage', 'closeImage', 'squashImage', 'cloneInstance', 'gc',
+        'listImages', 'imageTree', 'getLayerChain', 'listInstances', 'diskUsage', 'diff',
+        'setInstanceLimit', 'instanceLimits',
+        'newPoint', 'clonePoint', 'deletePoint', 'newPointInstance', 'setPointInstance', 'deletePointInstance',
+        'mount', 'umount', 'cutover', 'fallback', 'mountAll', 'umountAll', 'reapMounts', 'listPoints', 'fsck',
+    ])
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import subprocess
+import tarfile
+import threading
+
+import error
+import layerUtils
+
+class Codec(object):
+    """ Compression for layer streams. Prefers an external (multi-threaded)
+        tool when it is installed and falls back to the stdlib tarfile
+        stream mode otherwise.
+    """
+
+    def __init__(self, name, magic=None, tarMode=None, compressCmd=None, decompressCmd=None):
+        self.name = name
+        self.magic = magic
+        self.tarMode = tarMode
+        self.compressCmd = compressCmd
+        self.decompressCmd = decompressCmd
+
+    def hasCommand(self, cmd):
+        return cmd is not None and shutil.which(cmd[0]) is not None
+
+    def check(self):
+        if self.tarMode is None and not (self.hasCommand(self.compressCmd) and self.hasCommand(self.decompressCmd)):
+            raise error.StacksException("Codec {0!s} needs {1!s} to be installed".format(self.name, self.compressCmd[0]))
+
+codecs = {
+    'none': Codec('none', tarMode=''),
+    'gzip': Codec('gzip', magic=b'\x1f\x8b', tarMode='gz',
+                  compressCmd=['pigz', '-c'], decompressCmd=['pigz', '-dc']),
+    'bzip2': Codec('bzip2', magic=b'BZh', tarMode='bz2',
+                   compressCmd=['pbzip2', '-c'], decompressCmd=['pbzip2', '-dc']),
+    'xz': Codec('xz', magic=b'\xfd7zXZ\x00', tarMode='xz',
+                compressCmd=['xz', '-T0', '-c'], decompressCmd=['xz', '-T0', '-dc']),
+    'zstd': Codec('zstd', magic=b'\x28\xb5\x2f\xfd',
+                  compressCmd=['zstd', '-T0', '-q', '-c'], decompressCmd=['zstd', '-q', '-dc']),
+}
+
+def detectCodec(fileobj):
+    # fileobj must support peek() (any buffered reader, including stdin)
+    head = fileobj.peek(8)[:8]
+    for codec in list(codecs.values()):
+        if codec.magic and head.startswith(codec.magic):
+            return codec
+    return codecs['none']
+
+def getCodec(name):
+    if name not in codecs:
+        raise error.StacksException("Unknown codec: {0!s}".format(name))
+    return codecs[name]
+
+def exportTree(root, fileobj, codecName='none'):
+    """ Stream the directory as a tar archive to fileobj without staging a
+        copy. Whiteouts and opaque directories are written as .wh. entries.
+    """
+    codec = getCodec(codecName)
+    codec.check()
+
+    if codec.hasCommand(codec.compressCmd):
+        fileobj.flush()
+        proc = subprocess.Popen(codec.compressCmd, stdin=subprocess.PIPE, stdout=fileobj.fileno())
+        try:
+            with tarfile.open(fileobj=proc.stdin, mode='w|', format=tarfile.PAX_FORMAT) as tar:
+                _addTree(tar, root, '')
+        finally:
+            proc.stdin.close()
+            proc.wait()
+        if proc.returncode != 0:
+            raise error.StacksException("{0!s} failed with status {1!s}".format(codec.compressCmd[0], proc.returncode))
+    else:
+        with tarfile.open(fileobj=fileobj, mode='w|' + codec.tarMode, format=tarfile.PAX_FORMAT) as tar:
+            _addTree(tar, root, '')
+        fileobj.flush()
+
+def _addTree(tar, root, relDir):
+    for entry in sorted(os.scandir(os.path.join(root, relDir)), key=lambda entry: entry.name):
+        relPath = os.path.join(relDir, entry.name)
+        st = entry.stat(follow_symlinks=False)
+
+        if layerUtils.isWhiteout(st):
+            info = tarfile.TarInfo(os.path.join(relDir, layerUtils.whiteoutPrefix + entry.name))
+            info.mtime = st.st_mtime
+            tar.addfile(info)
+            continue
+
+        info = tar.gettarinfo(entry.path, arcname=relPath)
+        if info.isreg():
+            with open(entry.path, 'rb') as theFile:
+                tar.addfile(info, theFile)
+        else:
+            tar.addfile(info)
+
+        if entry.is_dir(follow_symlinks=False):
+            if layerUtils.isOpaque(entry.path):
+                marker = tarfile.TarInfo(os.path.join(relPath, layerUtils.opaqueMarker))
+                marker.mtime = st.st_mtime
+                tar.addfile(marker)
+            _addTree(tar, root, relPath)
+
+def importTree(root, fileobj, codecName='auto'):
+    """ Extract a tar stream produced by exportTree (or any layer tarball
+        using .wh. whiteouts) into root, recreating overlayfs whiteouts and
+        opaque directories.
+    """
+    if codecName == 'auto':
+        codec = detectCodec(fileobj)
+    else:
+        codec = getCodec(codecName)
+    codec.check()
+
+    if codec.hasCommand(codec.decompressCmd):
+        proc = subprocess.Popen(codec.decompressCmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+        def pump():
+            try:
+                shutil.copyfileobj(fileobj, proc.stdin, 1024 * 1024)
+            except BrokenPipeError:
+                pass
+            finally:
+                proc.stdin.close()
+
+        pumpThread = threading.Thread(target=pump)
+        pumpThread.daemon = True
+        pumpThread.start()
+        try:
+            with tarfile.open(fileobj=proc.stdout, mode='r|') as tar:
+                _extractTree(tar, root)
+        finally:
+            proc.stdout.close()
+            proc.wait()
+            pumpThread.join()
+        if proc.returncode != 0:
+            raise error.StacksException("{0!s} failed with status {1!s}".format(codec.decompressCmd[0], proc.returncode))
+    else:
+        with tarfile.open(fileobj=fileobj, mode='r|' + codec.tarMode) as tar:
+            _extractTree(tar, root)
+
+def _extractTree(tar, root):
+    root = os.path.realpath(root)
+    directories = []
+    extractArgs = {}
+    if hasattr(tarfile, 'fully_trusted_filter'):
+        # member paths and hardlink targets are validated below, keep devices
+        # and modes (setuid binaries) as they are
+        extractArgs['filter'] = 'fully_trusted'
+
+    for member in tar:
+        name = os.path.normpath(member.name)
+        if os.path.isabs(name) or name == '..' or name.startswith('..' + os.sep):
+            raise error.StacksException("Refusing unsafe path in archive: {0!s}".format(member.name))
+        if name == '.':
+            continue
+
+        parentDir, baseName = os.path.split(name)
+        targetParent = os.path.realpath(os.path.join(root, parentDir))
+        if targetParent != root and not targetParent.startswith(root + os.sep):
+            raise error.StacksException("Refusing path outside of the image in archive: {0!s}".format(member.name))
+
+        if baseName == layerUtils.opaqueMarker:
+            if not os.path.isdir(targetParent):
+                os.makedirs(targetParent)
+            layerUtils.setOpaque(targetParent)
+        elif baseName.startswith(layerUtils.whiteoutPrefix):
+            if not os.path.isdir(targetParent):
+                os.makedirs(targetParent)
+            layerUtils.makeWhiteout(os.path.join(targetParent, baseName[len(layerUtils.whiteoutPrefix):]))
+        else:
+            if member.islnk():
+                _checkHardlink(member, root)
+            # never write through an entry extracted earlier (a symlink to
+            # outside the image, or a hardlink to another file)
+            targetPath = os.path.join(targetParent, baseName)
+            if os.path.lexists(targetPath) and not (member.isdir() and os.path.isdir(targetPath) and not os.path.islink(targetPath)):
+                layerUtils.removePath(targetPath)
+            member.name = name
+            tar.extract(member, root, numeric_owner=True, **extractArgs)
+            if member.isdir():
+                directories.append(member)
+
+    # directory times/modes are only final once everything below them exists
+    for member in reversed(directories):
+        path = os.path.join(root, member.name)
+        os.chmod(path, member.mode)
+        os.utime(path, (member.mtime, member.mtime))
+
+def _checkHardlink(member, root):
+    # symlinks are extracted as they are (absolute ones are normal in
+    # images), the parent dir check and removing existing entries keep
+    # extraction from following them. A hardlink shares the inode it names,
+    # and os.link() follows a symlink given as the target.
+    targetPath = os.path.realpath(os.path.join(root, os.path.normpath(member.linkname)))
+    if not targetPath.startswith(root + os.sep):
+        raise error.StacksException("Refusing link outside of the image in archive: {0!s} -> {1!s}".format(member.name, member.linkname))
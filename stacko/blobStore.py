@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+import shutil
+import stat
+
+# files below this size are not worth a blob (and an inode) of their own
+minBlobSize = 1
+
+defaultWorkers = 8
+
+def hasXattrs(path):
+    try:
+        return len(os.listxattr(path, follow_symlinks=False)) > 0
+    except OSError:
+        # not supported by the filesystem
+        return False
+
+def hashFile(path):
+    # sha256 of the content, blobs and layer diffs use the same digests
+    digest = hashlib.sha256()
+    with open(path, 'rb') as theFile:
+        for chunk in iter(lambda: theFile.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class DedupStats(object):
+
+    def __init__(self):
+        self.files = 0
+        self.linked = 0
+        self.bytesSaved = 0
+
+class BlobStore(object):
+    """ Content addressed store of hardlinks. Identical files in image
+        content dirs are hardlinked to a single blob, so the link count of
+        a blob is its reference count plus one (the store's own link).
+        Blobs are keyed by content hash, mode, owner and mtime, as all of
+        these are shared by every hardlink. Files with xattrs (capabilities,
+        ACLs, security labels) are never linked, those are shared too.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def isEnabled(self):
+        return os.path.isdir(self.path)
+
+    def enable(self):
+        if not self.isEnabled():
+            os.mkdir(self.path)
+
+    def blobPath(self, digest, st):
+        key = "{0!s}-{1:o}-{2!s}-{3!s}-{4!s}".format(digest, stat.S_IMODE(st.st_mode), st.st_uid, st.st_gid,
+                                                     st.st_mtime_ns)
+        return os.path.join(self.path, digest[:2], key)
+
+    def _newFiles(self, root):
+        # regular files that are not linked anywhere else yet
+        for dirPath, dirNames, fileNames in os.walk(root):
+            for fileName in fileNames:
+                path = os.path.join(dirPath, fileName)
+                st = os.lstat(path)
+                if stat.S_ISREG(st.st_mode) and st.st_nlink == 1 and st.st_size >= minBlobSize and not hasXattrs(path):
+                    yield path, st
+
+    def dedupTree(self, root, workers=defaultWorkers):
+        """ Hash the files of root that are not in the store yet and replace
+            them with links to the matching blob (adding new blobs as needed).
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        result = DedupStats()
+        candidates = list(self._newFiles(root))
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            digests = list(executor.map(lambda item: hashFile(item[0]), candidates))
+
+        for (path, st), digest in zip(candidates, digests):
+            result.files += 1
+            blob = self.blobPath(digest, st)
+            blobDir = os.path.dirname(blob)
+            if not os.path.isdir(blobDir):
+                os.makedirs(blobDir, exist_ok=True)
+            try:
+                # first of its kind, the file itself becomes the blob
+                os.link(path, blob)
+                continue
+            except FileExistsError:
+                pass
+            tmpPath = path + ".stacko-dedup"
+            os.link(blob, tmpPath)
+            os.replace(tmpPath, path)
+            result.linked += 1
+            result.bytesSaved += st.st_size
+        return result
+
+    def _blobInodes(self):
+        inodes = set()
+        if not self.isEnabled():
+            return inodes
+        for entry in os.scandir(self.path):
+            if entry.is_dir(follow_symlinks=False):
+                for blob in os.scandir(entry.path):
+                    inodes.add(blob.inode())
+        return inodes
+
+    def unshareTree(self, root):
+        """ Give every file of root that is backed by a blob a private copy
+            again, so it can be edited in place without touching other images.
+        """
+        inodes = self._blobInodes()
+        count = 0
+        if len(inodes) == 0:
+            return count
+        for dirPath, dirNames, fileNames in os.walk(root):
+            for fileName in fileNames:
+                path = os.path.join(dirPath, fileName)
+                st = os.lstat(path)
+                if stat.S_ISREG(st.st_mode) and st.st_nlink > 1 and st.st_ino in inodes:
+                    tmpPath = path + ".stacko-unshare"
+                    shutil.copy2(path, tmpPath)
+                    os.chown(tmpPath, st.st_uid, st.st_gid)
+                    os.replace(tmpPath, path)
+                    count += 1
+        return count
+
+    def collect(self):
+        """ Remove blobs no image links to anymore. Returns the number of
+            bytes freed.
+        """
+        freed = 0
+        if not self.isEnabled():
+            return freed
+        for entry in os.scandir(self.path):
+            if not entry.is_dir(follow_symlinks=False):
+                continue
+            for blob in os.scandir(entry.path):
+                st = blob.stat(follow_symlinks=False)
+                if st.st_nlink == 1:
+                    os.remove(blob.path)
+                    freed += st.st_size
+        return freed
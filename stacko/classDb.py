@@ -1,39 +1,489 @@
+import copy
 import json
 import os
+import sqlite3
+
+from collections.abc import MutableMapping
+
+import tracing
+
+# Number of journal entries tolerated before the journal is folded back into
+# the snapshot file
+compactThreshold = 1000
+
+# The presence of this file in a metadata dir selects the SQLite backend for
+# every ClassDb stored there
+sqliteFilename = "stacko.sqlite"
+
+def syncDir(path):
+    # make a rename/unlink within the directory durable
+    fd = os.open(path or ".", os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def atomicWrite(path, data, mode=0o777):
+    # write to a sibling temp file and rename over the target, readers see
+    # either the old or the new file, never a partially written one
+    tmpPath = path + ".tmp"
+    with open(tmpPath, 'w') as theFile:
+        theFile.write(data)
+        theFile.flush()
+        os.fsync(theFile.fileno())
+    os.chmod(tmpPath, mode)
+    os.replace(tmpPath, path)
+    syncDir(os.path.dirname(path))
+
+def indexValues(indexes, name, record):
+    # index functions return a list of values for a record, None is never indexed
+    return [value for value in indexes[name](record) if value is not None]
+
+class JournalStore(object):
+    """ Snapshot file (the original <name>.json list of records) plus an
+        append-only journal of put/del entries. Commits only append the
+        changed records, the snapshot is rewritten atomically once the
+        journal grows past compactThreshold.
+    """
+
+    def __init__(self, metadataDir, dbFilename, key='name', indexes=None):
+        self.snapshotPath = os.path.join(metadataDir, dbFilename)
+        self.journalPath = self.snapshotPath + ".journal"
+        self.key = key
+        self.indexes = indexes or {}
+        self.records = {}
+        self.index = None
+        self.journalLength = 0
+        # byte offset of the last complete journal entry, anything past this
+        # is a torn write from a crash and is discarded on the next commit
+        self.journalEnd = None
+
+    def load(self):
+        records = {}
+        if os.path.exists(self.snapshotPath):
+            with open(self.snapshotPath, 'r') as theFile:
+                for record in json.load(theFile):
+                    records[record[self.key]] = record
+
+        self.journalLength = 0
+        self.journalEnd = None
+        if os.path.exists(self.journalPath):
+            offset = 0
+            with open(self.journalPath, 'rb') as theFile:
+                for line in theFile:
+                    if not line.endswith(b"\n"):
+                        break
+                    try:
+                        entry = json.loads(line.decode('utf-8'))
+                    except ValueError:
+                        break
+                    self._apply(records, entry)
+                    offset += len(line)
+                    self.journalLength += 1
+            self.journalEnd = offset
+
+        self.records = records
+        self.index = None
+        return self
+
+    def _apply(self, records, entry):
+        if entry['op'] == 'put':
+            record = entry['record']
+            records[record[self.key]] = record
+        elif entry['op'] == 'del':
+            records.pop(entry['key'], None)
+
+    def version(self):
+        # changes whenever another process commits or compacts
+        result = []
+        for path in (self.snapshotPath, self.journalPath):
+            try:
+                st = os.stat(path)
+                result.append((st.st_ino, st.st_size, st.st_mtime_ns))
+            except OSError:
+                result.append(None)
+        return tuple(result)
+
+    def get(self, key):
+        return self.records.get(key)
+
+    def has(self, key):
+        return key in self.records
+
+    def keys(self):
+        return list(self.records.keys())
+
+    def values(self):
+        return list(self.records.values())
+
+    def lookup(self, indexName, value):
+        # the in-memory index is built on first use and dropped on commit
+        if self.index is None:
+            self.index = {}
+        if indexName not in self.index:
+            entries = {}
+            for key, record in list(self.records.items()):
+                for indexValue in indexValues(self.indexes, indexName, record):
+                    entries.setdefault(indexValue, set()).add(key)
+            self.index[indexName] = entries
+        return list(self.index[indexName].get(value, ()))
+
+    def commit(self, puts, deletes):
+        """ puts: list of records to (re)write
+            deletes: list of keys to remove
+        """
+        if len(puts) + len(deletes) == 0:
+            return
+
+        for record in puts:
+            self.records[record[self.key]] = record
+        for key in deletes:
+            self.records.pop(key, None)
+        self.index = None
+
+        if self.journalLength + len(puts) + len(deletes) > compactThreshold:
+            self.compact()
+            return
+
+        lines = [json.dumps({'op': 'put', 'record': record}) for record in puts]
+        lines += [json.dumps({'op': 'del', 'key': key}) for key in deletes]
+        data = ("\n".join(lines) + "\n").encode('utf-8')
+
+        isNew = not os.path.exists(self.journalPath)
+        fd = os.open(self.journalPath, os.O_WRONLY | os.O_CREAT, 0o777)
+        try:
+            if self.journalEnd is not None:
+                os.ftruncate(fd, self.journalEnd)
+                os.lseek(fd, self.journalEnd, os.SEEK_SET)
+            else:
+                os.lseek(fd, 0, os.SEEK_END)
+            os.write(fd, data)
+            os.fsync(fd)
+            self.journalEnd = os.lseek(fd, 0, os.SEEK_CUR)
+        finally:
+            os.close(fd)
+
+        if isNew:
+            os.chmod(self.journalPath, 0o777)
+            syncDir(os.path.dirname(self.journalPath))
+
+        self.journalLength += len(lines)
+
+    @tracing.traced('classDb.compact')
+    def compact(self):
+        atomicWrite(self.snapshotPath, json.dumps(list(self.records.values())))
+        # a crash before the unlink only replays entries already present in
+        # the new snapshot, which is harmless
+        if os.path.exists(self.journalPath):
+            os.remove(self.journalPath)
+            syncDir(os.path.dirname(self.journalPath))
+        self.journalLength = 0
+        self.journalEnd = None
+
+    def replaceAll(self, records):
+        self.records = dict((record[self.key], record) for record in records)
+        self.index = None
+        self.compact()
+
+    def retire(self):
+        # keep the old files around (renamed) after a migration
+        for path in (self.snapshotPath, self.journalPath):
+            if os.path.exists(path):
+                os.replace(path, path + ".migrated")
+
+class SqliteStore(object):
+    """ One table of JSON encoded records per ClassDb plus a side table of
+        (index, value, key) rows, all in a single sqlite file per metadata
+        dir. Records are only decoded when asked for.
+    """
+
+    def __init__(self, metadataDir, dbFilename, key='name', indexes=None):
+        self.path = os.path.join(metadataDir, sqliteFilename)
+        self.table = os.path.splitext(dbFilename)[0]
+        self.key = key
+        self.indexes = indexes or {}
+        self.conn = None
+
+    def load(self):
+        isNew = not os.path.exists(self.path)
+        # mountAll hands the managers to worker threads after warming the
+        # caches, the connection itself is never used concurrently
+        self.conn = sqlite3.connect(self.path, timeout=60, isolation_level=None,
+                                    check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=FULL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS {0} (key TEXT PRIMARY KEY, record TEXT NOT NULL)".format(self.table))
+        self.conn.execute("CREATE TABLE IF NOT EXISTS {0}_index (name TEXT NOT NULL, value TEXT NOT NULL, key TEXT NOT NULL)".format(self.table))
+        self.conn.execute("CREATE INDEX IF NOT EXISTS {0}_index_lookup ON {0}_index (name, value)".format(self.table))
+        self.conn.execute("CREATE INDEX IF NOT EXISTS {0}_index_key ON {0}_index (key)".format(self.table))
+        if isNew:
+            os.chmod(self.path, 0o777)
+        return self
+
+    def version(self):
+        # data_version only changes for commits made by other connections
+        return self.conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def get(self, key):
+        row = self.conn.execute("SELECT record FROM {0} WHERE key = ?".format(self.table), (key,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def has(self, key):
+        row = self.conn.execute("SELECT 1 FROM {0} WHERE key = ?".format(self.table), (key,)).fetchone()
+        return row is not None
+
+    def keys(self):
+        return [row[0] for row in self.conn.execute("SELECT key FROM {0} ORDER BY key".format(self.table))]
+
+    def values(self):
+        return [json.loads(row[0]) for row in self.conn.execute("SELECT record FROM {0} ORDER BY key".format(self.table))]
+
+    def lookup(self, indexName, value):
+        rows = self.conn.execute("SELECT key FROM {0}_index WHERE name = ? AND value = ?".format(self.table),
+                                 (indexName, value))
+        return [row[0] for row in rows]
+
+    def _write(self, puts, deletes):
+        for key in deletes:
+            self.conn.execute("DELETE FROM {0} WHERE key = ?".format(self.table), (key,))
+            self.conn.execute("DELETE FROM {0}_index WHERE key = ?".format(self.table), (key,))
+        for record in puts:
+            key = record[self.key]
+            self.conn.execute("INSERT OR REPLACE INTO {0} (key, record) VALUES (?, ?)".format(self.table),
+                              (key, json.dumps(record)))
+            self.conn.execute("DELETE FROM {0}_index WHERE key = ?".format(self.table), (key,))
+            for indexName in self.indexes:
+                for value in indexValues(self.indexes, indexName, record):
+                    self.conn.execute("INSERT INTO {0}_index (name, value, key) VALUES (?, ?, ?)".format(self.table),
+                                      (indexName, value, key))
+
+    def commit(self, puts, deletes):
+        if len(puts) + len(deletes) == 0:
+            return
+        with self.transaction():
+            self._write(puts, deletes)
+
+    def transaction(self):
+        return SqliteTransaction(self.conn)
+
+    def replaceAll(self, records):
+        with self.transaction():
+            self.conn.execute("DELETE FROM {0}".format(self.table))
+            self.conn.execute("DELETE FROM {0}_index".format(self.table))
+            self._write(list(records), [])
+
+    def retire(self):
+        # the sqlite file is shared by every ClassDb in the metadata dir
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(self.path + suffix):
+                os.replace(self.path + suffix, self.path + suffix + ".migrated")
+
+class SqliteTransaction(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, excType, excValue, traceback):
+        if excType is None:
+            self.conn.execute("COMMIT")
+        else:
+            self.conn.execute("ROLLBACK")
+        return False
+
+storeBackends = {
+    'json': JournalStore,
+    'sqlite': SqliteStore,
+}
+
+def detectBackend(metadataDir):
+    if os.path.exists(os.path.join(metadataDir, sqliteFilename)):
+        return 'sqlite'
+    return 'json'
+
+def openStore(metadataDir, dbFilename, key='name', indexes=None, backend=None):
+    if backend is None:
+        backend = detectBackend(metadataDir)
+    return storeBackends[backend](metadataDir, dbFilename, key, indexes).load()
+
+class RecordMap(MutableMapping):
+    """ Dict-like view over a store. Objects are built from their records on
+        first access, and assignments/deletions are remembered so that only
+        those records are written back. In-place changes to a stored object
+        are not visible to the map, use markDirty() for those.
+    """
+
+    def __init__(self, store=None, itemCls=None, indexes=None, items=None):
+        self.store = store
+        self.itemCls = itemCls
+        self.indexes = indexes or {}
+        self.cache = {}
+        self.dirty = set()
+        self.deleted = set()
+        if items:
+            for key, obj in list(items.items()):
+                self[key] = obj
+
+    def __getitem__(self, key):
+        if key in self.cache:
+            return self.cache[key]
+        if key in self.deleted or self.store is None:
+            raise KeyError(key)
+        record = self.store.get(key)
+        if record is None:
+            raise KeyError(key)
+        obj = self.itemCls(**record)
+        self.cache[key] = obj
+        return obj
+
+    def __contains__(self, key):
+        if key in self.cache:
+            return True
+        if key in self.deleted or self.store is None:
+            return False
+        return self.store.has(key)
+
+    def __setitem__(self, key, value):
+        self.cache[key] = value
+        self.dirty.add(key)
+        self.deleted.discard(key)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.cache.pop(key, None)
+        self.dirty.discard(key)
+        self.deleted.add(key)
+
+    def _keys(self):
+        keys = set(self.cache.keys())
+        if self.store is not None:
+            keys.update(self.store.keys())
+        return keys - self.deleted
+
+    def __iter__(self):
+        return iter(self._keys())
+
+    def __len__(self):
+        return len(self._keys())
+
+    def lookup(self, indexName, value):
+        keys = set()
+        if self.store is not None:
+            keys.update(self.store.lookup(indexName, value))
+        # the store only knows about persisted records, re-check the ones
+        # changed by this process
+        keys -= self.deleted
+        for key in self.dirty:
+            if value in indexValues(self.indexes, indexName, self.cache[key].__dict__):
+                keys.add(key)
+            else:
+                keys.discard(key)
+        return [self[key] for key in keys]
+
+    def markDirty(self, key):
+        if key in self:
+            self.dirty.add(key)
+
+    def isDirty(self):
+        return len(self.dirty) > 0 or len(self.deleted) > 0
+
+    def clearDirty(self):
+        self.dirty = set()
+        self.deleted = set()
+
+    def checkpoint(self):
+        # copies every object loaded so far, cheap only while few are
+        return (copy.deepcopy(self.cache), set(self.dirty), set(self.deleted))
+
+    def restore(self, state):
+        cache, dirty, deleted = state
+        self.cache = copy.deepcopy(cache)
+        self.dirty = set(dirty)
+        self.deleted = set(deleted)
 
 class ClassDb(object):
 
     metadataDir = None
     db = None
+    store = None
 
-    def __init__(self, db=None, metadataDir=None,**kwargs):
-        if db:
-            self.db = db
-        else:
-            self.db = {}
+    # name -> function(record) returning the values a record is indexed by
+    indexes = {}
 
+    def __init__(self, db=None, metadataDir=None, store=None, itemCls=None, **kwargs):
         if metadataDir:
             self.metadataDir = metadataDir
 
+        self.store = store
+        self.db = RecordMap(store, itemCls, self.indexes, items=db)
+        self.loadedVersion = None
+        if store is not None:
+            self.loadedVersion = store.version()
+
     @classmethod
-    def from_db(cls, metadataDir, itemCls, key='name',**kwargs):
-        db=None
-        dbFilename = os.path.join(metadataDir,cls.dbFilename)
-        if os.path.exists(dbFilename):
-            db = {}
-            imageList = json.load(open(dbFilename,'r'))
-            for items in imageList:
-                db[items[key]] = itemCls(**items)
-        obj = cls(db, metadataDir=metadataDir,**kwargs)
+    def from_db(cls, metadataDir, itemCls, key='name', backend=None, **kwargs):
+        with tracing.span('classDb.load', db=cls.dbFilename):
+            store = openStore(metadataDir, cls.dbFilename, key, cls.indexes, backend)
+        obj = cls(metadataDir=metadataDir, store=store, itemCls=itemCls, **kwargs)
         return obj
 
+    def markDirty(self, name):
+        # record an in-place change to an object already in the db
+        self.db.markDirty(name)
+
+    def lookup(self, indexName, value):
+        return self.db.lookup(indexName, value)
+
     def to_db(self):
-        jsonDb = []
-        for name, obj in list(self.db.items()):
-            jsonDb.append(obj.__dict__)
-
-        theFilePath = os.path.join(self.metadataDir,self.dbFilename)
-        theFile = open(theFilePath,'w')
-        json.dump(jsonDb, theFile)
-        theFile.close()
-        os.chmod(theFilePath, 0o777)
+        # only the objects touched by this process are written
+        if not self.db.isDirty():
+            return
+
+        if self.store is None:
+            self.store = openStore(self.metadataDir, self.dbFilename, indexes=self.indexes)
+            self.db.store = self.store
+
+        puts = [self.db[name].__dict__ for name in sorted(self.db.dirty)]
+        deletes = sorted(self.db.deleted)
+
+        with tracing.span('classDb.save', db=self.dbFilename, puts=len(puts), deletes=len(deletes)):
+            self.store.commit(puts, deletes)
+        self.db.clearDirty()
+        self.loadedVersion = self.store.version()
+
+    def checkpoint(self):
+        """ In-memory state of the unsaved changes, to go back to with
+            restore() when a step of a larger operation fails.
+        """
+        return self.db.checkpoint()
+
+    def restore(self, state):
+        self.db.restore(state)
+
+    def isStale(self):
+        # True when another process changed the store since it was loaded
+        return self.store is not None and self.store.version() != self.loadedVersion
+
+    def migrate(self, backend):
+        """ Copy every record into a store of the given backend and switch
+            over to it. The old store is returned so that the caller can
+            retire() it once every ClassDb sharing the metadata dir has been
+            migrated.
+        """
+        self.to_db()
+        oldStore = self.store
+        newStore = storeBackends[backend](self.metadataDir, self.dbFilename,
+                                          oldStore.key, self.indexes).load()
+        newStore.replaceAll(oldStore.values())
+        self.store = newStore
+        self.db.store = newStore
+        return oldStore
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+import argparse
+import json
+import os
+import socket
+import socketserver
+import stat
+import threading
+import time
+
+import api
+import error
+import tracing
+
+defaultSocketPath = '/tmp/stacko.sock'
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """ One JSON object per line in each direction:
+            -> {"method": "mount", "args": ["system1fs"], "kwargs": {}}
+            <- {"result": "/.../mounts/system1fs"}
+            <- {"error": "NotFoundException", "message": "..."}
+    """
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            response = self.server.dispatch(line)
+            self.wfile.write((json.dumps(response) + "\n").encode('utf-8'))
+            self.wfile.flush()
+
+def isListening(socketPath):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socketPath)
+    except ConnectionRefusedError:
+        return False
+    finally:
+        sock.close()
+    return True
+
+class StackoServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    daemon_threads = True
+
+    def __init__(self, socketPath, stacko):
+        self.stacko = stacko
+        if os.path.lexists(socketPath):
+            if not stat.S_ISSOCK(os.lstat(socketPath).st_mode) or isListening(socketPath):
+                raise error.StacksException("Socket path is in use: {0!s}".format(socketPath))
+            # left behind by a daemon that did not shut down cleanly
+            os.remove(socketPath)
+        # mount operations need root, so should anyone talking to us: the
+        # socket is created private instead of being chmodded once bound
+        oldMask = os.umask(0o177)
+        try:
+            socketserver.UnixStreamServer.__init__(self, socketPath, RequestHandler)
+        finally:
+            os.umask(oldMask)
+
+    def dispatch(self, line):
+        try:
+            request = json.loads(line.decode('utf-8'))
+            method = request['method']
+            if method not in api.Stacko.exported:
+                raise error.StacksException("Unknown method: {0!s}".format(method))
+            with tracing.span('daemon.request', method=method):
+                result = getattr(self.stacko, method)(*request.get('args', []), **request.get('kwargs', {}))
+            return {'result': result}
+        except error.StacksException as e:
+            return {'error': type(e).__name__, 'message': str(e)}
+        except Exception as e:
+            return {'error': 'InternalError', 'message': "{0!s}: {1!s}".format(type(e).__name__, str(e))}
+
+class Client(object):
+    """ Calls Stacko methods on a running daemon, raising the same exception
+        types the in-process API would.
+    """
+
+    def __init__(self, socketPath=defaultSocketPath):
+        self.socketPath = socketPath
+        self.sock = None
+        self.reader = None
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socketPath)
+        self.reader = self.sock.makefile('rb')
+
+    def close(self):
+        if self.sock is not None:
+            self.reader.close()
+            self.sock.close()
+            self.sock = None
+
+    def call(self, method, *args, **kwargs):
+        if self.sock is None:
+            self.connect()
+        request = {'method': method, 'args': list(args), 'kwargs': kwargs}
+        self.sock.sendall((json.dumps(request) + "\n").encode('utf-8'))
+        line = self.reader.readline()
+        if not line:
+            self.close()
+            raise error.StacksException("Daemon closed the connection")
+        response = json.loads(line.decode('utf-8'))
+        if 'error' in response:
+            excCls = getattr(error, response['error'], error.StacksException)
+            if not (isinstance(excCls, type) and issubclass(excCls, error.StacksException)):
+                excCls = error.StacksException
+            raise excCls(response['message'])
+        return response['result']
+
+    def __getattr__(self, method):
+        if method not in api.Stacko.exported:
+            raise AttributeError(method)
+        return lambda *args, **kwargs: self.call(method, *args, **kwargs)
+
+def collectGarbage(stacko, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            stacko.gc()
+        except Exception as e:
+            print('gc failed: {0!s}'.format(str(e)))
+
+def reapMounts(stacko, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            stacko.reapMounts()
+        except Exception as e:
+            print('reap-mounts failed: {0!s}'.format(str(e)))
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Serve the stacko API over a unix socket')
+    parser.add_argument('--socket', '-s', default=defaultSocketPath)
+    parser.add_argument('--gc-interval', type=float, default=0, help='seconds between gc runs (0: never)')
+    parser.add_argument('--reap-interval', type=float, default=0, help='seconds between reap-mounts runs (0: never)')
+    args = parser.parse_args(argv)
+
+    stacko = api.Stacko(watchMounts=True)
+    server = StackoServer(args.socket, stacko)
+    if args.gc_interval > 0:
+        collector = threading.Thread(target=collectGarbage, args=(stacko, args.gc_interval))
+        collector.daemon = True
+        collector.start()
+    if args.reap_interval > 0:
+        reaper = threading.Thread(target=reapMounts, args=(stacko, args.reap_interval))
+        reaper.daemon = True
+        reaper.start()
+    print('Serving stacko: socket={0!s}'.format(repr(args.socket)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
@@ -1 +1,10 @@
 class StacksException(Exception): pass
+
+# Subclasses let library callers (see api.Stacko) tell failures apart, the CLI
+# still only catches StacksException
+class NotFoundException(StacksException): pass
+class ExistsException(StacksException): pass
+class InUseException(StacksException): pass
+class ManifestMismatchException(StacksException): pass
+class QuotaExceededException(StacksException): pass
+class MountTimeoutException(StacksException): pass
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import tracing
+
+defaultWorkers = 8
+
+class Problem(object):
+    """ One difference between the manifest, the directory tree and the mount
+        table. repair is None for problems that need a human.
+    """
+
+    def __init__(self, kind, detail, repair=None, onDisk=True):
+        self.kind = kind
+        self.detail = detail
+        self.repair = repair
+        # disk repairs run in parallel, manifest repairs one after another
+        self.onDisk = onDisk
+        self.repaired = False
+        self.error = None
+
+class Checker(object):
+    """ Reconciles the manifest of images and points with images/, mounts/
+        and the mount table. Orphan directories are moved to the image trash
+        (see gc), never removed outright.
+    """
+
+    def __init__(self, imageManager, pointManager):
+        self.imageManager = imageManager
+        self.pointManager = pointManager
+        # the mount table holds resolved paths
+        self.imagesDir = os.path.realpath(imageManager.imagesDir)
+        self.mountDir = os.path.realpath(pointManager.mountDir)
+
+    def _listDir(self, path):
+        try:
+            return sorted(os.listdir(path))
+        except FileNotFoundError:
+            return None
+
+    @tracing.traced('fsck.check')
+    def check(self, workers=defaultWorkers):
+        imageManager = self.imageManager
+        pointManager = self.pointManager
+        backend = imageManager.mountBackend
+        problems = []
+
+        images = dict(imageManager.db.items())
+        points = dict(pointManager.db.items())
+        imageNames = sorted(images.keys())
+
+        # one listing per image dir, on a thread pool as images/ can be large
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            listings = dict(zip(imageNames, executor.map(
+                lambda name: self._listDir(imageManager.getImageDir(name)), imageNames)))
+        mounted = set(backend.snapshot().keys())
+
+        # instances whose dir is gone, the repair also drops them from history
+        missingInstances = set()
+
+        # images
+        for name in imageNames:
+            imageObj = images[name]
+            if imageObj.parent is not None and imageObj.parent not in images:
+                problems.append(Problem('missing-parent', "image={0!s} parent={1!s}".format(name, imageObj.parent)))
+
+            listing = listings[name]
+            if listing is None:
+                problems.append(Problem('missing-image-dir', "image={0!s} dir={1!s}".format(name, imageManager.getImageDir(name))))
+                continue
+            if imageManager.ownInstance not in listing:
+                problems.append(Problem('missing-image-content', "image={0!s}".format(name)))
+
+            for instanceName in imageObj.instances:
+                if instanceName not in listing:
+                    missingInstances.add((name, instanceName))
+                    problems.append(Problem('missing-instance-dir', "image={0!s} instance={1!s}".format(name, instanceName),
+                                            self._dropInstance(name, instanceName), onDisk=False))
+
+            for entry in listing:
+                if entry != imageManager.ownInstance and entry not in imageObj.instances:
+                    path = imageManager.getInstancesDir(name, entry)
+                    problems.append(Problem('orphan-instance-dir', "image={0!s} dir={1!s}".format(name, path),
+                                            self._trashUnmounted(path, mounted)))
+
+        for entry in self._listDir(self.imagesDir) or []:
+            if not entry.startswith(".") and entry not in images:
+                path = os.path.join(self.imagesDir, entry)
+                problems.append(Problem('orphan-image-dir', "dir={0!s}".format(path), self._trashUnmounted(path, mounted)))
+
+        # points
+        for name in sorted(points.keys()):
+            pointObj = points[name]
+            pointDir = os.path.realpath(pointManager.getMountPointDir(name))
+            if not os.path.isdir(pointDir):
+                problems.append(Problem('missing-mount-dir', "point={0!s} dir={1!s}".format(name, pointDir),
+                                        self._makeDir(pointDir)))
+
+            for imageName in pointObj.imageHistory:
+                if imageName not in images or name not in images[imageName].instances or (imageName, name) in missingInstances:
+                    problems.append(Problem('dangling-history', "point={0!s} image={1!s}".format(name, imageName),
+                                            self._dropHistory(name, imageName), onDisk=False))
+
+            if pointObj.currentImage not in pointObj.imageHistory:
+                problems.append(Problem('current-not-in-history', "point={0!s} image={1!s}".format(name, pointObj.currentImage),
+                                        self._appendHistory(name), onDisk=False))
+
+        for entry in self._listDir(self.mountDir) or []:
+            path = os.path.join(self.mountDir, entry)
+            if entry == pointManager.stagingDir:
+                for staged in self._listDir(path) or []:
+                    stagedPath = os.path.join(path, staged)
+                    if stagedPath not in mounted:
+                        problems.append(Problem('stale-staging-dir', "dir={0!s}".format(stagedPath), self._removeEmptyDir(stagedPath)))
+            elif entry not in points and path not in mounted:
+                problems.append(Problem('orphan-mount-dir', "dir={0!s}".format(path), self._removeEmptyDir(path)))
+
+        # mounts below images/ and mounts/ that no instance or point accounts for
+        expected = set()
+        for name in imageNames:
+            for instanceName in images[name].instances + [imageManager.ownInstance]:
+                expected.add(os.path.realpath(imageManager.getInstanceMountDir(name, instanceName)))
+        for name in points:
+            expected.add(os.path.realpath(pointManager.getMountPointDir(name)))
+
+        # nested mounts come first, they are umounted one after another
+        for path in sorted(mounted, reverse=True):
+            managed = path.startswith(self.imagesDir + os.sep) or path.startswith(self.mountDir + os.sep)
+            if managed and path not in expected:
+                problems.append(Problem('stale-mount', "path={0!s}".format(path), self._umount(path), onDisk=False))
+
+        return problems
+
+    def repair(self, problems, workers=defaultWorkers):
+        """ Run every available repair: the manifest ones in order, the disk
+            ones on a thread pool. Failures are kept on the problem.
+        """
+        def run(problem):
+            try:
+                problem.repair()
+                problem.repaired = True
+            except Exception as e:
+                problem.error = e
+
+        fixable = [problem for problem in problems if problem.repair is not None]
+        for problem in fixable:
+            if not problem.onDisk:
+                run(problem)
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            list(executor.map(run, [problem for problem in fixable if problem.onDisk]))
+
+    # repairs
+    def _dropInstance(self, imageName, instanceName):
+        def repair():
+            imageObj = self.imageManager.db[imageName]
+            imageObj.instances.remove(instanceName)
+            imageObj.limits.pop(instanceName, None)
+            self.imageManager.markDirty(imageName)
+        return repair
+
+    def _dropHistory(self, pointName, imageName):
+        def repair():
+            pointObj = self.pointManager.db[pointName]
+            remaining = [name for name in pointObj.imageHistory if name != imageName]
+            if pointObj.currentImage == imageName:
+                if len(remaining) == 0:
+                    raise RuntimeError("No instance left for the point, delete it instead")
+                pointObj.currentImage = remaining[-1]
+            pointObj.imageHistory = remaining
+            self.pointManager.markDirty(pointName)
+        return repair
+
+    def _appendHistory(self, pointName):
+        def repair():
+            pointObj = self.pointManager.db[pointName]
+            pointObj.imageHistory.append(pointObj.currentImage)
+            self.pointManager.markDirty(pointName)
+        return repair
+
+    def _trashUnmounted(self, path, mounted):
+        def repair():
+            prefix = path + os.sep
+            if any(mount == path or mount.startswith(prefix) for mount in mounted):
+                raise RuntimeError("Something is mounted below it")
+            self.imageManager.trash.moveIn(path)
+        return repair
+
+    def _makeDir(self, path):
+        return lambda: os.makedirs(path)
+
+    def _removeEmptyDir(self, path):
+        # a non empty dir fails here and is left for a human
+        return lambda: os.rmdir(path)
+
+    def _umount(self, path):
+        return lambda: self.imageManager.mountBackend.umount(path, lazy=True)
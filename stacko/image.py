@@ -1,29 +1,55 @@
 # -*- coding: utf-8 -*-
 import os
-import shutil
-import platform
-
-import overlayUtils
 
+import blobStore
 import classDb
 import error
+import intentLog
+import layerDiff
+import layerUtils
+import lock
+import mountBackend
+import mountRefs
+import quota
+import tracing
+import trash
+import usage
 
 class Image(object):
 
-    def __init__(self, name, parent, version, instances):
+    def __init__(self, name, parent, version, instances, limits=None):
         self.name = name
         self.parent = parent
         self.version = version
         self.instances = instances
+        # instanceName -> {'bytes', 'inodes', 'projectId', 'enforcedBy'}, see setInstanceLimit
+        self.limits = limits or {}
 
     def __lt__(self, other):
         return self.name < other.name
 
+# kernel release -> legacy, detected once per process
+legacyKernels = {}
+
+def isLegacyKernel(release=None):
+    """ overlayfs before 3.19 takes a single lower dir """
+    if release is None:
+        release = os.uname().release
+    if release not in legacyKernels:
+        versions = release.split(".")
+        legacyKernels[release] = int(versions[0]) < 3 or (int(versions[0]) == 3 and int(versions[1]) < 19)
+    return legacyKernels[release]
+
 # Manages image relations and can spawn instances of images
 class ImageManager(classDb.ClassDb):
 
     dbFilename = "images.json"
 
+    indexes = {
+        'parent': lambda record: [record['parent']],
+        'instance': lambda record: record['instances'],
+    }
+
     # image dir paths
     imageDir = None
     imageContentDir = "content"
@@ -31,9 +57,8 @@ class ImageManager(classDb.ClassDb):
 
     # reserved for internal use
     ownInstance = ".self"
-
-    legacy = None
-
+    blobsDir = ".blobs"
+    trashDir = ".trash"
 
     def __init__(self, *args, **kwargs):
         super(ImageManager, self).__init__(*args, **kwargs)
@@ -42,48 +67,84 @@ class ImageManager(classDb.ClassDb):
         if len(self.imagesDir.strip()) <= 5:
             raise RuntimeError("Unexpected dirname: {0!s}".format(repr(self.imagesDir)))
 
-        if 'legacy' in kwargs:
-            # allow forcing legacy behavior (for testing and general compatibility)
-            self.legacy = kwargs['legacy']
-        else:
-            # detect legacy behavior from environment
-            versions = platform.release().split(".")
-            if int(versions[0]) < 3 or (int(versions[0]) == 3 and int(versions[1]) < 19 ) :
-                self.legacy = True
-            else:
+        # per-instance locks guard mount state, the manifest lock is held by the caller
+        self.locks = kwargs.get('locks') or lock.LockManager()
+
+        # performs the mounts and answers mount table queries, see mountBackend
+        self.mountBackend = kwargs.get('mountBackend') or mountBackend.OverlayBackend()
+
+        # optional content addressed store shared by all images, deduplication
+        # is active once its directory exists (see enable-dedup)
+        self.blobStore = blobStore.BlobStore(os.path.join(self.imagesDir, self.blobsDir))
 
-                self.legacy = False
+        # deleted dirs wait here for the reaper (see gc) instead of being
+        # removed while the manifest lock is held
+        self.trash = trash.Trash(os.path.join(self.imagesDir, self.trashDir))
 
+        # records the directory changes that the manifest only learns about
+        # when it is saved, api.Stacko passes the real one
+        self.intents = kwargs.get('intents') or intentLog.NullIntentLog()
 
+        # disk usage cache, loaded on first use, see diskUsage()
+        self.usageCache = None
+        self.quotas = kwargs.get('quotas') or quota.ProjectQuotas()
+        self.layerIndexes = None
+        # legacy mode .self mount reference counts, loaded on first use
+        self.mountRefs = None
+
+        # memoized ancestry, see getLayerChain()
+        self.layerChains = {}
+        self.lowerDirs = {}
+
+        # allow forcing legacy behavior (for testing and general compatibility),
+        # otherwise it is detected on first use, see isLegacyKernel()
+        self._legacy = kwargs.get('legacy')
+
+    @property
+    def legacy(self):
+        if self._legacy is None:
+            self._legacy = isLegacyKernel()
+        return self._legacy
+
+    @tracing.traced('image.newImage')
     def newImage(self, name, parent):
+        # names starting with a dot are used for stacko's own dirs under imagesDir
+        if name.startswith("."):
+            raise error.StacksException("Image names cannot start with '.': {0!s}".format(str(name)))
+
         # validate input against the manifest
         if name in self.db:
-            raise error.StacksException("Image name already exists: {0!s}".format(str(name)))
+            raise error.ExistsException("Image name already exists: {0!s}".format(str(name)))
         if parent is not None and parent not in self.db:
-            raise error.StacksException("Parent does not exist: {0!s}".format(str(parent)))
+            raise error.NotFoundException("Parent does not exist: {0!s}".format(str(parent)))
 
         # check if the image dirs exist for the parent node
         if parent is not None:
             parentDir = self.getImageDir(parent)
             if not os.path.exists(parentDir):
-                raise error.StacksException("Parent image directory does not exist: {0!s}".format(str(parentDir)))
+                raise error.NotFoundException("Parent image directory does not exist: {0!s}".format(str(parentDir)))
 
         # ensure the node path does not exist already (for some reason)
         imageDir = self.getImageDir(name)
         if os.path.exists(imageDir):
-            raise error.StacksException("Manifest mismatch. Image directory already exists: {0!s}".format(str(imageDir)))
+            raise error.ManifestMismatchException("Manifest mismatch. Image directory already exists: {0!s}".format(str(imageDir)))
 
         # create a new node directories and update the manifest
-        os.mkdir(imageDir)
+        with self.intents.intent('newImage') as intent:
+            intent.expect('image', [name])
+            intent.create(imageDir)
+            os.mkdir(imageDir)
 
-        self.db[name] = Image(name, parent, None, [])
-        self.newImageInstance(name, self.ownInstance, force=True)
+            self.db[name] = Image(name, parent, None, [])
+            self.invalidateLayerChains()
+            self.newImageInstance(name, self.ownInstance, force=True)
 
 
+    @tracing.traced('image.deleteImage')
     def deleteImage(self, name):
         # validate input against the manifest
         if name not in self.db:
-            raise error.StacksException("Image does not exist: {0!s}".format(str(name)))
+            raise error.NotFoundException("Image does not exist: {0!s}".format(str(name)))
 
         imageObj = self.db[name]
         children = self.getChildImages(name)
@@ -91,58 +152,152 @@ class ImageManager(classDb.ClassDb):
         # check if the image dirs exist for the parent node
         if len(children) > 0:
             childrenStr = ", ".join([ obj.name for obj in children ])
-            raise error.StacksException("Image is supporting other images: {0!s}".format(childrenStr))
+            raise error.InUseException("Image is supporting other images: {0!s}".format(childrenStr))
 
         # ensure there are no instantiations of this image
         if len(imageObj.instances) > 0:
             instancesStr = ", ".join(imageObj.instances)
-            raise error.StacksException("Cannot delete an image that supports other instances: {0!s}".format(instancesStr))
+            raise error.InUseException("Cannot delete an image that supports other instances: {0!s}".format(instancesStr))
         else:
             # double check to see the instance dir is really empty
             instancesDirLs = os.listdir(self.getInstancesDir(name))
             if self.ownInstance in instancesDirLs:
                 instancesDirLs.remove(self.ownInstance)
             if len(instancesDirLs) > 0:
-                raise error.StacksException("Manifest mismatch. Image may be supporting instances.")
+                raise error.ManifestMismatchException("Manifest mismatch. Image may be supporting instances.")
 
         # ensure there are no instances being supported by this image currently mounted
-        instancesInUse = []
-        for instance in list(imageObj.instances):
-            instanceMountDir = os.path.join( self.getInstancesDir(imageObj, instance),
-                                             "mount")
-            if overlayUtils.isMounted(instanceMountDir):
-                instancesInUse.append(instance)
+        instancesInUse = self.getMountedInstances(imageObj)
 
         if len(instancesInUse) > 0:
             instanceStr = ", ".join(instancesInUse)
-            raise error.StacksException("Cannot delete an image that supports other mounted instances: {0!s}".format(instanceStr))
+            raise error.InUseException("Cannot delete an image that supports other mounted instances: {0!s}".format(instanceStr))
 
-        instanceMountDir = os.path.join( self.getInstancesDir(imageObj, self.ownInstance),
-                                         "mount")
+        instanceMountDir = self.getInstanceMountDir(imageObj, self.ownInstance)
 
-        if overlayUtils.isMounted(instanceMountDir):
-            raise error.StacksException("Cannot delete an image that is being edited. Use 'close-image' before deleting")
+        if self.mountBackend.isMounted(instanceMountDir):
+            raise error.InUseException("Cannot delete an image that is being edited. Use 'close-image' before deleting")
 
-        # remove the image directory
-        shutil.rmtree(self.getImageDir(name))
-        del self.db[name]
+        # move the image directory out of the way, gc removes it
+        with self.intents.intent('deleteImage') as intent:
+            imageDir = self.getImageDir(name)
+            entry = self.trash.entryFor(imageDir)
+            intent.expect('image', [name], present=False, record=dict(imageObj.__dict__))
+            intent.move(imageDir, entry)
+            self.trash.moveIn(imageDir, entry)
+            del self.db[name]
+        self.invalidateLayerChains()
 
+    @tracing.traced('image.exportImage')
+    def exportImage(self, name, fileobj, codec='none'):
+        # validate input against the manifest
+        if name not in self.db:
+            raise error.NotFoundException("Image does not exist: {0!s}".format(str(name)))
+
+        # the content must not change while it is being streamed out
+        if self.isBeingEdited(name):
+            raise error.InUseException("Cannot export an image that is being edited. Use 'close-image' before exporting")
+
+        import archive
+        archive.exportTree(self.getContentDir(name), fileobj, codec)
+
+    @tracing.traced('image.importImage')
+    def importImage(self, name, parent, fileobj, codec='auto'):
+        # tarfile and the codecs are only imported by the commands using them
+        import archive
+        self.newImage(name, parent)
+        try:
+            archive.importTree(self.getContentDir(name), fileobj, codec)
+        except:
+            # do not leave a half populated image behind
+            self.deleteImage(name)
+            raise
+
+    @tracing.traced('image.squashImage')
+    def squashImage(self, name, newName):
+        """ Create the root image newName holding the merged content of name
+            and all of its ancestors, so stacks built on it need a single
+            lowerdir.
+        """
+        # validate input against the manifest
+        if name not in self.db:
+            raise error.NotFoundException("Image does not exist: {0!s}".format(str(name)))
+
+        chain = self.getLayerChain(name)
+        editing = [layer for layer in chain if self.isBeingEdited(layer)]
+        if len(editing) > 0:
+            raise error.InUseException("Cannot squash images that are being edited: {0!s}".format(", ".join(editing)))
+
+        self.newImage(newName, None)
+        try:
+            contentDir = self.getContentDir(newName)
+            for layer in chain:
+                layerUtils.applyLayer(self.getContentDir(layer), contentDir)
+        except:
+            self.deleteImage(newName)
+            raise
+
+        if self.blobStore.isEnabled():
+            self.blobStore.dedupTree(self.getContentDir(newName))
+
+    def isBeingEdited(self, name):
+        mountEntry = self.mountBackend.get(self.getInstanceMountDir(name, self.ownInstance))
+        return mountEntry is not None and 'rw' in mountEntry.options.split(',')
+
+    @tracing.traced('image.mountImage')
     def mountImage(self, name, writable=False, verbose=False):
+        # deduplicated files are shared with other images and must not be
+        # edited in place, give them back a private copy first
+        if writable and name in self.db and self.blobStore.isEnabled():
+            if not self.mountBackend.isMounted(self.getInstanceMountDir(name, self.ownInstance)):
+                self.blobStore.unshareTree(self.getContentDir(name))
         return self.mountInstance(name, self.ownInstance, writable, verbose)
 
+    @tracing.traced('image.umountImage')
     def umountImage(self, name):
+        # see dedupImage(), which needs the exclusive manifest lock
         return self.umountInstance(name, self.ownInstance)
 
+    @tracing.traced('image.dedupImage')
+    def dedupImage(self, name):
+        """ Deduplicate an image that was closed, if the blob store is
+            enabled. This replaces its files, which the mounts of other
+            commands may be using: the caller holds the exclusive manifest
+            lock. Returns DedupStats, None if nothing was done.
+        """
+        if name not in self.db:
+            raise error.NotFoundException("Image does not exist: {0!s}".format(str(name)))
+        if not self.blobStore.isEnabled() or self.isBeingEdited(name):
+            return None
+        return self.blobStore.dedupTree(self.getContentDir(name))
+
+    @tracing.traced('image.dedupImages')
+    def dedupImages(self):
+        """ Enable the blob store and deduplicate every image that is not
+            being edited. Returns the combined DedupStats.
+        """
+        self.blobStore.enable()
+        total = blobStore.DedupStats()
+        for name in sorted(self.db.keys()):
+            if self.isBeingEdited(name):
+                continue
+            result = self.blobStore.dedupTree(self.getContentDir(name))
+            total.files += result.files
+            total.linked += result.linked
+            total.bytesSaved += result.bytesSaved
+        return total
+
+    @tracing.traced('image.newImageInstance')
     def newImageInstance(self, name, instanceName, force=False):
         # validate input against the manifest
         if name not in self.db:
-            raise error.StacksException("Image name does not exist: {0!s}".format(str(name)))
+            raise error.NotFoundException("Image name does not exist: {0!s}".format(str(name)))
 
         imageObj = self.db[name]
 
         # ensure the manifest does not already have that instance instantiated
         if instanceName in imageObj.instances:
-            raise error.StacksException("Image instance already exists: {0!s}".format(str(instanceName)))
+            raise error.ExistsException("Image instance already exists: {0!s}".format(str(instanceName)))
 
         # special case, don't allow creating a new "own" instance
         if force == False and instanceName == self.ownInstance:
@@ -151,28 +306,59 @@ class ImageManager(classDb.ClassDb):
         # ensure the node path does not exist already (for some reason)
         instanceDir = self.getInstancesDir(imageObj, instanceName)
         if os.path.exists(instanceDir):
-            raise error.StacksException("Manifest mismatch. Image instance directory already exists: {0!s}".format(str(instanceDir)))
+            raise error.ManifestMismatchException("Manifest mismatch. Image instance directory already exists: {0!s}".format(str(instanceDir)))
 
         # create a new instance directories and update the manifest
-        os.mkdir(instanceDir)
-        os.mkdir(os.path.join(instanceDir,"content"))
-        os.mkdir(os.path.join(instanceDir,"mount"))
-        os.mkdir(os.path.join(instanceDir,"working"))
-
-        # we don't care about the .self instance in the manifest
-        if instanceName != self.ownInstance:
-            imageObj.instances.append(instanceName)
+        with self.intents.intent('newImageInstance') as intent:
+            # we don't care about the .self instance in the manifest
+            if instanceName != self.ownInstance:
+                intent.expect('instance', [name, instanceName])
+            intent.create(instanceDir)
+            os.mkdir(instanceDir)
+            os.mkdir(os.path.join(instanceDir,"content"))
+            os.mkdir(os.path.join(instanceDir,"mount"))
+            os.mkdir(os.path.join(instanceDir,"working"))
+
+            if instanceName != self.ownInstance:
+                imageObj.instances.append(instanceName)
+                self.markDirty(name)
+
+    @tracing.traced('image.cloneInstance')
+    def cloneInstance(self, name, sourceInstance, instanceName, workers=layerUtils.defaultWorkers):
+        """ New instance starting with a copy of another instance's upper
+            layer (reflinked where the filesystem allows). The source may be
+            mounted, the copy then reflects its state at some point during
+            the clone. Returns layerUtils.CloneStats.
+        """
+        if name not in self.db:
+            raise error.NotFoundException("Image does not exist: {0!s}".format(str(name)))
 
+        imageObj = self.db[name]
+        if sourceInstance not in imageObj.instances:
+            raise error.NotFoundException("Image instance does not exist: image={0!s} instance={1!s}".format(repr(name), repr(sourceInstance)))
+
+        self.newImageInstance(name, instanceName)
+        try:
+            # the source cannot be mounted or umounted halfway through the copy
+            with self.locks.instance(name, sourceInstance):
+                return layerUtils.cloneTree(self.getContentDir(imageObj, sourceInstance),
+                                            self.getContentDir(imageObj, instanceName),
+                                            workers)
+        except:
+            self.deleteImageInstance(name, instanceName)
+            raise
+
+    @tracing.traced('image.deleteImageInstance')
     def deleteImageInstance(self, name, instanceName, force=False):
         # validate input against the manifest
         if name not in self.db:
-            raise error.StacksException("Image does not exist: {0!s}".format(str(name)))
+            raise error.NotFoundException("Image does not exist: {0!s}".format(str(name)))
 
         imageObj = self.db[name]
 
         # validate input against the manifest
         if instanceName not in imageObj.instances:
-            raise error.StacksException("Image instance does not exist: {0!s}".format(str(instanceName)))
+            raise error.NotFoundException("Image instance does not exist: {0!s}".format(str(instanceName)))
 
         # special case, don't allow deletion a new "own" instance
         if force == False and instanceName == self.ownInstance:
@@ -182,51 +368,66 @@ class ImageManager(classDb.ClassDb):
 
         # Ensure there are no active mounts for this instance
         instanceMountDir = os.path.join( instanceDir, "mount")
-        if overlayUtils.isMounted(instanceMountDir):
-            raise error.StacksException("Cannot delete a mounted instances: {0!s}".format(instanceName))
-
-        # remove the image directory
-        shutil.rmtree(instanceDir)
-        imageObj.instances.remove(instanceName)
-
+        if self.mountBackend.isMounted(instanceMountDir):
+            raise error.InUseException("Cannot delete a mounted instances: {0!s}".format(instanceName))
+
+        # move the instance directory out of the way, gc removes it
+        with self.intents.intent('deleteImageInstance') as intent:
+            entry = self.trash.entryFor(instanceDir)
+            intent.expect('instance', [name, instanceName], present=False)
+            intent.move(instanceDir, entry)
+            self.trash.moveIn(instanceDir, entry)
+            imageObj.instances.remove(instanceName)
+            limit = imageObj.limits.pop(instanceName, None)
+            self.markDirty(name)
+
+        # the project id stays on the trashed files, only the limit goes. Not
+        # before the move: a failed move leaves the instance as it was
+        if limit is not None and limit['enforcedBy'] == 'kernel':
+            self.quotas.clear(entry, limit['projectId'])
+
+    @tracing.traced('image.mountInstance')
     def mountInstance(self, name, instanceName, writable=False, verbose=False):
 
         # validate input against the manifest
         if name not in self.db:
-            raise error.StacksException("Image does not exist: {0!s}".format(str(name)))
+            raise error.NotFoundException("Image does not exist: {0!s}".format(str(name)))
 
         imageObj = self.db[name]
 
         if instanceName not in imageObj.instances and instanceName != self.ownInstance:
-            raise error.StacksException("Image instance does not exist: image={0!s} instance={1!s}".format(repr(name), repr(instanceName)))
+            raise error.NotFoundException("Image instance does not exist: image={0!s} instance={1!s}".format(repr(name), repr(instanceName)))
+
+        if writable and instanceName in imageObj.limits and not self.mountBackend.isMounted(self.getInstanceMountDir(imageObj, instanceName)):
+            self.checkLimit(name, instanceName)
 
         # two different strategies can be used based on the kernel version
         if self.legacy:
-            depth = 0
-            parent = imageObj.parent
-            while parent is not None:
-                depth += 1
-                parent = self.db[name].parent
+            depth = len(self.getLayerChain(name)) - 1
 
             # This number should include the instance to be mounted
             if depth > 2:
                 raise error.StacksException("Image depth exceeds kernel maximum FS stacking depth (2).")
 
-            return self._mountInstance_legacy(name, instanceName, writable, verbose)
+            with self.locks.instance(name, instanceName):
+                return self._mountInstance_legacy(name, instanceName, writable, verbose)
         else:
-            return self._mountInstance_standard(name, instanceName, writable, verbose)
+            with self.locks.instance(name, instanceName):
+                return self._mountInstance_standard(name, instanceName, writable, verbose)
 
-    def umountInstance(self, name, instanceName):
+    @tracing.traced('image.umountInstance')
+    def umountInstance(self, name, instanceName, lazy=False):
 
         # validate input against the manifest
         if name not in self.db:
-            raise error.StacksException("Image does not exist: {0!s}".format(str(name)))
+            raise error.NotFoundException("Image does not exist: {0!s}".format(str(name)))
 
         # two different strategies can be used based on the kernel version
-        if self.legacy:
-            return self._umountInstance_legacy(name, instanceName)
-        else:
-            return self._umountInstance_standard(name, instanceName)
+        with self.locks.instance(name, instanceName):
+            if self.legacy:
+                return self._umountInstance_legacy(name, instanceName, lazy)
+            else:
+                return self._umountInstance_standard(name, instanceName, lazy)
 
     def _mountInstance_standard(self, name, instanceName, writable=False, verbose=False):
         """ [Image3]
@@ -253,50 +454,36 @@ class ImageManager(classDb.ClassDb):
         # anyway if they are not already mounted)
         instanceDir = self.getInstancesDir(imageObj, instanceName)
         mountDir = os.path.join( instanceDir, "mount")
-        if overlayUtils.isMounted(mountDir):
+        if self.mountBackend.isMounted(mountDir):
             return
 
         upperDir = os.path.join( instanceDir, "content")
         workingDir = os.path.join( instanceDir, "working")
 
-        ownInstanceDir = self.getInstancesDir(imageObj, self.ownInstance)
-        currentImageContent = os.path.join(ownInstanceDir, "content")
-        lowerDir = [currentImageContent]
-
-        parentName = imageObj.parent
-        while parentName is not None:
-
-            parentObj = self.db[parentName]
-            parentInstanceDir = self.getInstancesDir(parentObj, self.ownInstance)
-            lowerContentDir = os.path.join(parentInstanceDir, "content")
-            lowerContentDir = os.path.abspath(lowerContentDir)
-            lowerDir.append(lowerContentDir)
-
-            # get the next parent to check
-            parentName = parentObj.parent
+        lowerDir = self.getLowerDirs(name)
 
         if verbose:
             print("Mounting:\n\tmount: {0!s}\n\tupper: {1!s}\n\tlower: {2!s}\n".format(os.path.abspath(mountDir),
                     os.path.abspath(upperDir),
                     repr(lowerDir)))
 
-        overlayUtils.mount(directory=os.path.abspath(mountDir),
-                           lower_dir=lowerDir,
-                           upper_dir=os.path.abspath(upperDir),
-                           working_dir=os.path.abspath(workingDir),
-                           readonly=not writable)
+        self.mountBackend.mountOverlay(directory=os.path.abspath(mountDir),
+                                       lowerDirs=lowerDir,
+                                       upperDir=os.path.abspath(upperDir),
+                                       workingDir=os.path.abspath(workingDir),
+                                       readonly=not writable)
 
         return mountDir
 
 
-    def _umountInstance_standard(self, name, instanceName):
+    def _umountInstance_standard(self, name, instanceName, lazy=False):
 
         imageObj = self.db[name]
 
         mountDir = os.path.join( self.getInstancesDir(imageObj, instanceName),
                                  "mount")
-        if overlayUtils.isMounted(mountDir):
-            overlayUtils.umount(mountDir)
+        if self.mountBackend.isMounted(mountDir):
+            self.mountBackend.umount(mountDir, lazy=lazy)
 
 
     def _mountInstance_legacy(self, name, instanceName, writable=False, verbose=False):
@@ -320,9 +507,26 @@ class ImageManager(classDb.ClassDb):
         # anyway if they are not already mounted)
         instanceDir = self.getInstancesDir(imageObj, instanceName)
         mountDir = os.path.join( instanceDir, "mount")
-        if overlayUtils.isMounted(mountDir):
+        if self.mountBackend.isMounted(mountDir):
             return
 
+        # Hold the lock of the .self instance this mount stacks on until the
+        # mount is done, otherwise a concurrent close-image could unmount the
+        # lower layer between the two steps
+        if instanceName != self.ownInstance:
+            lowerLock = self.locks.instance(imageObj.name, self.ownInstance)
+        elif imageObj.parent is not None:
+            lowerLock = self.locks.instance(imageObj.parent, self.ownInstance)
+        else:
+            lowerLock = self.locks.instance(imageObj.name, self.ownInstance)
+
+        with lowerLock:
+            return self._mountInstance_legacyLocked(imageObj, instanceName, writable, verbose)
+
+    def _mountInstance_legacyLocked(self, imageObj, instanceName, writable=False, verbose=False):
+        instanceDir = self.getInstancesDir(imageObj, instanceName)
+        mountDir = os.path.join( instanceDir, "mount")
+
         # Before mounting this instance, ensure the image is mounted as read-only.
         # This is done by mounting the ".self" instance of the current image.
         # After that, you can mount this [writable] instance
@@ -351,71 +555,81 @@ class ImageManager(classDb.ClassDb):
                         os.path.abspath(upperDir),
                         os.path.abspath(lowerDir)))
 
-            overlayUtils.mount(directory=os.path.abspath(mountDir),
-                               lower_dir=os.path.abspath(lowerDir),
-                               upper_dir=os.path.abspath(upperDir),
-                               working_dir=os.path.abspath(workingDir),
-                               readonly=not writable)
+            self.mountBackend.mountOverlay(directory=os.path.abspath(mountDir),
+                                           lowerDirs=[os.path.abspath(lowerDir)],
+                                           upperDir=os.path.abspath(upperDir),
+                                           workingDir=os.path.abspath(workingDir),
+                                           readonly=not writable)
 
         # ... or this is the root, no need to mount parents
         else:
-            import subwrap
-            if writable:
-                options="rw"
-            else:
-                options="ro"
-
             # This could be in use by other layers
-            #subwrap.run(['umount', mountDir ])
+            #self.mountBackend.umount(mountDir)
 
             if verbose:
                 print("Binding:\n\tmount: {0!s}\n\source: {1!s}\n".format(os.path.abspath(mountDir),
                         os.path.abspath(upperDir)))
 
             # perform a bind mount to the contents dir
-            subwrap.run(['mount', '--bind','-o',options, upperDir, mountDir ])
-
+            self.mountBackend.bind(os.path.abspath(upperDir), os.path.abspath(mountDir), readonly=not writable)
+
+        # count what now stacks on which shared .self mount, see reapIdleMounts()
+        def count(refs):
+            if instanceName != self.ownInstance:
+                refs.acquire(imageObj.name, "instance:" + instanceName)
+                return
+            if not writable:
+                refs.track(imageObj.name)
+            if imageObj.parent is not None:
+                refs.acquire(imageObj.parent, "image:" + imageObj.name)
+        self._updateMountRefs(count)
 
         return mountDir
 
-    def _umountInstance_legacy(self, name, instanceName):
+    def _umountInstance_legacy(self, name, instanceName, lazy=False):
 
         imageObj = self.db[name]
-
-        if instanceName == self.ownInstance:
-
-            # ensure there are no child images that are mounted
-            children = self.getChildImages(name)
-            childrenInUse = []
-            for childObj in children:
-                childMountDir = os.path.join( self.getInstancesDir(childObj, self.ownInstance),
-                                              "mount")
-                if overlayUtils.isMounted(childMountDir):
-                    childrenInUse.append(childObj)
-
-            if len(childrenInUse) > 0:
-                childrenStr = ", ".join([ obj.name for obj in childrenInUse ])
-                raise error.StacksException("Cannot unmount an image that supports other mounted images: {0!s}".format(childrenStr))
-
-            # ensure there are no instances being supported by this image currently mounted
-            instancesInUse = []
-            for instance in imageObj.instances:
-                instanceMountDir = os.path.join( self.getInstancesDir(imageObj, instance),
-                                                 "mount")
-                if overlayUtils.isMounted(instanceMountDir):
-                    instancesInUse.append(instance)
-
-            if len(instancesInUse) > 0:
-                instanceStr = ", ".join(instancesInUse)
-                raise error.StacksException("Cannot unmount an image that supports other mounted instances: {0!s}".format(instanceStr))
-
-        # ensure the image is not already mounted, if so, assume the remaining
-        # parents are already mounted (as we will be unable to mount them
-        # anyway if they are not already mounted)
         mountDir = os.path.join( self.getInstancesDir(imageObj, instanceName),
                                  "mount")
-        if overlayUtils.isMounted(mountDir):
-            overlayUtils.umount(mountDir)
+
+        if instanceName == self.ownInstance and self.mountBackend.isMounted(mountDir):
+            self._checkUnused(imageObj)
+            self.mountBackend.umount(mountDir, lazy=lazy)
+
+            self._updateMountRefs(lambda refs: self._forgetMountRef(refs, name))
+
+        elif instanceName != self.ownInstance:
+            if self.mountBackend.isMounted(mountDir):
+                self.mountBackend.umount(mountDir, lazy=lazy)
+            self._updateMountRefs(lambda refs: refs.release(name, "instance:" + instanceName))
+
+    def _checkUnused(self, imageObj):
+        """ Raise InUseException if a child's .self mount or an instance is
+            stacked on the image's .self mount. The mount table decides, the
+            counts are brought in line with it.
+        """
+        name = imageObj.name
+        holderDirs = dict(("image:" + childObj.name, self.getInstanceMountDir(childObj, self.ownInstance))
+                          for childObj in self.getChildImages(name))
+        holderDirs.update(("instance:" + instanceName, self.getInstanceMountDir(imageObj, instanceName))
+                          for instanceName in imageObj.instances if instanceName != self.ownInstance)
+        mounted = self.mountBackend.mounted(list(holderDirs.values()))
+        inUse = sorted(holder for holder, path in holderDirs.items() if path in mounted)
+
+        def sync(refs):
+            recorded = refs.holders(name)
+            if recorded is None:
+                return
+            for holder in recorded:
+                if holder not in inUse:
+                    refs.release(name, holder)
+            for holder in inUse:
+                refs.acquire(name, holder)
+        self._updateMountRefs(sync)
+
+        if inUse:
+            raise error.InUseException("Cannot unmount an image that supports other mounted images or instances: {0!s}".format(
+                ", ".join(inUse)))
 
     def getImageDir(self, obj):
         if isinstance(obj, str):
@@ -444,17 +658,266 @@ class ImageManager(classDb.ClassDb):
 
         return path
 
+    def getInstanceMountDir(self, obj, instanceName):
+        return os.path.join(self.getInstancesDir(obj, instanceName), "mount")
+
+    def getMountedInstances(self, imageObj):
+        # one mount table lookup for every instance of the image
+        mountDirs = dict((instance, self.getInstanceMountDir(imageObj, instance))
+                         for instance in imageObj.instances)
+        mounted = self.mountBackend.mounted(list(mountDirs.values()))
+        return [instance for instance in imageObj.instances if mountDirs[instance] in mounted]
+
+    @tracing.traced('image.getLayerChain')
+    def getLayerChain(self, name):
+        """ Names of the image and all of its ancestors, ordered from the root
+            image down to the given image. Memoized until an image is added or
+            deleted.
+        """
+        if name not in self.layerChains:
+            imageObj = self.db[name]
+            if imageObj.parent is None:
+                chain = (name,)
+            else:
+                chain = self.getLayerChain(imageObj.parent) + (name,)
+            self.layerChains[name] = chain
+        return self.layerChains[name]
+
+    def getLowerDirs(self, name):
+        # absolute .self content dirs of the chain, topmost first as overlayfs
+        # expects them in lowerdir
+        if name not in self.lowerDirs:
+            lowerDirs = [os.path.abspath(self.getContentDir(layer))
+                         for layer in reversed(self.getLayerChain(name))]
+            self.lowerDirs[name] = lowerDirs
+        return list(self.lowerDirs[name])
+
+    def invalidateLayerChains(self):
+        self.layerChains = {}
+        self.lowerDirs = {}
+
+    def restore(self, state):
+        super(ImageManager, self).restore(state)
+        # the memoized chains hold objects from before the restore
+        self.invalidateLayerChains()
+
     def getChildImages(self, obj):
         if isinstance(obj, str):
-            return [item for node, item in list(self.db.items()) if item.parent == obj]
+            return self.lookup('parent', obj)
         elif isinstance(obj, Image):
-            return [item for node, item in list(self.db.items()) if item.parent == obj.name]
+            return self.lookup('parent', obj.name)
         raise RuntimeError("Invalid input given: {0!s}".format(repr(obj)))
 
     def getImagesWithInstanceName(self, instanceName):
-        return [item for node, item in list(self.db.items()) if instanceName in item.instances]
+        return self.lookup('instance', instanceName)
+
+    def _layerName(self, name, instanceName):
+        return os.path.relpath(self.getContentDir(name, instanceName), self.imagesDir)
+
+    def _updateMountRefs(self, func):
+        with self.locks.mountRefs():
+            if self.mountRefs is None or self.mountRefs.isStale():
+                self.mountRefs = mountRefs.MountRefManager.from_db(metadataDir=self.metadataDir,
+                                                                   itemCls=mountRefs.MountRef)
+            result = func(self.mountRefs)
+            self.mountRefs.to_db()
+        return result
+
+    @tracing.traced('image.reapIdleMounts')
+    def reapIdleMounts(self, grace=mountRefs.defaultGrace):
+        """ Umount the shared read-only .self mounts (legacy mode) that nothing
+            has stacked on for grace seconds, which may leave their parents
+            idle in turn. Returns the names of the images umounted.
+        """
+        reaped = []
+        skipped = set()
+        while True:
+            names = [name for name in self._updateMountRefs(lambda refs: refs.idle(grace))
+                     if name not in skipped]
+            if not names:
+                return reaped
+            for name in names:
+                skipped.add(name)
+                if name not in self.db:
+                    self._updateMountRefs(lambda refs: refs.forget(name))
+                    continue
+                with self.locks.instance(name, self.ownInstance):
+                    mountEntry = self.mountBackend.get(self.getInstanceMountDir(name, self.ownInstance))
+                    # being edited, close-image takes it down
+                    if mountEntry is not None and 'rw' in mountEntry.options.split(','):
+                        continue
+                    if mountEntry is None:
+                        # gone already, only the count was left
+                        self._updateMountRefs(lambda refs: self._forgetMountRef(refs, name))
+                        continue
+                    try:
+                        self._umountInstance_legacy(name, self.ownInstance)
+                    except error.InUseException:
+                        continue
+                    reaped.append(name)
+
+    def _forgetMountRef(self, refs, name):
+        refs.forget(name)
+        parent = self.db[name].parent if name in self.db else None
+        if parent is not None:
+            refs.release(parent, "image:" + name)
+
+    def _usageCache(self):
+        # the caller holds self.locks.usage()
+        if self.usageCache is None or self.usageCache.isStale():
+            self.usageCache = usage.UsageManager.from_db(metadataDir=self.metadataDir,
+                                                         itemCls=usage.Usage,
+                                                         imagesDir=self.imagesDir)
+        return self.usageCache
+
+    @tracing.traced('image.diskUsage')
+    def diskUsage(self, names=None, full=False):
+        """ {imageName: {'image': Usage, 'instances': {instanceName: Usage}}}
+            for the given images (all by default), rescanning only what
+            changed since the last call unless full is set.
+        """
+        allNames = names is None
+        if allNames:
+            names = sorted(self.db.keys())
+        for name in names:
+            if name not in self.db:
+                raise error.NotFoundException("Image does not exist: {0!s}".format(str(name)))
+
+        with self.locks.usage():
+            cache = self._usageCache()
+            result = {}
+            layerNames = set()
+            for name in names:
+                imageLayer = self._layerName(name, self.ownInstance)
+                instanceLayers = dict((instanceName, self._layerName(name, instanceName))
+                                      for instanceName in self.db[name].instances)
+                result[name] = {
+                    'image': cache.scan(imageLayer, full),
+                    'instances': dict((instanceName, cache.scan(layer, full))
+                                      for instanceName, layer in instanceLayers.items()),
+                }
+                layerNames.add(imageLayer)
+                layerNames.update(instanceLayers.values())
+            if allNames:
+                cache.prune(layerNames)
+            cache.to_db()
+        return result
+
+    def instanceUsage(self, name, instanceName, full=False):
+        with self.locks.usage():
+            cache = self._usageCache()
+            result = cache.scan(self._layerName(name, instanceName), full)
+            cache.to_db()
+        return result
+
+    @tracing.traced('image.setInstanceLimit')
+    def setInstanceLimit(self, name, instanceName, limitBytes=None, limitInodes=None):
+        """ Limit the CoW layer of an instance, both limits None removes the
+            limit. Project quotas enforce it where the filesystem supports
+            them, otherwise mountInstance() refuses to mount an instance that
+            is over its limit. Returns how it is enforced ('kernel', 'mount').
+        """
+        if name not in self.db:
+            raise error.NotFoundException("Image does not exist: {0!s}".format(str(name)))
+
+        imageObj = self.db[name]
+        if instanceName not in imageObj.instances:
+            raise error.NotFoundException("Image instance does not exist: image={0!s} instance={1!s}".format(repr(name), repr(instanceName)))
+
+        contentDir = self.getContentDir(imageObj, instanceName)
+        current = imageObj.limits.get(instanceName)
+
+        if limitBytes is None and limitInodes is None:
+            if current is not None:
+                if current['enforcedBy'] == 'kernel':
+                    self.quotas.clear(contentDir, current['projectId'])
+                del imageObj.limits[instanceName]
+                self.markDirty(name)
+            return None
+
+        if current is not None:
+            projectId = current['projectId']
+        else:
+            usedIds = [limit['projectId'] for obj in list(self.db.values()) for limit in obj.limits.values()]
+            projectId = max(usedIds + [quota.projectIdBase - 1]) + 1
+
+        enforcedBy = 'mount'
+        if self.quotas.isSupported(contentDir):
+            self.quotas.apply(contentDir, projectId, limitBytes, limitInodes)
+            enforcedBy = 'kernel'
+
+        imageObj.limits[instanceName] = {'bytes': limitBytes, 'inodes': limitInodes,
+                                         'projectId': projectId, 'enforcedBy': enforcedBy}
+        self.markDirty(name)
+        return enforcedBy
+
+    def checkLimit(self, name, instanceName):
+        # limits the kernel does not enforce are checked before every mount
+        limit = self.db[name].limits.get(instanceName)
+        if limit is None or limit['enforcedBy'] == 'kernel':
+            return
+        # a full scan, files growing in place leave the directory mtimes the
+        # incremental scan goes by alone
+        used = self.instanceUsage(name, instanceName, full=True)
+        if limit['bytes'] is not None and used.bytes + used.sharedBytes > limit['bytes']:
+            raise error.QuotaExceededException("Instance exceeds its size limit: image={0!s} instance={1!s} used={2!s} limit={3!s}".format(
+                name, instanceName, usage.formatSize(used.bytes + used.sharedBytes), usage.formatSize(limit['bytes'])))
+        if limit['inodes'] is not None and used.inodes() > limit['inodes']:
+            raise error.QuotaExceededException("Instance exceeds its inode limit: image={0!s} instance={1!s} used={2!s} limit={3!s}".format(
+                name, instanceName, used.inodes(), limit['inodes']))
+
+    @tracing.traced('image.diffLayer')
+    def diffLayer(self, name, instanceName=None, hashes=False, useIndex=False):
+        """ What the image (against its parents) or one of its instances
+            (against the image) changed, see layerDiff.LayerDiff. With useIndex
+            the file index of the layer is read for cached hashes and to list
+            the files changed since the last indexed diff, then updated.
+        """
+        if name not in self.db:
+            raise error.NotFoundException("Image does not exist: {0!s}".format(str(name)))
+        imageObj = self.db[name]
+
+        if instanceName is None:
+            upperDir = self.getContentDir(imageObj)
+            lowerDirs = self.getLowerDirs(imageObj.parent) if imageObj.parent is not None else []
+            layer = self._layerName(name, self.ownInstance)
+        else:
+            if instanceName not in imageObj.instances:
+                raise error.NotFoundException("Image instance does not exist: image={0!s} instance={1!s}".format(repr(name), repr(instanceName)))
+            upperDir = self.getContentDir(imageObj, instanceName)
+            lowerDirs = self.getLowerDirs(name)
+            layer = self._layerName(name, instanceName)
+
+        if not useIndex:
+            return layerDiff.diffLayer(upperDir, lowerDirs, hashes)[0]
+
+        with self.locks.layerIndex():
+            if self.layerIndexes is None or self.layerIndexes.isStale():
+                self.layerIndexes = layerDiff.LayerIndexManager.from_db(metadataDir=self.metadataDir,
+                                                                        itemCls=layerDiff.LayerIndex)
+            index = self.layerIndexes.db[layer] if layer in self.layerIndexes.db else layerDiff.LayerIndex(layer)
+            result, files = layerDiff.diffLayer(upperDir, lowerDirs, hashes, index)
+            self.layerIndexes.update(layer, files)
+            self.layerIndexes.to_db()
+        return result
+
+    def formatLimit(self, name, instanceName):
+        limit = self.db[name].limits.get(instanceName)
+        if limit is None:
+            return ""
+        parts = []
+        if limit['bytes'] is not None:
+            parts.append(usage.formatSize(limit['bytes']))
+        if limit['inodes'] is not None:
+            parts.append("{0!s} inodes".format(limit['inodes']))
+        return " [limit {0!s}]".format(", ".join(parts))
+
+    def listImages(self, tree=False, showUsage=False, full=False):
+        sizes = {}
+        if showUsage:
+            sizes = dict((name, " ({0!s})".format(usage.formatSize(entry['image'].bytes)))
+                         for name, entry in self.diskUsage(full=full).items())
 
-    def listImages(self, tree=False):
         if tree:
             roots = [name for name, obj in list(self.db.items()) if obj.parent is None]
             parentNodes = set([obj.parent for name, obj in list(self.db.items()) if obj.parent is not None])
@@ -462,9 +925,9 @@ class ImageManager(classDb.ClassDb):
             def printTree(node, padding, isLast=False):
 
                 if isLast:
-                    print(padding + '└── ' + node)
+                    print(padding + '└── ' + node + sizes.get(node, ""))
                 else:
-                    print(padding + '├── ' + node)
+                    print(padding + '├── ' + node + sizes.get(node, ""))
 
                 children = self.getChildImages(node)
 
@@ -479,7 +942,7 @@ class ImageManager(classDb.ClassDb):
                     printTree(child.name, padding, isLast)
 
             for root in sorted(roots):
-                print(root)
+                print(root + sizes.get(root, ""))
                 children = self.getChildImages(root)
                 for idx, child in enumerate(sorted(children)):
                     isLast = idx==len(children)-1
@@ -487,20 +950,26 @@ class ImageManager(classDb.ClassDb):
                 print()
         else:
             for imageName in sorted(self.db.keys()):
-                print(imageName)
+                print(imageName + sizes.get(imageName, ""))
 
 
-    def listInstances(self, imageName=None):
+    def listInstances(self, imageName=None, showUsage=False, full=False):
+        sizes = {}
+        if showUsage:
+            for name, entry in self.diskUsage(None if imageName is None else [imageName], full).items():
+                for instance, instanceUsage in entry['instances'].items():
+                    sizes[(name, instance)] = " ({0!s})".format(usage.formatSize(instanceUsage.bytes))
 
         def showInstances(name):
             imageObj = self.db[name]
             print("{0!s}:".format(name))
             for idx, instance in enumerate(imageObj.instances):
                 isLast = idx == len(imageObj.instances) - 1
+                label = instance + sizes.get((name, instance), "") + self.formatLimit(name, instance)
                 if isLast:
-                    print(' └── ' + instance)
+                    print(' └── ' + label)
                 else:
-                    print(' ├── ' + instance)
+                    print(' ├── ' + label)
 
             if len(imageObj.instances) == 0:
                 print('    <no instances>')
@@ -515,7 +984,5 @@ class ImageManager(classDb.ClassDb):
 
 # mount image, name; (for editing)
 # umount image, name; (close edits, make ro)
-# import image, name, tarpath
-# export image, name, tarpath
 
 # rename image/instance? should this me allowed?
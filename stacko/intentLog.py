@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+import collections
+import contextlib
+import json
+import os
+import uuid
+
+import classDb
+import tracing
+
+intentsFilename = "intents.journal"
+
+class Intent(object):
+    """ Handed to a multi-step operation: expect() states what the manifest
+        holds once the operation is saved, create/move/removeDir record a
+        directory change and must be called before making it. Expectations
+        are written along with the next step.
+    """
+
+    def __init__(self, log, number, op):
+        self.log = log
+        self.number = number
+        self.op = op
+        self.checks = []
+
+    def expect(self, kind, key, present=True, record=None):
+        # kind is 'image', 'instance' (key [image, instance]) or 'point',
+        # record is what to restore when an absent one has to come back
+        self.checks.append({'kind': kind, 'key': list(key), 'present': present, 'record': record})
+
+    def create(self, path):
+        self._step(['create', os.path.abspath(path)])
+
+    def move(self, source, target):
+        self._step(['move', os.path.abspath(source), os.path.abspath(target)])
+
+    def removeDir(self, path):
+        self._step(['removeDir', os.path.abspath(path)])
+
+    def _step(self, step):
+        self.log._write({'intent': self.number, 'op': self.op, 'checks': self.checks, 'steps': [step]})
+        self.checks = []
+
+    def flush(self):
+        if self.checks:
+            self.log._write({'intent': self.number, 'op': self.op, 'checks': self.checks, 'steps': []})
+            self.checks = []
+
+class NullIntent(object):
+
+    def expect(self, kind, key, present=True, record=None):
+        pass
+
+    def create(self, path):
+        pass
+
+    def move(self, source, target):
+        pass
+
+    def removeDir(self, path):
+        pass
+
+class NullIntentLog(object):
+    """ For managers used without api.Stacko, whose saves the log would not
+        hear about.
+    """
+
+    @contextlib.contextmanager
+    def intent(self, op):
+        yield NullIntent()
+
+    def mark(self):
+        return 0
+
+    def rollbackSince(self, mark, imageManager):
+        pass
+
+    def pending(self):
+        return False
+
+class IntentLog(object):
+    """ Write-ahead log of the directory changes made by the operations of
+        one transaction, which the manifest only learns about when it is
+        saved at the end. api.Stacko writes a marker after saving each store
+        and removes the log once all are saved. A log found by the next
+        exclusive transaction belongs to a process that died in between:
+        when every store was saved the operations are complete and kept
+        (rolled forward), otherwise their directory changes are undone and
+        any store that was saved is put back to match (rolled back).
+    """
+
+    def __init__(self, metadataDir):
+        self.path = os.path.join(metadataDir, intentsFilename)
+        self.txn = None
+        self.count = 0
+        self.active = None
+
+    @contextlib.contextmanager
+    def intent(self, op):
+        if self.active is not None:
+            # nested operations are steps of the outer one
+            yield self.active
+            return
+        if self.txn is None:
+            self.txn = uuid.uuid4().hex
+        self.count += 1
+        self.active = Intent(self, self.count, op)
+        try:
+            yield self.active
+        finally:
+            self.active.flush()
+            self.active = None
+
+    def _write(self, record):
+        record['txn'] = self.txn
+        isNew = not os.path.exists(self.path)
+        with open(self.path, 'a') as theFile:
+            theFile.write(json.dumps(record, sort_keys=True) + "\n")
+            theFile.flush()
+            os.fsync(theFile.fileno())
+        if isNew:
+            classDb.syncDir(os.path.dirname(self.path))
+
+    def _read(self):
+        records = []
+        with open(self.path, 'r') as theFile:
+            for line in theFile:
+                # a torn last line was never followed by the step it announced
+                if not line.endswith("\n"):
+                    break
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    break
+        return records
+
+    def pending(self):
+        return os.path.exists(self.path)
+
+    def trashEntries(self):
+        """ Trash entries that logged operations moved directories to, those
+            are put back if the operation is rolled back.
+        """
+        try:
+            records = self._read()
+        except FileNotFoundError:
+            return set()
+        return set(step[2] for record in records for step in record.get('steps', [])
+                   if step[0] == 'move')
+
+    def saved(self, dbFilename):
+        if self.txn is not None:
+            self._write({'saved': dbFilename})
+
+    def commit(self):
+        if self.txn is not None:
+            self.clear()
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+            classDb.syncDir(os.path.dirname(self.path))
+        self.txn = None
+        self.count = 0
+
+    def mark(self):
+        return self.count
+
+    def rollbackSince(self, mark, imageManager):
+        """ Undo the directory changes of the intents started after mark(),
+            the caller puts the manifest back itself (see ClassDb.restore).
+        """
+        if self.txn is None or self.count <= mark:
+            return
+        intents = self._group(self._read()).get(self.txn, {'intents': {}})['intents']
+        for number in sorted(intents.keys(), reverse=True):
+            if number > mark:
+                self._undo(intents[number], imageManager.trash)
+
+    def _group(self, records):
+        txns = collections.OrderedDict()
+        for record in records:
+            txn = txns.setdefault(record['txn'], {'saved': set(), 'intents': collections.OrderedDict()})
+            if 'saved' in record:
+                txn['saved'].add(record['saved'])
+                continue
+            entry = txn['intents'].setdefault(record['intent'], {'op': record['op'], 'checks': [], 'steps': []})
+            entry['checks'].extend(record['checks'])
+            entry['steps'].extend(record['steps'])
+        return txns
+
+    @tracing.traced('intentLog.recover')
+    def recover(self, imageManager, pointManager):
+        """ Roll the logged transactions forward or back, see above. Changes
+            the managers, the caller saves them and then calls clear().
+            Returns [(op, 'forward'|'back', [errors])].
+        """
+        managers = {'image': imageManager, 'instance': imageManager, 'point': pointManager}
+        results = []
+        for txn in self._group(self._read()).values():
+            if set([imageManager.dbFilename, pointManager.dbFilename]) <= txn['saved']:
+                results.extend((intent['op'], 'forward', []) for intent in txn['intents'].values())
+                continue
+            for intent in reversed(list(txn['intents'].values())):
+                errors = self._undo(intent, imageManager.trash)
+                # a store saved before the crash holds the operation's result
+                for check in intent['checks']:
+                    if managers[check['kind']].dbFilename in txn['saved']:
+                        self._revert(managers[check['kind']], check)
+                results.append((intent['op'], 'back', errors))
+        return results
+
+    def _undo(self, intent, trash):
+        # every step may or may not have happened, undoing one is idempotent
+        errors = []
+        for step in reversed(intent['steps']):
+            try:
+                if step[0] == 'create' and os.path.lexists(step[1]):
+                    if os.path.isdir(step[1]) and not os.listdir(step[1]):
+                        os.rmdir(step[1])
+                    else:
+                        trash.moveIn(step[1])
+                elif step[0] == 'move' and os.path.lexists(step[2]) and not os.path.lexists(step[1]):
+                    os.rename(step[2], step[1])
+                elif step[0] == 'removeDir':
+                    os.makedirs(step[1], exist_ok=True)
+            except OSError as e:
+                # left for fsck, the other steps are still undone
+                errors.append("{0!s} {1!s}: {2!s}".format(step[0], step[1], str(e)))
+        return errors
+
+    def _revert(self, manager, check):
+        key = check['key']
+        if check['kind'] == 'instance':
+            if key[0] not in manager.db:
+                return
+            instances = manager.db[key[0]].instances
+            if check['present'] and key[1] in instances:
+                instances.remove(key[1])
+            elif not check['present'] and key[1] not in instances:
+                instances.append(key[1])
+            manager.markDirty(key[0])
+        elif check['present'] and key[0] in manager.db:
+            del manager.db[key[0]]
+        elif not check['present'] and key[0] not in manager.db and check['record'] is not None:
+            manager.db[key[0]] = manager.db.itemCls(**check['record'])
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+import os
+import stat
+import time
+
+import blobStore
+import classDb
+import layerUtils
+import tracing
+
+class LayerDiff(object):
+    """ Changes an upper layer makes to the layers below it, as paths relative
+        to the layer. opaque lists directories that hide everything below
+        them (their content is in added). changed lists the files that differ
+        from the last indexed run when an index was used.
+    """
+
+    def __init__(self):
+        self.added = []
+        self.modified = []
+        self.deleted = []
+        self.opaque = []
+        self.changed = []
+        self.hashes = {}
+
+    def summary(self):
+        return {'added': self.added, 'modified': self.modified, 'deleted': self.deleted,
+                'opaque': self.opaque, 'changed': self.changed, 'hashes': self.hashes}
+
+class LayerIndex(object):
+    """ Last indexed state of a layer dir (relative to imagesDir):
+        files maps a path in the layer to [size, mtime_ns, sha256 or None].
+    """
+
+    def __init__(self, name, files=None, indexed=None):
+        self.name = name
+        self.files = files or {}
+        self.indexed = indexed
+
+class LayerIndexManager(classDb.ClassDb):
+    """ Persisted LayerIndex records. Written by commands that share the
+        manifest lock, callers serialize on LockManager.layerIndex().
+    """
+
+    dbFilename = "layerIndex.json"
+
+    def update(self, name, files):
+        self.db[name] = LayerIndex(name, files, time.time())
+
+def lowerLookup(lowerDirs, relPath):
+    """ True if relPath exists in the merged view of lowerDirs (topmost first),
+        honouring whiteouts, opaque directories and files hiding directories.
+    """
+    parts = relPath.split(os.sep)
+    for layer in lowerDirs:
+        path = os.path.join(layer, relPath)
+        if os.path.lexists(path):
+            return not layerUtils.isWhiteout(os.lstat(path))
+        # a whiteout, file or opaque dir on the way hides the layers below
+        parent = layer
+        for part in parts[:-1]:
+            parent = os.path.join(parent, part)
+            if not os.path.lexists(parent):
+                break
+            st = os.lstat(parent)
+            if layerUtils.isWhiteout(st) or not stat.S_ISDIR(st.st_mode):
+                return False
+            if layerUtils.isOpaque(parent):
+                return False
+    return False
+
+@tracing.traced('layerDiff.diff')
+def diffLayer(upperDir, lowerDirs, hashes=False, index=None):
+    """ Walk only upperDir and classify its entries against lowerDirs. With
+        hashes every added or modified file is hashed, reusing the hash from
+        index (a LayerIndex) for files whose size and mtime did not change.
+        Returns (LayerDiff, updated files map for the index).
+    """
+    result = LayerDiff()
+    oldFiles = index.files if index is not None else {}
+    newFiles = {}
+
+    def visit(relDir, nothingBelow):
+        path = os.path.join(upperDir, relDir) if relDir else upperDir
+        for entry in sorted(os.scandir(path), key=lambda entry: entry.name):
+            relPath = os.path.join(relDir, entry.name) if relDir else entry.name
+            st = entry.stat(follow_symlinks=False)
+
+            if layerUtils.isWhiteout(st):
+                result.deleted.append(relPath)
+                continue
+
+            existsBelow = not nothingBelow and lowerLookup(lowerDirs, relPath)
+
+            if stat.S_ISDIR(st.st_mode):
+                opaque = layerUtils.isOpaque(entry.path)
+                if opaque and existsBelow:
+                    result.opaque.append(relPath)
+                elif not existsBelow:
+                    result.added.append(relPath + os.sep)
+                visit(relPath, nothingBelow or opaque or not existsBelow)
+                continue
+
+            if existsBelow:
+                result.modified.append(relPath)
+            else:
+                result.added.append(relPath)
+
+            old = oldFiles.get(relPath)
+            # a cached digest stays valid until the file changes, even
+            # through runs without hashes
+            unchanged = old is not None and old[0] == st.st_size and old[1] == st.st_mtime_ns
+            digest = old[2] if unchanged else None
+            if hashes and stat.S_ISREG(st.st_mode):
+                if digest is None:
+                    digest = blobStore.hashFile(entry.path)
+                result.hashes[relPath] = digest
+            if index is not None and (old is None or old[0] != st.st_size or old[1] != st.st_mtime_ns):
+                result.changed.append(relPath)
+            newFiles[relPath] = [st.st_size, st.st_mtime_ns, digest]
+
+    visit("", False)
+
+    if index is not None:
+        result.changed.extend(sorted(path for path in oldFiles if path not in newFiles))
+        result.changed.sort()
+    return result, newFiles
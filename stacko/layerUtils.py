@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+import errno
+import fcntl
+import os
+import shutil
+import stat
+import threading
+
+# overlayfs marks deleted entries in an upper layer with a 0/0 character
+# device, and directories that hide everything below them with this xattr
+opaqueXattr = 'trusted.overlay.opaque'
+
+# portable (OCI/aufs style) names used when a layer leaves the filesystem
+whiteoutPrefix = '.wh.'
+opaqueMarker = '.wh..wh..opq'
+
+# ioctl that makes dst share src's extents (btrfs, xfs with reflink, bcachefs)
+FICLONE = 0x40049409
+
+defaultWorkers = 8
+
+class CloneStats(object):
+
+    def __init__(self):
+        self.dirs = 0
+        self.files = 0
+        self.reflinked = 0
+        self.bytesCopied = 0
+
+def isWhiteout(st):
+    return stat.S_ISCHR(st.st_mode) and st.st_rdev == 0
+
+def isOpaque(path):
+    try:
+        return os.getxattr(path, opaqueXattr, follow_symlinks=False) == b'y'
+    except OSError:
+        return False
+
+def makeWhiteout(path):
+    os.mknod(path, stat.S_IFCHR | 0o000, os.makedev(0, 0))
+
+def setOpaque(path):
+    os.setxattr(path, opaqueXattr, b'y', follow_symlinks=False)
+
+def removePath(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+def copyXattrs(srcPath, dstPath):
+    # overlayfs keeps its own state (opaque, redirect, metacopy) in xattrs
+    for name in os.listxattr(srcPath, follow_symlinks=False):
+        os.setxattr(dstPath, name, os.getxattr(srcPath, name, follow_symlinks=False), follow_symlinks=False)
+
+def reflinkFile(srcPath, dstPath):
+    """ Copy a regular file, sharing its extents if the filesystem supports
+        it. Returns True if the file was reflinked.
+    """
+    with open(srcPath, 'rb') as src, open(dstPath, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return True
+        except OSError as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS):
+                raise
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+    return False
+
+def copyEntry(srcPath, dstPath, st, linkedInodes, copyFile=shutil.copyfile):
+    """ Copy a single non-directory entry, keeping ownership and times.
+        Files sharing an inode in the source share one in the destination,
+        linkedInodes maps (st_dev, st_ino) to the first copy and its inode.
+    """
+    inode = (st.st_dev, st.st_ino)
+    if stat.S_ISREG(st.st_mode) and st.st_nlink > 1 and inode in linkedInodes:
+        firstPath, firstIno = linkedInodes[inode]
+        try:
+            # the first copy may have been removed or replaced since
+            if os.lstat(firstPath).st_ino == firstIno:
+                os.link(firstPath, dstPath)
+                return
+        except FileNotFoundError:
+            pass
+        del linkedInodes[inode]
+
+    if stat.S_ISLNK(st.st_mode):
+        os.symlink(os.readlink(srcPath), dstPath)
+    elif stat.S_ISREG(st.st_mode):
+        copyFile(srcPath, dstPath)
+    else:
+        # devices, fifos and sockets
+        os.mknod(dstPath, st.st_mode, st.st_rdev)
+
+    os.lchown(dstPath, st.st_uid, st.st_gid)
+    if not stat.S_ISLNK(st.st_mode):
+        os.chmod(dstPath, stat.S_IMODE(st.st_mode))
+    os.utime(dstPath, ns=(st.st_atime_ns, st.st_mtime_ns), follow_symlinks=False)
+
+    if stat.S_ISREG(st.st_mode) and st.st_nlink > 1:
+        linkedInodes[inode] = (dstPath, os.lstat(dstPath).st_ino)
+
+def applyLayer(srcDir, dstDir, linkedInodes=None):
+    """ Merge an overlayfs upper layer onto a plain directory tree: whiteouts
+        delete, opaque directories replace, everything else is copied over.
+        The result contains no whiteouts or opaque markers.
+    """
+    if linkedInodes is None:
+        linkedInodes = {}
+
+    for entry in sorted(os.scandir(srcDir), key=lambda entry: entry.name):
+        dstPath = os.path.join(dstDir, entry.name)
+        st = entry.stat(follow_symlinks=False)
+
+        if isWhiteout(st):
+            removePath(dstPath)
+            continue
+
+        if stat.S_ISDIR(st.st_mode):
+            if os.path.lexists(dstPath) and (isOpaque(entry.path) or not os.path.isdir(dstPath) or os.path.islink(dstPath)):
+                removePath(dstPath)
+            if not os.path.lexists(dstPath):
+                os.mkdir(dstPath)
+            applyLayer(entry.path, dstPath, linkedInodes)
+            os.lchown(dstPath, st.st_uid, st.st_gid)
+            os.chmod(dstPath, stat.S_IMODE(st.st_mode))
+            os.utime(dstPath, ns=(st.st_atime_ns, st.st_mtime_ns))
+            continue
+
+        removePath(dstPath)
+        copyEntry(entry.path, dstPath, st, linkedInodes)
+
+def cloneTree(srcDir, dstDir, workers=defaultWorkers):
+    """ Copy srcDir into the existing empty dstDir as is, whiteouts, opaque
+        markers and other xattrs included, reflinking file data where
+        possible. Hardlinks within srcDir stay hardlinks. Directories are
+        walked in parallel. Returns CloneStats.
+    """
+    # not imported at the top, mountBackend needs this module on every command
+    from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+    stats = CloneStats()
+    guard = threading.Lock()
+    # (st_dev, st_ino) -> first copy, and the links to make once it exists
+    firstCopies = {}
+    deferredLinks = []
+    # directories get their metadata last, their mtime changes while filling
+    finishDirs = [(srcDir, dstDir, os.lstat(srcDir), 0)]
+
+    def copyFile(srcPath, dstPath):
+        reflinked = reflinkFile(srcPath, dstPath)
+        with guard:
+            if reflinked:
+                stats.reflinked += 1
+            else:
+                stats.bytesCopied += os.path.getsize(dstPath)
+
+    def cloneDir(src, dst, depth):
+        subDirs = []
+        for entry in os.scandir(src):
+            dstPath = os.path.join(dst, entry.name)
+            st = entry.stat(follow_symlinks=False)
+
+            if stat.S_ISDIR(st.st_mode):
+                os.mkdir(dstPath)
+                subDirs.append((entry.path, dstPath, depth + 1))
+                with guard:
+                    finishDirs.append((entry.path, dstPath, st, depth + 1))
+                    stats.dirs += 1
+                continue
+
+            if stat.S_ISREG(st.st_mode) and st.st_nlink > 1:
+                inode = (st.st_dev, st.st_ino)
+                with guard:
+                    if inode in firstCopies:
+                        deferredLinks.append((firstCopies[inode], dstPath))
+                        continue
+                    firstCopies[inode] = dstPath
+
+            copyEntry(entry.path, dstPath, st, {}, copyFile)
+            if not stat.S_ISLNK(st.st_mode):
+                copyXattrs(entry.path, dstPath)
+            with guard:
+                stats.files += 1
+        return subDirs
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        pending = set([executor.submit(cloneDir, srcDir, dstDir, 0)])
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                for subDir in future.result():
+                    pending.add(executor.submit(cloneDir, *subDir))
+
+    for firstCopy, dstPath in deferredLinks:
+        os.link(firstCopy, dstPath)
+        stats.files += 1
+
+    for src, dst, st, depth in sorted(finishDirs, key=lambda item: -item[3]):
+        copyXattrs(src, dst)
+        os.lchown(dst, st.st_uid, st.st_gid)
+        os.chmod(dst, stat.S_IMODE(st.st_mode))
+        os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns))
+    return stats
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+
+from urllib.parse import quote
+
+import fasteners
+
+import tracing
+
+# Guards the manifest: shared for commands that only read it, exclusive for
+# commands that change it
+dbLockPath = '/tmp/stacksDb.lock'
+
+# Per-point and per-instance locks live here, one file per object
+lockDir = '/tmp/stacko-locks'
+
+class NamedLock(object):
+    """ An interprocess lock that is also safe between threads and reentrant
+        within a thread, so nested mounts of the same object do not deadlock.
+    """
+
+    def __init__(self, path):
+        self.threadLock = threading.RLock()
+        self.processLock = fasteners.InterProcessLock(path)
+        self.depth = 0
+
+    def __enter__(self):
+        self.threadLock.acquire()
+        if self.depth == 0:
+            try:
+                self.processLock.acquire()
+            except:
+                self.threadLock.release()
+                raise
+        self.depth += 1
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.depth -= 1
+        if self.depth == 0:
+            self.processLock.release()
+        self.threadLock.release()
+        return False
+
+class LockManager(object):
+
+    def __init__(self, dbLockPath=dbLockPath, lockDir=lockDir):
+        self.dbLockPath = dbLockPath
+        self.lockDir = lockDir
+        self.dbLock = fasteners.InterProcessReaderWriterLock(dbLockPath)
+        self.namedLocks = {}
+        self.guard = threading.Lock()
+
+    def db(self, shared=False):
+        if shared:
+            return tracing.timedAcquire(self.dbLock.read_lock(), 'lock.db', shared=True)
+        return tracing.timedAcquire(self.dbLock.write_lock(), 'lock.db', shared=False)
+
+    def point(self, pointName):
+        return self._named("point", pointName)
+
+    def instance(self, imageName, instanceName):
+        return self._named("instance", imageName, instanceName)
+
+    def usage(self):
+        # the disk usage cache is written by commands that share the manifest lock
+        return self._named("usage")
+
+    def mountRefs(self):
+        # the shared mount reference counts are also written by mount commands
+        return self._named("mountRefs")
+
+    def layerIndex(self):
+        # like usage(), for the persisted layer file indexes
+        return self._named("layerIndex")
+
+    def _named(self, *parts):
+        filename = "-".join([quote(str(part), safe='') for part in parts]) + ".lock"
+        with self.guard:
+            if filename not in self.namedLocks:
+                os.makedirs(self.lockDir, 0o777, exist_ok=True)
+                self.namedLocks[filename] = NamedLock(os.path.join(self.lockDir, filename))
+            namedLock = self.namedLocks[filename]
+        return tracing.timedAcquire(namedLock, 'lock.' + parts[0], target="/".join(map(str, parts[1:])))
@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+import contextlib
+import json
+import os
+import threading
+
+import classDb
+import error
+import layerUtils
+import mountTable
+import tracing
+
+# STACKO_MOUNT_BACKEND=simulated runs every command without root or overlayfs
+backendEnvVar = 'STACKO_MOUNT_BACKEND'
+simulatedFilename = 'simulated-mounts.json'
+
+# seconds a single mount(8)/umount(8) call may take, None waits forever
+defaultTimeout = 120
+
+def runCommand(command, timeout=None):
+    """ Run a mount command, raising StacksException when it fails and
+        MountTimeoutException (after killing it) when it takes longer than
+        timeout seconds.
+    """
+    import subprocess
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        stdOut, stdErr = process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        # a process stuck in the kernel only goes away once the call returns,
+        # do not wait for it
+        threading.Thread(target=process.wait, daemon=True).start()
+        raise error.MountTimeoutException("Timed out after {0!s}s: {1!s}".format(timeout, " ".join(command)))
+    if process.returncode != 0:
+        raise error.StacksException("Failed with exit code {0!s}: {1!s}: {2!s}".format(
+            process.returncode, " ".join(command), stdErr.decode('utf-8', 'replace').strip()))
+
+class OverlayBackend(object):
+    """ Real kernel mounts: overlayfs and bind mounts through mount(8), each
+        call given up after timeout seconds. Queries are answered from a
+        MountTable snapshot that is invalidated after every change made here.
+    """
+
+    requiresRoot = True
+
+    def __init__(self, table=None, timeout=defaultTimeout):
+        self.mountTable = table or mountTable.MountTable()
+        self.timeout = timeout
+
+    @contextlib.contextmanager
+    def timeLimit(self, timeout):
+        # api.Stacko runs one call at a time, the engine threads only read it
+        previous = self.timeout
+        self.timeout = timeout
+        try:
+            yield
+        finally:
+            self.timeout = previous
+
+    # queries
+    def isMounted(self, path):
+        return self.mountTable.isMounted(path)
+
+    def mounted(self, paths):
+        return self.mountTable.mounted(paths)
+
+    def get(self, path):
+        return self.mountTable.get(path)
+
+    def snapshot(self):
+        return self.mountTable.snapshot()
+
+    def watch(self):
+        self.mountTable.watch()
+
+    def refresh(self):
+        self.mountTable.refresh()
+
+    # changes
+    @tracing.traced('mount.overlay')
+    def mountOverlay(self, directory, lowerDirs, upperDir, workingDir, readonly=False):
+        options = "lowerdir={0!s},upperdir={1!s},workdir={2!s}".format(":".join(lowerDirs), upperDir, workingDir)
+        if readonly:
+            options = "ro," + options
+        try:
+            runCommand(['mount', '-t', 'overlay', 'overlay', '-o', options, directory], self.timeout)
+        finally:
+            self.mountTable.invalidate()
+
+    @tracing.traced('mount.bind')
+    def bind(self, source, target, readonly=False):
+        try:
+            runCommand(['mount', '--bind', '-o', 'ro' if readonly else 'rw', source, target], self.timeout)
+        finally:
+            self.mountTable.invalidate()
+
+    @tracing.traced('mount.umount')
+    def umount(self, directory, lazy=False):
+        try:
+            # a lazy umount detaches the mount now and lets open files finish
+            runCommand(['umount'] + (['-l'] if lazy else []) + [directory], self.timeout)
+        finally:
+            self.mountTable.invalidate()
+
+    @tracing.traced('mount.move')
+    def move(self, source, target):
+        try:
+            runCommand(['mount', '--move', source, target], self.timeout)
+        finally:
+            self.mountTable.invalidate()
+
+class SimulatedBackend(object):
+    """ Unprivileged stand-in for the kernel: mounts are only recorded in a
+        JSON file (so separate stacko processes see the same table) and
+        lookups through a mount are resolved in Python over the directories
+        that back it, honouring overlayfs whiteouts and opaque directories.
+    """
+
+    requiresRoot = False
+
+    def __init__(self, statePath, timeout=defaultTimeout):
+        self.statePath = os.path.abspath(statePath)
+        # nothing here blocks, kept for the same interface as OverlayBackend
+        self.timeout = timeout
+        self.guard = threading.RLock()
+        self.version = None
+        self.mounts = {}
+
+    @contextlib.contextmanager
+    def timeLimit(self, timeout):
+        previous = self.timeout
+        self.timeout = timeout
+        try:
+            yield
+        finally:
+            self.timeout = previous
+
+    def _stateVersion(self):
+        try:
+            st = os.stat(self.statePath)
+            return (st.st_ino, st.st_size, st.st_mtime_ns)
+        except OSError:
+            return None
+
+    def _load(self):
+        version = self._stateVersion()
+        if version == self.version:
+            return self.mounts
+        if version is None:
+            self.mounts = {}
+        else:
+            with open(self.statePath, 'r') as theFile:
+                self.mounts = json.load(theFile)
+        self.version = version
+        return self.mounts
+
+    def _change(self, func):
+        import fasteners
+        with self.guard:
+            with fasteners.InterProcessLock(self.statePath + ".lock"):
+                mounts = dict(self._load())
+                func(mounts)
+                classDb.atomicWrite(self.statePath, json.dumps(mounts, sort_keys=True))
+                self.mounts = mounts
+                self.version = self._stateVersion()
+
+    # queries
+    def snapshot(self):
+        with self.guard:
+            return dict((path, [mountTable.MountEntry(path, entry['type'], entry.get('source', entry['type']),
+                                                      'ro' if entry['readonly'] else 'rw')])
+                        for path, entry in list(self._load().items()))
+
+    def isMounted(self, path):
+        with self.guard:
+            return os.path.realpath(path) in self._load()
+
+    def mounted(self, paths):
+        with self.guard:
+            mounts = self._load()
+            return set([path for path in paths if os.path.realpath(path) in mounts])
+
+    def get(self, path):
+        entries = self.snapshot().get(os.path.realpath(path))
+        if entries:
+            return entries[-1]
+        return None
+
+    def watch(self):
+        pass
+
+    def refresh(self):
+        pass
+
+    # changes
+    @tracing.traced('mount.overlay')
+    def mountOverlay(self, directory, lowerDirs, upperDir, workingDir, readonly=False):
+        path = os.path.realpath(directory)
+
+        def change(mounts):
+            if path in mounts:
+                raise OSError("Already mounted: {0!s}".format(path))
+            mounts[path] = {'type': 'overlay',
+                            'lower': [os.path.realpath(lowerDir) for lowerDir in lowerDirs],
+                            'upper': os.path.realpath(upperDir),
+                            'readonly': readonly}
+        self._change(change)
+
+    @tracing.traced('mount.bind')
+    def bind(self, source, target, readonly=False):
+        path = os.path.realpath(target)
+
+        def change(mounts):
+            if path in mounts:
+                raise OSError("Already mounted: {0!s}".format(path))
+            mounts[path] = {'type': 'bind',
+                            'source': os.path.realpath(source),
+                            'readonly': readonly}
+        self._change(change)
+
+    @tracing.traced('mount.umount')
+    def umount(self, directory, lazy=False):
+        path = os.path.realpath(directory)
+
+        def change(mounts):
+            if path not in mounts:
+                raise OSError("Not mounted: {0!s}".format(path))
+            del mounts[path]
+        self._change(change)
+
+    @tracing.traced('mount.move')
+    def move(self, source, target):
+        sourcePath = os.path.realpath(source)
+        targetPath = os.path.realpath(target)
+
+        def change(mounts):
+            if sourcePath not in mounts:
+                raise OSError("Not mounted: {0!s}".format(sourcePath))
+            if targetPath in mounts:
+                raise OSError("Already mounted: {0!s}".format(targetPath))
+            mounts[targetPath] = mounts.pop(sourcePath)
+        self._change(change)
+
+    # lookups through the virtual mounts
+    def _findMount(self, path):
+        mounts = self._load()
+        candidate = path
+        while True:
+            if candidate in mounts:
+                return candidate, mounts[candidate]
+            parent = os.path.dirname(candidate)
+            if parent == candidate:
+                return None, None
+            candidate = parent
+
+    def _layers(self, path):
+        # the real paths that make up path, topmost layer first
+        with self.guard:
+            mountPoint, entry = self._findMount(path)
+        if entry is None:
+            return [path]
+        relPath = os.path.relpath(path, mountPoint)
+        if entry['type'] == 'bind':
+            return self._layers(os.path.normpath(os.path.join(entry['source'], relPath)))
+        layers = [entry['upper']] + entry['lower']
+        # lower dirs may themselves be (legacy) simulated mounts
+        result = []
+        for layer in layers:
+            result.extend(self._layers(os.path.normpath(os.path.join(layer, relPath))))
+        return result
+
+    def resolve(self, path):
+        """ Real path that backs path as seen through the mounts, None if
+            it does not exist there.
+        """
+        for candidate in self._layers(os.path.realpath(path)):
+            if os.path.lexists(candidate):
+                if layerUtils.isWhiteout(os.lstat(candidate)):
+                    return None
+                return candidate
+            if self._hiddenBelow(candidate):
+                return None
+        return None
+
+    def _hiddenBelow(self, candidate):
+        # a whiteout or opaque directory on the way to candidate hides the
+        # layers below this one
+        parent = os.path.dirname(candidate)
+        while parent != os.path.dirname(parent):
+            if os.path.lexists(parent):
+                if not os.path.isdir(parent) or os.path.islink(parent):
+                    return True
+                return layerUtils.isOpaque(parent)
+            parent = os.path.dirname(parent)
+        return False
+
+    def listdir(self, path):
+        """ Merged directory listing of path as seen through the mounts. """
+        names = set()
+        hidden = set()
+        for layer in self._layers(os.path.realpath(path)):
+            if os.path.isdir(layer) and not os.path.islink(layer):
+                for entry in os.scandir(layer):
+                    if entry.name in hidden or entry.name in names:
+                        continue
+                    if layerUtils.isWhiteout(entry.stat(follow_symlinks=False)):
+                        hidden.add(entry.name)
+                    else:
+                        names.add(entry.name)
+                if layerUtils.isOpaque(layer):
+                    break
+            elif os.path.lexists(layer):
+                break
+            elif self._hiddenBelow(layer):
+                break
+        return sorted(names)
+
+def fromEnvironment(metadataDir):
+    if os.environ.get(backendEnvVar) == 'simulated':
+        return SimulatedBackend(os.path.join(metadataDir, simulatedFilename))
+    return OverlayBackend()
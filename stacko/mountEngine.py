@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import collections
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import tracing
+
+defaultWorkers = 8
+
+class MountNode(object):
+    """ One mount of a MountGraph. mount() returns True when it mounted
+        something, False when it was mounted already (that is never undone),
+        umount() undoes it. targets are the names (stackpoints) that need it.
+    """
+
+    def __init__(self, key, mount, umount, deps):
+        self.key = key
+        self.mount = mount
+        self.umount = umount
+        self.deps = deps
+        self.targets = []
+        # pending, mounted, present, failed, skipped, undone
+        self.state = 'pending'
+        self.error = None
+        self.finished = None
+
+class MountGraph(object):
+    """ Mounts keyed by their mount dir, added dependencies first. A mount
+        needed by several targets (a parent image's .self mount) is added
+        once.
+    """
+
+    def __init__(self):
+        self.nodes = collections.OrderedDict()
+        self.targetNames = []
+
+    def add(self, key, target, mount, umount, deps=()):
+        node = self.nodes.get(key)
+        if node is None:
+            node = MountNode(key, mount, umount, [dep for dep in deps if dep is not None])
+            self.nodes[key] = node
+        if target not in node.targets:
+            node.targets.append(target)
+        if target not in self.targetNames:
+            self.targetNames.append(target)
+        return node
+
+class MountEngine(object):
+    """ Runs a MountGraph on an event loop: a mount starts as soon as the
+        mounts it stacks on are done, at most workers at a time, each on a
+        thread as the mount calls block. A failing mount fails every target
+        that needs it, and with rollback the mounts made for failed targets
+        alone are undone, dependents first. The mount backend gives up on a
+        mount call that hangs (see mountBackend.defaultTimeout), which fails
+        its targets like any other error.
+    """
+
+    def __init__(self, workers=defaultWorkers, rollback=True):
+        self.workers = max(1, workers)
+        self.rollback = rollback
+
+    @tracing.traced('mountEngine.run')
+    def run(self, graph):
+        """ Returns [(target, seconds, error)] in the order targets were
+            added, error is None on success.
+        """
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            asyncio.run(self._run(graph, executor))
+
+        results = []
+        for target in graph.targetNames:
+            nodes = [node for node in graph.nodes.values() if target in node.targets]
+            failed = [node for node in nodes if node.error is not None]
+            finished = max([node.finished for node in nodes if node.finished is not None] or [start])
+            results.append((target, finished - start, failed[0].error if failed else None))
+
+        if self.rollback:
+            failedTargets = set(target for target, seconds, exc in results if exc is not None)
+            self._rollback(graph, failedTargets)
+        return results
+
+    async def _run(self, graph, executor):
+        loop = asyncio.get_running_loop()
+        tasks = {}
+
+        async def runNode(node):
+            if node.deps:
+                await asyncio.gather(*[tasks[dep.key] for dep in node.deps])
+            failedDeps = [dep for dep in node.deps if dep.error is not None]
+            if failedDeps:
+                node.state = 'skipped'
+                node.error = failedDeps[0].error
+                return
+
+            # the executor runs at most workers mounts at a time
+            try:
+                mounted = await loop.run_in_executor(executor, self._mountNode, node)
+                node.state = 'mounted' if mounted else 'present'
+            except Exception as e:
+                node.state = 'failed'
+                node.error = e
+            node.finished = time.monotonic()
+
+        for node in graph.nodes.values():
+            tasks[node.key] = loop.create_task(runNode(node))
+        await asyncio.gather(*tasks.values())
+
+    def _mountNode(self, node):
+        with tracing.span('mountEngine.mount', key=node.key):
+            return node.mount()
+
+    def _rollback(self, graph, failedTargets):
+        if not failedTargets:
+            return
+        for node in reversed(list(graph.nodes.values())):
+            if node.state != 'mounted' or not set(node.targets) <= failedTargets:
+                continue
+            try:
+                with tracing.span('mountEngine.umount', key=node.key):
+                    node.umount()
+                node.state = 'undone'
+            except Exception:
+                # still mounted, fsck reports it if nothing uses it
+                pass
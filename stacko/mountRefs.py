@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+import time
+
+import classDb
+
+# seconds an unused shared mount stays up, so that quickly remounting an
+# instance does not umount and mount its lower layers again
+defaultGrace = 300
+
+class MountRef(object):
+    """ Who stacks on the read-only .self mount of an image (legacy mode):
+        holders maps "image:<child>" (the child's .self mount) and
+        "instance:<name>" (a mounted instance of the image) to the time they
+        did. idleSince is when the last holder went away.
+    """
+
+    def __init__(self, name, holders=None, idleSince=None):
+        self.name = name
+        self.holders = holders or {}
+        self.idleSince = idleSince
+
+class MountRefManager(classDb.ClassDb):
+    """ Reference counts of the shared .self mounts, so mounting and
+        umounting an instance never scans the other instances or children.
+        Written by mount commands, which share the manifest lock: callers
+        serialize on LockManager.mountRefs().
+    """
+
+    dbFilename = "mountRefs.json"
+
+    def track(self, name):
+        # a shared mount this process just made, it is idle until acquired
+        if name not in self.db:
+            self.db[name] = MountRef(name, idleSince=time.time())
+
+    def acquire(self, name, holder):
+        # untracked mounts (made by an older stacko, or before a crash) are
+        # never counted, and so never reaped
+        if name not in self.db:
+            return
+        ref = self.db[name]
+        if holder not in ref.holders:
+            ref.holders[holder] = time.time()
+            ref.idleSince = None
+            self.markDirty(name)
+
+    def release(self, name, holder):
+        if name not in self.db:
+            return
+        ref = self.db[name]
+        if ref.holders.pop(holder, None) is not None:
+            if not ref.holders:
+                ref.idleSince = time.time()
+            self.markDirty(name)
+
+    def holders(self, name):
+        """ None when the mount is not tracked (mounted by an older stacko) """
+        if name not in self.db:
+            return None
+        return list(self.db[name].holders.keys())
+
+    def forget(self, name):
+        if name in self.db:
+            del self.db[name]
+
+    def idle(self, grace, now=None):
+        now = time.time() if now is None else now
+        return sorted(ref.name for ref in self.db.values()
+                      if not ref.holders and ref.idleSince is not None and ref.idleSince <= now - grace)
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import select
+import threading
+
+import tracing
+
+mountInfoPath = '/proc/self/mountinfo'
+
+def unescape(field):
+    # mountinfo escapes space, tab, newline and backslash as \ooo
+    return re.sub(r'\\([0-7]{3})', lambda match: chr(int(match.group(1), 8)), field)
+
+class MountEntry(object):
+
+    def __init__(self, mountPoint, fsType, source, options, superOptions=""):
+        self.mountPoint = mountPoint
+        self.fsType = fsType
+        self.source = source
+        self.options = options
+        # filesystem wide options, e.g. prjquota
+        self.superOptions = superOptions
+
+class MountTable(object):
+    """ Snapshot of the kernel mount table, read once and indexed by mount
+        point. Call invalidate() after changing mounts so the next query
+        rereads it.
+    """
+
+    def __init__(self, path=mountInfoPath):
+        self.path = path
+        self.mounts = None
+        self.guard = threading.Lock()
+        self.watchFile = None
+        self.poller = None
+
+    def watch(self):
+        # keep the table open so that changes made by anyone can be detected
+        # cheaply with refresh(), used by long running processes
+        self.watchFile = open(self.path, 'r')
+        self.poller = select.poll()
+        self.poller.register(self.watchFile, select.POLLPRI | select.POLLERR)
+        self.invalidate()
+
+    def refresh(self):
+        # drop the snapshot if the kernel mount table changed since it was read
+        if self.poller is None or len(self.poller.poll(0)) > 0:
+            self.invalidate()
+
+    def _readLines(self):
+        if self.watchFile is not None:
+            # rereading the watched file also resets its poll state
+            self.watchFile.seek(0)
+            return self.watchFile.read().splitlines()
+        with open(self.path, 'r') as theFile:
+            return theFile.read().splitlines()
+
+    @tracing.traced('mountTable.read')
+    def _load(self):
+        mounts = {}
+        for line in self._readLines():
+            fields = line.split()
+            # optional fields end with a lone "-", followed by the fs type,
+            # the source and the super block options
+            separator = fields.index('-', 6)
+            entry = MountEntry(mountPoint=unescape(fields[4]),
+                               fsType=fields[separator + 1],
+                               source=unescape(fields[separator + 2]),
+                               options=fields[5],
+                               superOptions=fields[separator + 3] if len(fields) > separator + 3 else "")
+            # the last entry for a path is the one stacked on top
+            mounts.setdefault(entry.mountPoint, []).append(entry)
+        return mounts
+
+    def snapshot(self):
+        with self.guard:
+            if self.mounts is None:
+                self.mounts = self._load()
+            return self.mounts
+
+    def invalidate(self):
+        with self.guard:
+            self.mounts = None
+
+    def isMounted(self, path):
+        return os.path.realpath(path) in self.snapshot()
+
+    def mounted(self, paths):
+        # bulk query, returns the subset of the given paths that are mount points
+        mounts = self.snapshot()
+        return set([path for path in paths if os.path.realpath(path) in mounts])
+
+    def containing(self, path):
+        # the mount entry of the filesystem path lives on
+        mounts = self.snapshot()
+        candidate = os.path.realpath(path)
+        while candidate not in mounts:
+            if candidate == os.path.dirname(candidate):
+                return None
+            candidate = os.path.dirname(candidate)
+        return mounts[candidate][-1]
+
+    def get(self, path):
+        entries = self.snapshot().get(os.path.realpath(path))
+        if entries:
+            return entries[-1]
+        return None
@@ -1,11 +1,18 @@
 # -*- coding: utf-8 -*-
+import contextlib
 import os
 import shutil
+import time
 
 import classDb
 import error
+import lock
+import mountBackend
+import tracing
+import usage
 
-import subwrap
+# default size of the worker pool used by mountAll/umountAll
+defaultWorkers = 8
 
 class Point(object):
 
@@ -19,6 +26,9 @@ class PointManager(classDb.ClassDb):
 
     dbFilename = "points.json"
 
+    # the next instance is bind mounted here while the point still serves the old one
+    stagingDir = ".cutover"
+
     mountDir = None
 
     def __init__(self, *args, **kwargs):
@@ -28,6 +38,9 @@ class PointManager(classDb.ClassDb):
             raise RuntimeError("Unexpected dirname: {0!s}".format(repr(self.mountDir)))
 
         self.imageManager = kwargs['imageManager']
+        self.locks = kwargs.get('locks') or lock.LockManager()
+        self.mountBackend = kwargs.get('mountBackend') or self.imageManager.mountBackend
+        self.intents = self.imageManager.intents
 
     def getMountPointDir(self, obj):
         if isinstance(obj, str):
@@ -40,54 +53,107 @@ class PointManager(classDb.ClassDb):
             raise RuntimeError("Invalid input given: {0!s}".format(repr(obj)))
         return instanceDir
 
+    @tracing.traced('point.newPoint')
     def newPoint(self, pointName, imageName):
+        # names starting with a dot are used for stacko's own dirs under mountDir
+        if pointName.startswith("."):
+            raise error.StacksException("Point names cannot start with '.': {0!s}".format(str(pointName)))
+
         # validate input against the manifest
         if pointName in self.db:
-            raise error.StacksException("Point already exists: {0!s}".format(str(pointName)))
+            raise error.ExistsException("Point already exists: {0!s}".format(str(pointName)))
         if imageName not in self.imageManager.db.keys():
-            raise error.StacksException("Image does not exist: {0!s}".format(str(imageName)))
+            raise error.NotFoundException("Image does not exist: {0!s}".format(str(imageName)))
 
         # check if the instance dir is already taken (for some reason)
         instanceDir = self.imageManager.getInstancesDir(imageName, pointName)
         if os.path.exists(instanceDir):
-            raise error.StacksException("Manifest mismatch. Instance directory already exists: {0!s}".format(str(instanceDir)))
+            raise error.ManifestMismatchException("Manifest mismatch. Instance directory already exists: {0!s}".format(str(instanceDir)))
 
         # ensure the mount point does not already exist
         mountPointDir = self.getMountPointDir(pointName)
         if os.path.exists(mountPointDir):
-            raise error.StacksException("Manifest mismatch. Mount point already exists: {0!s}".format(str(mountPointDir)))
+            raise error.ManifestMismatchException("Manifest mismatch. Mount point already exists: {0!s}".format(str(mountPointDir)))
+
+        with self.intents.intent('newPoint') as intent:
+            intent.expect('point', [pointName])
+            # create a new mount point directory
+            intent.create(mountPointDir)
+            os.mkdir(mountPointDir)
+            # create an instance of the given image and associate with the point
+            self.imageManager.newImageInstance(imageName, pointName)
+            # update the manifest
+            self.db[pointName] = Point(pointName, [imageName], imageName)
+
+    @tracing.traced('point.clonePoint')
+    def clonePoint(self, pointName, newPointName):
+        """ New point using a clone of the current instance of another point,
+            e.g. to stage a canary with the state of a running point.
+        """
+        if pointName not in self.db:
+            raise error.NotFoundException("Point does not exist: {0!s}".format(str(pointName)))
+        if newPointName.startswith("."):
+            raise error.StacksException("Point names cannot start with '.': {0!s}".format(str(newPointName)))
+        if newPointName in self.db:
+            raise error.ExistsException("Point already exists: {0!s}".format(str(newPointName)))
+
+        imageName = self.db[pointName].currentImage
+        mountPointDir = self.getMountPointDir(newPointName)
+        if os.path.exists(mountPointDir):
+            raise error.ManifestMismatchException("Manifest mismatch. Mount point already exists: {0!s}".format(str(mountPointDir)))
 
-        # create a new mount point directory
-        os.mkdir(mountPointDir)
-        # create an instance of the given image and associate with the point
-        self.imageManager.newImageInstance(imageName, pointName)
-        # update the manifest
-        self.db[pointName] = Point(pointName, [imageName], imageName)
+        with self.intents.intent('clonePoint') as intent:
+            intent.expect('point', [newPointName])
+            stats = self.imageManager.cloneInstance(imageName, pointName, newPointName)
+            intent.create(mountPointDir)
+            os.mkdir(mountPointDir)
+            self.db[newPointName] = Point(newPointName, [imageName], imageName)
+        return stats
 
+    @tracing.traced('point.deletePoint')
     def deletePoint(self, pointName):
-        pass
-        # TODO...
-        # very destructive, kinda complicated, let's do this later
+        # validate input against the manifest
+        if pointName not in self.db:
+            raise error.NotFoundException("Point does not exist: {0!s}".format(str(pointName)))
 
+        with self.locks.point(pointName):
+            pointDir = os.path.abspath(self.getMountPointDir(pointName))
+            if self.mountBackend.isMounted(pointDir):
+                raise error.InUseException("Cannot delete a mounted point, umount it first: {0!s}".format(pointName))
+
+            with self.intents.intent('deletePoint') as intent:
+                intent.expect('point', [pointName], present=False, record=dict(self.db[pointName].__dict__))
+                # every instance of the point goes, they are moved to the trash
+                for imageObj in self.imageManager.getImagesWithInstanceName(pointName):
+                    self.imageManager.deleteImageInstance(imageObj.name, pointName)
+
+                if os.path.isdir(pointDir):
+                    intent.removeDir(pointDir)
+                    os.rmdir(pointDir)
+                del self.db[pointName]
+
+    @tracing.traced('point.setPointInstance')
     def setPointInstance(self, pointName, imageName):
         # validate input against the manifest
         if pointName not in self.db:
-            raise error.StacksException("Point does not exist: {0!s}".format(str(pointName)))
+            raise error.NotFoundException("Point does not exist: {0!s}".format(str(pointName)))
 
         pointObj = self.db[pointName]
 
         if imageName not in pointObj.imageHistory:
-            raise error.StacksException("Point instance does not exist: {0!s}".format(str(imageName)))
+            raise error.NotFoundException("Point instance does not exist: {0!s}".format(str(imageName)))
 
         # ensure the image instance directory exists?
         # TODO... maybe?
 
         pointObj.currentImage = imageName
+        self.markDirty(pointName)
 
+    @tracing.traced('point.newPointInstance')
     def newPointInstance(self, pointName, imageName):
         # validate input against the manifest
         if pointName not in self.db:
-            raise error.StacksException("Point does not exist: {0!s}".format(str(pointName)))
+            raise error.NotFoundException("Point does not exist: {0!s}".format(str(pointName)))
 
         pointObj = self.db[pointName]
 
@@ -96,11 +162,13 @@ class PointManager(classDb.ClassDb):
         if imageName in pointObj.imageHistory:
             pointObj.imageHistory.remove(imageName)
         pointObj.imageHistory.append(imageName)
+        self.markDirty(pointName)
 
+    @tracing.traced('point.deletePointInstance')
     def deletePointInstance(self, pointName, imageName):
         # validate input against the manifest
         if pointName not in self.db:
-            raise error.StacksException("Point does not exist: {0!s}".format(str(pointName)))
+            raise error.NotFoundException("Point does not exist: {0!s}".format(str(pointName)))
 
         pointObj = self.db[pointName]
 
@@ -109,42 +177,121 @@ class PointManager(classDb.ClassDb):
         # not be possible. A simplification of this is to ensure that the
         # current image instance cannot be deleted
         if imageName == pointObj.currentImage:
-            raise error.StacksException("Cannot delete the Point's main instance, cutover to another instance before deleting: point={0!s} image={1!s}".format(pointName, imageName))
+            raise error.InUseException("Cannot delete the Point's main instance, cutover to another instance before deleting: point={0!s} image={1!s}".format(pointName, imageName))
 
         # delete the instance of the given image and associate with the point
         # and remove from operational history (otherwise fallbacks will fail)
         self.imageManager.deleteImageInstance(imageName, pointName)
         if imageName in pointObj.imageHistory:
             pointObj.imageHistory.remove(imageName)
+        self.markDirty(pointName)
 
-    def mount(self, pointName):
+    @tracing.traced('point.mount')
+    def mount(self, pointName, verbose=True, timeout=mountBackend.defaultTimeout):
         # validate input against the manifest
         if pointName not in self.db:
-            raise error.StacksException("Point does not exist: {0!s}".format(str(pointName)))
-
-        pointObj = self.db[pointName]
-        imageName = pointObj.currentImage
-
-        pointDir = self.getMountPointDir(pointName)
-        pointDir = os.path.abspath(pointDir)
-
-        # TEMP TEMP TEMP: for the meantime, lets be verbose about mount/bind actions
-        topMountDir = self.imageManager.mountInstance(imageName, pointName, writable=True, verbose=True)
-
-        # if there was a successful mount, then bind the point dir to the
-        # top mount dir
-        if topMountDir:
-            topMountDir = os.path.abspath(topMountDir)
+            raise error.NotFoundException("Point does not exist: {0!s}".format(str(pointName)))
+
+        with self.locks.point(pointName), self.mountBackend.timeLimit(timeout):
+            return self._mount(pointName, verbose)
+
+    def _mount(self, pointName, verbose=True):
+        # the caller holds the point lock, the bind must not take it again
+        # from an engine thread
+        import mountEngine
+        engine = mountEngine.MountEngine()
+        name, seconds, exc = engine.run(self._mountGraph([pointName], verbose, lockPoints=False))[0]
+        if exc is not None:
+            raise exc
+        return os.path.abspath(self.getMountPointDir(pointName))
+
+    def _mountGraph(self, pointNames, verbose=False, lockPoints=True):
+        """ The mounts behind each point: in legacy mode the .self mount of
+            every image of the chain (root first, shared between points),
+            then the point's instance overlay and the bind of the point dir.
+        """
+        import mountEngine
+        imageManager = self.imageManager
+        graph = mountEngine.MountGraph()
+        for pointName in pointNames:
+            imageName = self.db[pointName].currentImage
+
+            lower = None
+            if imageManager.legacy:
+                for layer in imageManager.getLayerChain(imageName):
+                    lower = graph.add(os.path.abspath(imageManager.getInstanceMountDir(layer, imageManager.ownInstance)),
+                                      pointName,
+                                      *self._imageMountSteps(layer),
+                                      deps=[lower])
+
+            instance = graph.add(os.path.abspath(imageManager.getInstanceMountDir(imageName, pointName)),
+                                 pointName,
+                                 *self._instanceMountSteps(imageName, pointName, verbose),
+                                 deps=[lower])
+
+            graph.add(os.path.abspath(self.getMountPointDir(pointName)),
+                      pointName,
+                      *self._bindSteps(imageName, pointName, lockPoints),
+                      deps=[instance])
+        return graph
+
+    def _imageMountSteps(self, imageName):
+        def mount():
+            return self.imageManager.mountImage(imageName, writable=False) is not None
+
+        def umount():
+            self.imageManager.umountInstance(imageName, self.imageManager.ownInstance)
+        return mount, umount
+
+    def _instanceMountSteps(self, imageName, pointName, verbose):
+        def mount():
+            return self.imageManager.mountInstance(imageName, pointName, writable=True, verbose=verbose) is not None
+
+        def umount():
+            self.imageManager.umountInstance(imageName, pointName)
+        return mount, umount
+
+    def _bindSteps(self, imageName, pointName, lockPoint):
+        pointDir = os.path.abspath(self.getMountPointDir(pointName))
+        topMountDir = os.path.abspath(self.imageManager.getInstanceMountDir(imageName, pointName))
+
+        def mount():
+            with self.locks.point(pointName) if lockPoint else contextlib.nullcontext():
+                if self.mountBackend.isMounted(pointDir):
+                    return False
+                # a concurrent umount may have taken the instance away again
+                if not self.mountBackend.isMounted(topMountDir):
+                    raise error.StacksException("Instance is no longer mounted: {0!s}".format(topMountDir))
+                self.mountBackend.bind(topMountDir, pointDir)
+                return True
+
+        def umount():
+            with self.locks.point(pointName) if lockPoint else contextlib.nullcontext():
+                self.mountBackend.umount(pointDir)
+        return mount, umount
+
+    @tracing.traced('point.umount')
+    def umount(self, pointName, reap=True):
+        # validate input against the manifest
+        if pointName not in self.db:
+            raise error.NotFoundException("Point does not exist: {0!s}".format(str(pointName)))
 
-            subwrap.run(['mount', '--bind','-o','rw', topMountDir, pointDir ])
+        with self.locks.point(pointName):
+            self._umount(pointName)
 
-        return pointDir
+        # the shared image mounts stay up for a while, see reapIdleMounts()
+        if reap and self.imageManager.legacy:
+            self._reap()
 
-    def umount(self, pointName):
-        # validate input against the manifest
-        if pointName not in self.db:
-            raise error.StacksException("Point does not exist: {0!s}".format(str(pointName)))
+    def _reap(self):
+        try:
+            self.imageManager.reapIdleMounts()
+        except Exception:
+            # the point is umounted, what could not be umounted is left for
+            # reap-mounts, which reports the error
+            pass
 
+    def _umount(self, pointName):
         pointObj = self.db[pointName]
         imageName = pointObj.currentImage
 
@@ -153,9 +300,172 @@ class PointManager(classDb.ClassDb):
         # unbind the point dir
         pointDir = self.getMountPointDir(pointName)
         pointDir = os.path.abspath(pointDir)
-        subwrap.run(['umount', pointDir ])
+        self.mountBackend.umount(pointDir)
+
+    @tracing.traced('point.cutover')
+    def cutover(self, pointName, imageName, verbose=True):
+        """ Switch the point to an instance of the given image, creating the
+            instance if needed. Returns the seconds the point was unavailable,
+            None if the point was not mounted (it is mounted afterwards).
+        """
+        if pointName not in self.db:
+            raise error.NotFoundException("Point does not exist: {0!s}".format(str(pointName)))
+        if imageName not in self.imageManager.db:
+            raise error.NotFoundException("Image does not exist: {0!s}".format(str(imageName)))
 
-    def listPoints(self, pointName=None):
+        pointObj = self.db[pointName]
+        if imageName == pointObj.currentImage:
+            raise error.StacksException("Point already uses this image: point={0!s} image={1!s}".format(pointName, imageName))
+
+        with self.locks.point(pointName):
+            if imageName not in pointObj.imageHistory:
+                self.imageManager.newImageInstance(imageName, pointName)
+            window = self._switch(pointName, imageName, verbose)
+
+            # the history is ordered by cutover, fallbacks walk back through it
+            if imageName in pointObj.imageHistory:
+                pointObj.imageHistory.remove(imageName)
+            pointObj.imageHistory.append(imageName)
+            self.markDirty(pointName)
+        return window
+
+    @tracing.traced('point.fallback')
+    def fallback(self, pointName, verbose=True):
+        """ Switch the point back to the instance used before the current one.
+            Returns (imageName, seconds unavailable) as for cutover().
+        """
+        if pointName not in self.db:
+            raise error.NotFoundException("Point does not exist: {0!s}".format(str(pointName)))
+
+        with self.locks.point(pointName):
+            pointObj = self.db[pointName]
+            if pointObj.currentImage not in pointObj.imageHistory:
+                raise error.ManifestMismatchException("Current image is not in the stackpoint history: point={0!s} image={1!s}".format(
+                    pointName, pointObj.currentImage))
+            index = pointObj.imageHistory.index(pointObj.currentImage)
+            if index == 0:
+                raise error.NotFoundException("No previous instance to fall back to: point={0!s}".format(pointName))
+            imageName = pointObj.imageHistory[index - 1]
+            return imageName, self._switch(pointName, imageName, verbose)
+
+    def _switch(self, pointName, imageName, verbose=True):
+        """ Bring the point from its current instance to the instance of
+            imageName, which must exist. Everything that can be done while the
+            point still serves the old instance is done before and after the
+            swap, the swap itself is a lazy umount and a mount move.
+        """
+        pointObj = self.db[pointName]
+        oldImage = pointObj.currentImage
+        pointDir = os.path.abspath(self.getMountPointDir(pointName))
+
+        if not self.mountBackend.isMounted(pointDir):
+            pointObj.currentImage = imageName
+            self.markDirty(pointName)
+            self._mount(pointName, verbose)
+            return None
+
+        # None when the instance was mounted already
+        mounted = self.imageManager.mountInstance(imageName, pointName, writable=True, verbose=verbose) is not None
+        newTop = os.path.abspath(self.imageManager.getInstanceMountDir(imageName, pointName))
+        stagingDir = os.path.join(os.path.abspath(self.mountDir), self.stagingDir, pointName)
+        os.makedirs(stagingDir, exist_ok=True)
+        try:
+            self.mountBackend.bind(newTop, stagingDir)
+        except:
+            if mounted:
+                self.imageManager.umountInstance(imageName, pointName)
+            raise
+
+        with tracing.span('point.unavailable', point=pointName):
+            start = time.perf_counter()
+            # open files keep the old instance alive until they are closed
+            self.mountBackend.umount(pointDir, lazy=True)
+            try:
+                try:
+                    self.mountBackend.move(stagingDir, pointDir)
+                except Exception:
+                    # moving is refused under shared mount propagation, a
+                    # second bind is slower but leaves the same result
+                    self.mountBackend.bind(newTop, pointDir)
+            except:
+                # put the old instance back, it is still mounted underneath
+                oldTop = self.imageManager.getInstanceMountDir(oldImage, pointName)
+                self.mountBackend.bind(oldTop, pointDir)
+                self.mountBackend.umount(stagingDir)
+                self.imageManager.umountInstance(imageName, pointName)
+                raise
+            window = time.perf_counter() - start
+
+        if self.mountBackend.isMounted(stagingDir):
+            self.mountBackend.umount(stagingDir)
+        os.rmdir(stagingDir)
+
+        pointObj.currentImage = imageName
+        self.markDirty(pointName)
+
+        # the detached old instance goes away once nothing uses it anymore
+        self.imageManager.umountInstance(oldImage, pointName, lazy=True)
+        return window
+
+    @tracing.traced('point.mountAll')
+    def mountAll(self, workers=defaultWorkers, timeout=mountBackend.defaultTimeout):
+        """ Mount every point, independent mounts in parallel (see
+            mountEngine). Returns a list of (pointName, seconds, error) tuples,
+            error is None on success; a failed point leaves nothing mounted
+            that only it needed. A mount call taking longer than timeout
+            seconds fails with MountTimeoutException.
+        """
+        import mountEngine
+        pointNames = self._prepareAll()
+        engine = mountEngine.MountEngine(workers=workers)
+        with self.mountBackend.timeLimit(timeout):
+            return engine.run(self._mountGraph(pointNames, verbose=False, lockPoints=True))
+
+    @tracing.traced('point.umountAll')
+    def umountAll(self, workers=defaultWorkers):
+        pointNames = self._prepareAll()
+        mounted = self.mountBackend.mounted([self.getMountPointDir(name) for name in pointNames])
+        pointNames = [name for name in pointNames if self.getMountPointDir(name) in mounted]
+        results = self._runParallel(pointNames, lambda name: self.umount(name, reap=False), workers)
+        if self.imageManager.legacy:
+            self._reap()
+        return results
+
+    @tracing.traced('point.prepareAll')
+    def _prepareAll(self):
+        # resolve every point, image and layer chain up front so the workers
+        # only read in-memory state
+        pointNames = sorted(self.db.keys())
+        for name in pointNames:
+            self.imageManager.getLowerDirs(self.db[name].currentImage)
+        self.mountBackend.snapshot()
+        return pointNames
+
+    def _runParallel(self, names, func, workers):
+        from concurrent.futures import ThreadPoolExecutor
+
+        def timed(name):
+            start = time.time()
+            try:
+                func(name)
+            except Exception as e:
+                return (name, time.time() - start, e)
+            return (name, time.time() - start, None)
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            return list(executor.map(timed, names))
+
+    def listPoints(self, pointName=None, showUsage=False, full=False):
+        sizes = {}
+        if showUsage:
+            # the CoW layer of every instance of the listed points
+            pointNames = [pointName] if pointName else sorted(self.db.keys())
+            imageNames = set()
+            for name in pointNames:
+                imageNames.update([obj.name for obj in self.imageManager.getImagesWithInstanceName(name)])
+            for name, entry in self.imageManager.diskUsage(sorted(imageNames), full).items():
+                for instance, instanceUsage in entry['instances'].items():
+                    sizes[(instance, name)] = " ({0!s})".format(usage.formatSize(instanceUsage.bytes))
 
         def showPoint(name):
             pointObj = self.db[name]
@@ -168,10 +478,11 @@ class PointManager(classDb.ClassDb):
                 if pointObj.currentImage == imageObj.name:
                     status = " <--- current"
 
+                size = sizes.get((name, imageObj.name), "") + self.imageManager.formatLimit(imageObj.name, name)
                 if isLast:
-                    print(' └── ' + imageObj.name + status)
+                    print(' └── ' + imageObj.name + size + status)
                 else:
-                    print(' ├── ' + imageObj.name + status)
+                    print(' ├── ' + imageObj.name + size + status)
 
             if len(imagesWithThisPointInstance) == 0:
                 print('    <no instances>')
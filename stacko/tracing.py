@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+import functools
+import json
+import os
+import threading
+import time
+
+# STACKO_TRACE=FILE (or --trace FILE) records spans into FILE: Chrome trace
+# format (chrome://tracing, Perfetto) when it ends in .json, JSON lines otherwise
+traceEnvVar = 'STACKO_TRACE'
+
+# the active Tracer, None while tracing is off
+tracer = None
+
+class NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+nullSpan = NullSpan()
+
+class Span(object):
+
+    def __init__(self, tracer, name, attrs):
+        self.tracer = tracer
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        end = time.perf_counter()
+        if excType is not None:
+            self.attrs['error'] = excType.__name__
+        self.tracer.record(self.name, self.start, end, self.attrs)
+        return False
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+class Tracer(object):
+    """ Collects finished spans. JSON lines are appended as each span ends so
+        a crashed run still leaves its trace behind, Chrome traces have to be
+        written as a whole by close().
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.chrome = path.endswith('.json')
+        self.guard = threading.Lock()
+        self.events = []
+        self.origin = time.perf_counter()
+        self.wallOrigin = time.time()
+        self.pid = os.getpid()
+        self.theFile = None
+        if not self.chrome:
+            self.theFile = open(path, 'a')
+
+    def span(self, name, attrs):
+        return Span(self, name, attrs)
+
+    def record(self, name, start, end, attrs):
+        tid = threading.get_ident()
+        with self.guard:
+            if self.chrome:
+                self.events.append({'name': name, 'ph': 'X', 'pid': self.pid, 'tid': tid,
+                                    'ts': (start - self.origin) * 1e6,
+                                    'dur': (end - start) * 1e6,
+                                    'args': attrs})
+            else:
+                self.theFile.write(json.dumps({'name': name, 'pid': self.pid, 'tid': tid,
+                                               'start': self.wallOrigin + (start - self.origin),
+                                               'seconds': end - start,
+                                               'attrs': attrs}, default=str) + "\n")
+                self.theFile.flush()
+
+    def close(self):
+        with self.guard:
+            if self.chrome:
+                with open(self.path, 'w') as theFile:
+                    json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, theFile, default=str)
+            else:
+                self.theFile.close()
+
+class TimedAcquire(object):
+    """ Wraps a lock's context manager so that the wait for it is a span. """
+
+    def __init__(self, lock, name, attrs):
+        self.lock = lock
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        with span(self.name, **self.attrs):
+            return self.lock.__enter__()
+
+    def __exit__(self, excType, excValue, traceback):
+        return self.lock.__exit__(excType, excValue, traceback)
+
+def enable(path):
+    global tracer
+    disable()
+    tracer = Tracer(path)
+    return tracer
+
+def disable():
+    global tracer
+    if tracer is not None:
+        tracer.close()
+        tracer = None
+
+def fromEnvironment():
+    path = os.environ.get(traceEnvVar)
+    if path:
+        enable(path)
+
+def span(name, **attrs):
+    if tracer is None:
+        return nullSpan
+    return tracer.span(name, attrs)
+
+def timedAcquire(lock, name, **attrs):
+    if tracer is None:
+        return lock
+    return TimedAcquire(lock, name, attrs)
+
+def traced(name):
+    """ Decorator: every call of the function is a span. """
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if tracer is None:
+                return func(*args, **kwargs)
+            # the arguments (after self) identify what was operated on
+            attrs = dict((key, str(value)) for key, value in kwargs.items())
+            attrs['args'] = [str(arg) for arg in args[1:]]
+            with tracer.span(name, attrs):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
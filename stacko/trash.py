@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+import os
+import stat
+import threading
+import time
+from urllib.parse import quote, unquote
+
+import fasteners
+
+import classDb
+import tracing
+
+defaultWorkers = 4
+
+# lives in the trash dir, it is not an entry as it lacks the time stamp
+reapLockFilename = ".reap.lock"
+
+class ReapStats(object):
+
+    def __init__(self):
+        self.entries = 0
+        self.files = 0
+        self.dirs = 0
+        self.bytesFreed = 0
+
+class Throttle(object):
+    """ Shared budget of filesystem operations per second, 0 is unlimited. """
+
+    def __init__(self, rate=0):
+        self.rate = rate
+        self.guard = threading.Lock()
+        self.next = time.monotonic()
+
+    def wait(self):
+        if self.rate <= 0:
+            return
+        with self.guard:
+            now = time.monotonic()
+            delay = self.next - now
+            self.next = max(self.next, now) + 1.0 / self.rate
+        if delay > 0:
+            time.sleep(delay)
+
+class Trash(object):
+    """ Deleted image and instance dirs are renamed in here, which is instant
+        and atomic on the same filesystem, and removed later by reap(). An
+        entry is named after the time it was trashed and the path it had
+        (relative to the trash's parent), so a half reaped entry is simply
+        reaped again after a crash and fsck can tell where an entry came from.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def entryFor(self, path):
+        relPath = os.path.relpath(os.path.abspath(path), os.path.dirname(os.path.abspath(self.path)))
+        return os.path.join(self.path, "{0:d}-{1!s}".format(time.time_ns(), quote(relPath, safe='')))
+
+    def moveIn(self, path, entry=None):
+        # entry is given when it had to be known in advance, see intentLog
+        os.makedirs(self.path, 0o777, exist_ok=True)
+        entry = entry or self.entryFor(path)
+        os.rename(path, entry)
+        classDb.syncDir(os.path.dirname(os.path.abspath(path)))
+        classDb.syncDir(self.path)
+        return entry
+
+    def entries(self):
+        """ [(trash entry path, original path relative to the trash's parent)] """
+        if not os.path.isdir(self.path):
+            return []
+        result = []
+        for entry in sorted(os.scandir(self.path), key=lambda entry: entry.name):
+            stamp, sep, quoted = entry.name.partition("-")
+            if sep and stamp.isdigit():
+                result.append((entry.path, unquote(quoted)))
+        return result
+
+    @tracing.traced('trash.reap')
+    def reap(self, workers=defaultWorkers, rate=0, keep=None):
+        """ Remove every trash entry, directories are walked on a thread pool
+            and at most rate files per second are removed (0 for no limit).
+            keep() returns the entry paths to leave alone, it is called once
+            the entries are listed. Returns ReapStats.
+        """
+        stats = ReapStats()
+        if not os.path.isdir(self.path):
+            return stats
+
+        # a second reaper would only trip over the first one's removals
+        with fasteners.InterProcessLock(os.path.join(self.path, reapLockFilename)):
+            return self._reap(stats, workers, rate, keep)
+
+    def _reap(self, stats, workers, rate, keep):
+        from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+        guard = threading.Lock()
+        throttle = Throttle(rate)
+        dirs = []
+
+        def clearDir(path, depth):
+            subDirs = []
+            files = freed = 0
+            for entry in os.scandir(path):
+                st = entry.stat(follow_symlinks=False)
+                if stat.S_ISDIR(st.st_mode):
+                    subDirs.append((entry.path, depth + 1))
+                    continue
+                throttle.wait()
+                os.remove(entry.path)
+                files += 1
+                freed += st.st_size if st.st_nlink == 1 else 0
+            with guard:
+                dirs.append((path, depth))
+                stats.files += files
+                stats.bytesFreed += freed
+            return subDirs
+
+        entries = self.entries()
+        kept = set(os.path.abspath(path) for path in keep()) if keep else set()
+        for entryPath, origin in entries:
+            if os.path.abspath(entryPath) in kept:
+                continue
+            with tracing.span('trash.reapEntry', origin=origin):
+                if not os.path.isdir(entryPath) or os.path.islink(entryPath):
+                    os.remove(entryPath)
+                else:
+                    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+                        pending = set([executor.submit(clearDir, entryPath, 0)])
+                        while pending:
+                            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                            for future in done:
+                                for subDir in future.result():
+                                    pending.add(executor.submit(clearDir, *subDir))
+                    # children before parents, the entry itself goes last
+                    for path, depth in sorted(dirs, key=lambda item: -item[1]):
+                        os.rmdir(path)
+                    stats.dirs += len(dirs)
+                    del dirs[:]
+                stats.entries += 1
+        return stats
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+import os
+import stat
+import threading
+import time
+
+import classDb
+import tracing
+
+defaultWorkers = 8
+
+class Usage(object):
+    """ Disk usage of one layer dir (relative to imagesDir). bytes counts the
+        blocks of files linked only here, sharedBytes those of files with more
+        links (hardlinks, deduplicated blobs). dirs caches every directory's
+        own totals by its mtime for the next scan.
+    """
+
+    def __init__(self, name, bytes=0, sharedBytes=0, files=0, scanned=None, dirs=None):
+        self.name = name
+        self.bytes = bytes
+        self.sharedBytes = sharedBytes
+        self.files = files
+        self.scanned = scanned
+        self.dirs = dirs or {}
+
+    def inodes(self):
+        return self.files + len(self.dirs)
+
+    def summary(self):
+        return {'bytes': self.bytes, 'sharedBytes': self.sharedBytes, 'files': self.files,
+                'inodes': self.inodes(), 'scanned': self.scanned}
+
+def formatSize(size):
+    for unit in ['B', 'K', 'M', 'G', 'T']:
+        if size < 1024 or unit == 'T':
+            break
+        size /= 1024.0
+    if unit == 'B':
+        return "{0:d}B".format(int(size))
+    return "{0:.1f}{1!s}".format(size, unit)
+
+def parseSize(value):
+    """ "512", "10K", "1.5G" -> bytes """
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    value = str(value).strip().upper().rstrip('B')
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+class UsageManager(classDb.ClassDb):
+    """ Cache of layer disk usage. A rescan only lists directories whose
+        mtime changed since the last scan, which catches files being added,
+        removed or copied up, but not an existing file growing in place: use
+        full=True to recount everything.
+
+        This is a cache that is written by commands holding the manifest lock
+        shared, so callers serialize on LockManager.usage() instead.
+    """
+
+    dbFilename = "usage.json"
+
+    def __init__(self, *args, **kwargs):
+        super(UsageManager, self).__init__(*args, **kwargs)
+        self.imagesDir = kwargs['imagesDir']
+
+    @tracing.traced('usage.scan')
+    def scan(self, name, full=False, workers=defaultWorkers):
+        """ Returns the up to date Usage of imagesDir/name. """
+        from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+        root = os.path.join(self.imagesDir, name)
+        cached = {} if full or name not in self.db else self.db[name].dirs
+        guard = threading.Lock()
+        dirs = {}
+
+        def scanDir(relDir):
+            path = os.path.join(root, relDir) if relDir else root
+            st = os.lstat(path)
+            entry = cached.get(relDir)
+            if entry is None or entry[0] != st.st_mtime_ns:
+                ownBytes = st.st_blocks * 512
+                sharedBytes = files = 0
+                subDirs = []
+                for child in os.scandir(path):
+                    childSt = child.stat(follow_symlinks=False)
+                    if stat.S_ISDIR(childSt.st_mode):
+                        subDirs.append(child.name)
+                        continue
+                    files += 1
+                    if childSt.st_nlink > 1:
+                        sharedBytes += childSt.st_blocks * 512
+                    else:
+                        ownBytes += childSt.st_blocks * 512
+                entry = [st.st_mtime_ns, ownBytes, sharedBytes, files, sorted(subDirs)]
+            with guard:
+                dirs[relDir] = entry
+            return [os.path.join(relDir, subDir) for subDir in entry[4]]
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            pending = set([executor.submit(scanDir, "")])
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        subDirs = future.result()
+                    except FileNotFoundError:
+                        # removed while scanning, it no longer counts
+                        continue
+                    for subDir in subDirs:
+                        pending.add(executor.submit(scanDir, subDir))
+
+        result = Usage(name,
+                       bytes=sum(entry[1] for entry in dirs.values()),
+                       sharedBytes=sum(entry[2] for entry in dirs.values()),
+                       files=sum(entry[3] for entry in dirs.values()),
+                       scanned=time.time(),
+                       dirs=dirs)
+        # only a change is written back, the cache is saved after every scan
+        if name not in self.db or self.db[name].dirs != dirs:
+            self.db[name] = result
+        return result
+
+    def prune(self, names):
+        # forget layers that were deleted
+        for name in [name for name in self.db.keys() if name not in names]:
+            del self.db[name]
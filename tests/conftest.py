@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+stackoDir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "stacko")
+sys.path.insert(0, stackoDir)
+
+import api
+import image
+import lock
+import mountBackend
+
+@pytest.fixture
+def workDir(tmp_path, monkeypatch):
+    """ The layout `make init` creates, as the current directory """
+    for name in ("metadata", "images", "mounts"):
+        (tmp_path / name).mkdir()
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv(mountBackend.backendEnvVar, "simulated")
+    return tmp_path
+
+@pytest.fixture
+def stacko(workDir):
+    locks = lock.LockManager(dbLockPath=str(workDir / "db.lock"), lockDir=str(workDir / "locks"))
+    return api.Stacko(metadataDir="metadata", imagesDir="images", mountDir="mounts", locks=locks)
+
+@pytest.fixture
+def legacy(monkeypatch):
+    """ Mount the way stacko does on kernels without multiple lower dirs """
+    monkeypatch.setattr(image, "isLegacyKernel", lambda release=None: True)
+
+def mounted(workDir):
+    """ Mount dirs recorded by the simulated backend, relative to workDir """
+    path = workDir / "metadata" / mountBackend.simulatedFilename
+    if not path.exists():
+        return []
+    return sorted(os.path.relpath(mountDir, str(workDir)) for mountDir in json.loads(path.read_text()))
+
+def runCli(workDir, *args, **kwargs):
+    return subprocess.run([sys.executable, stackoDir] + list(args), cwd=str(workDir),
+                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                          universal_newlines=True, **kwargs)
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import tarfile
+
+import pytest
+
+import archive
+import error
+
+def tarStream(*members):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w') as tar:
+        for info, data in members:
+            tar.addfile(info, io.BytesIO(data) if data is not None else None)
+    buf.seek(0)
+    return io.BufferedReader(buf)
+
+def regular(name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    return info, data
+
+def link(name, target, linkType):
+    info = tarfile.TarInfo(name)
+    info.type = linkType
+    info.linkname = target
+    return info, None
+
+@pytest.fixture
+def dirs(tmp_path):
+    root = tmp_path / "root"
+    outside = tmp_path / "outside"
+    root.mkdir()
+    outside.mkdir()
+    return root, outside
+
+def test_roundTrip(tmp_path, dirs):
+    root, outside = dirs
+    (root / "dir").mkdir()
+    (root / "dir" / "file").write_text("content")
+    os.symlink("dir/file", str(root / "link"))
+
+    buf = io.BytesIO()
+    archive.exportTree(str(root), buf)
+    buf.seek(0)
+    target = tmp_path / "copy"
+    target.mkdir()
+    archive.importTree(str(target), io.BufferedReader(buf))
+
+    assert (target / "dir" / "file").read_text() == "content"
+    assert os.readlink(str(target / "link")) == "dir/file"
+
+@pytest.mark.parametrize("member", ["../escape", "/etc/escape", "dir/../../escape"])
+def test_refusesPathsOutside(dirs, member):
+    root, outside = dirs
+    with pytest.raises(error.StacksException):
+        archive.importTree(str(root), tarStream(regular(member, b"x")))
+
+def test_neverWritesThroughSymlink(dirs):
+    root, outside = dirs
+    stream = tarStream(link("link", str(outside / "pwned"), tarfile.SYMTYPE),
+                       regular("link", b"x"),
+                       link("dir", str(outside), tarfile.SYMTYPE))
+    archive.importTree(str(root), stream)
+
+    assert (root / "link").read_text() == "x"
+    assert os.listdir(str(outside)) == []
+    with pytest.raises(error.StacksException):
+        archive.importTree(str(root), tarStream(regular("dir/pwned", b"x")))
+    assert os.listdir(str(outside)) == []
+
+def test_absoluteSymlinkRoundTrip(tmp_path, dirs):
+    root, outside = dirs
+    (root / "etc").mkdir()
+    os.symlink("/usr/share/zoneinfo/UTC", str(root / "etc" / "localtime"))
+
+    buf = io.BytesIO()
+    archive.exportTree(str(root), buf)
+    buf.seek(0)
+    target = tmp_path / "copy"
+    target.mkdir()
+    archive.importTree(str(target), io.BufferedReader(buf))
+
+    assert os.readlink(str(target / "etc" / "localtime")) == "/usr/share/zoneinfo/UTC"
+
+@pytest.mark.parametrize("target", ["/etc/hostname", "../outside/file", "a/../../outside/file"])
+def test_refusesHardlinksOutside(dirs, target):
+    root, outside = dirs
+    (outside / "file").write_text("host")
+    with pytest.raises(error.StacksException):
+        archive.importTree(str(root), tarStream(link("link", target, tarfile.LNKTYPE)))
+    assert os.stat(str(outside / "file")).st_nlink == 1
+
+def test_refusesHardlinkThroughSymlink(dirs):
+    root, outside = dirs
+    (outside / "file").write_text("host")
+    stream = tarStream(link("sym", str(outside / "file"), tarfile.SYMTYPE),
+                       link("hard", "sym", tarfile.LNKTYPE))
+    with pytest.raises(error.StacksException):
+        archive.importTree(str(root), stream)
+    assert os.stat(str(outside / "file")).st_nlink == 1
+
+def test_replacesEarlierEntries(dirs):
+    root, outside = dirs
+    stream = tarStream(regular("file", b"first"),
+                       link("link", "file", tarfile.SYMTYPE),
+                       link("hard", "file", tarfile.LNKTYPE),
+                       regular("link", b"second"),
+                       regular("hard", b"third"))
+    archive.importTree(str(root), stream)
+
+    assert (root / "file").read_text() == "first"
+    assert not os.path.islink(str(root / "link"))
+    assert (root / "link").read_text() == "second"
+    assert (root / "hard").read_text() == "third"
+    assert os.stat(str(root / "hard")).st_nlink == 1
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+import json
+
+from conftest import runCli
+
+def listImages(workDir):
+    return runCli(workDir, "list-images").stdout.splitlines()[1:]
+
+def test_keepGoingUndoesTheFailedCommandOnly(workDir):
+    (workDir / "batch.txt").write_text("new-image z\n"
+                                       "import-image y --input /nonexistent\n"
+                                       "new-image w\n")
+    result = runCli(workDir, "batch", "--keep-going", "batch.txt")
+
+    assert result.returncode == 1
+    assert "failed=1" in result.stdout
+    assert listImages(workDir) == ["w", "z"]
+    assert sorted(path.name for path in (workDir / "images").iterdir()) == ["w", "z"]
+
+def test_stopsAtFirstFailure(workDir):
+    (workDir / "batch.txt").write_text("new-image a\nnew-image a\nnew-image b\n")
+    result = runCli(workDir, "batch", "batch.txt")
+
+    assert result.returncode == 1
+    assert listImages(workDir) == ["a"]
+
+def test_atomicUndoesEverything(workDir):
+    (workDir / "batch.txt").write_text("new-image a\n"
+                                       "new-stackpoint p a\n"
+                                       "new-image a\n")
+    result = runCli(workDir, "batch", "--atomic", "batch.txt")
+
+    assert result.returncode == 1
+    assert "every command was undone" in result.stdout
+    assert listImages(workDir) == []
+    assert [path.name for path in (workDir / "images").iterdir() if path.name != ".trash"] == []
+    assert not (workDir / "metadata" / "intents.journal").exists()
+
+def test_jsonResults(workDir):
+    result = runCli(workDir, "batch", "--json", "-", input='["new-image", "a"]\n{"command": "list-images"}\n')
+
+    assert result.returncode == 0
+    lines = [json.loads(line) for line in result.stdout.splitlines()]
+    assert [line['ok'] for line in lines] == [True, True]
+    assert "a" in lines[1]['output']
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+import json
+
+import pytest
+
+import classDb
+from conftest import runCli
+
+indexes = {'value': lambda record: [record['value']]}
+
+def put(name, value):
+    return {'name': name, 'value': value}
+
+@pytest.fixture
+def journal(tmp_path):
+    store = classDb.JournalStore(str(tmp_path), "items.json").load()
+    store.commit([put("a", 1), put("b", 1)], [])
+    store.commit([put("a", 2)], ["b"])
+    return tmp_path, store
+
+def reload(tmp_path):
+    return classDb.JournalStore(str(tmp_path), "items.json").load()
+
+def test_journalReplayed(journal):
+    tmp_path, store = journal
+
+    assert not (tmp_path / "items.json").exists()
+    assert reload(tmp_path).values() == [put("a", 2)]
+
+@pytest.mark.parametrize("tail", [b'{"op": "put", "record": {"name": "c"', b'{"op": "del"\n'])
+def test_tornTailDiscarded(journal, tail):
+    tmp_path, store = journal
+    journalPath = tmp_path / "items.json.journal"
+    complete = journalPath.read_bytes()
+    with open(str(journalPath), 'ab') as theFile:
+        theFile.write(tail)
+
+    store = reload(tmp_path)
+    assert store.values() == [put("a", 2)]
+
+    # the next commit lands where the torn entry started
+    store.commit([put("c", 3)], [])
+    assert journalPath.read_bytes().startswith(complete)
+    assert json.loads(journalPath.read_bytes()[len(complete):].decode('utf-8')) == {'op': 'put', 'record': put("c", 3)}
+    assert sorted(reload(tmp_path).keys()) == ["a", "c"]
+
+def test_compactFoldsJournalIntoSnapshot(journal, monkeypatch):
+    tmp_path, store = journal
+    monkeypatch.setattr(classDb, "compactThreshold", 5)
+
+    store.commit([put("c", 3)], [])
+    assert (tmp_path / "items.json.journal").exists()
+    store.commit([put("d", 4)], ["a"])
+
+    assert not (tmp_path / "items.json.journal").exists()
+    snapshot = json.loads((tmp_path / "items.json").read_text())
+    assert sorted(record['name'] for record in snapshot) == ["c", "d"]
+    assert sorted(reload(tmp_path).keys()) == ["c", "d"]
+
+    # appending starts over on top of the new snapshot
+    store.commit([put("e", 5)], [])
+    assert sorted(reload(tmp_path).keys()) == ["c", "d", "e"]
+
+def test_replayAfterCompactIsHarmless(journal):
+    tmp_path, store = journal
+    stale = (tmp_path / "items.json.journal").read_bytes()
+    store.compact()
+    # a crash between the snapshot rename and removing the journal
+    (tmp_path / "items.json.journal").write_bytes(stale)
+
+    assert reload(tmp_path).values() == [put("a", 2)]
+
+@pytest.mark.parametrize("backend", sorted(classDb.storeBackends))
+def test_storesAgree(tmp_path, backend):
+    store = classDb.openStore(str(tmp_path), "items.json", indexes=indexes, backend=backend)
+    store.commit([put("a", 1), put("b", 1), put("c", 2)], [])
+    store.commit([put("a", 2)], ["c"])
+
+    store = classDb.openStore(str(tmp_path), "items.json", indexes=indexes)
+    assert classDb.detectBackend(str(tmp_path)) == backend
+    assert sorted(store.keys()) == ["a", "b"]
+    assert store.get("a") == put("a", 2)
+    assert store.get("c") is None
+    assert store.lookup("value", 1) == ["b"]
+    assert store.lookup("value", 2) == ["a"]
+
+def test_sqliteSeesOtherConnectionsCommits(tmp_path):
+    store = classDb.openStore(str(tmp_path), "items.json", backend='sqlite')
+    other = classDb.openStore(str(tmp_path), "items.json", backend='sqlite')
+    version = store.version()
+    other.commit([put("a", 1)], [])
+
+    assert store.version() != version
+    assert store.get("a") == put("a", 1)
+
+def test_migrateDbRoundTrip(workDir):
+    for args in (["new-image", "base"], ["new-image", "app", "base"], ["new-stackpoint", "p", "app"]):
+        assert runCli(workDir, *args).returncode == 0
+    before = runCli(workDir, "list-stackpoints").stdout
+    (workDir / "images" / "app" / ".self" / "content" / "file").write_text("app")
+    assert runCli(workDir, "diff", "app", "--index").returncode == 0
+
+    result = runCli(workDir, "migrate-db", "sqlite")
+    assert result.returncode == 0, result.stdout
+    assert "images=2 points=1" in result.stdout
+    assert (workDir / "metadata" / classDb.sqliteFilename).exists()
+    assert (workDir / "metadata" / "images.json.journal.migrated").exists()
+    assert not (workDir / "metadata" / "images.json.journal").exists()
+    assert runCli(workDir, "list-stackpoints").stdout == before
+    # the layer indexes moved along
+    assert "Changed since the last index: 0" in runCli(workDir, "diff", "app", "--index").stdout
+
+    assert "already uses the sqlite backend" in runCli(workDir, "migrate-db", "sqlite").stdout
+    assert runCli(workDir, "delete-stackpoint", "p").returncode == 0
+    assert runCli(workDir, "migrate-db", "json").returncode == 0
+    assert not (workDir / "metadata" / classDb.sqliteFilename).exists()
+    assert runCli(workDir, "list-images").stdout.splitlines()[1:] == ["app", "base"]
+    assert runCli(workDir, "list-stackpoints").stdout != before
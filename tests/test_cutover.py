@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+import error
+from conftest import mounted
+
+@pytest.fixture
+def point(workDir, stacko):
+    stacko.newImage("a")
+    stacko.newImage("b", "a")
+    (workDir / "images" / "a" / ".self" / "content" / "fa").write_text("a")
+    (workDir / "images" / "b" / ".self" / "content" / "fb").write_text("b")
+    stacko.newPoint("p", "a")
+    return stacko
+
+def serves(workDir, stacko, fileName):
+    return stacko.mountBackend.resolve(str(workDir / "mounts" / "p" / fileName)) is not None
+
+def test_cutoverSwapsMountedPoint(workDir, point):
+    point.mount("p")
+
+    window = point.cutover("p", "b")
+
+    assert window >= 0
+    assert serves(workDir, point, "fb")
+    assert point.listPoints("p")["p"]["current"] == "b"
+    assert point.listPoints("p")["p"]["history"] == ["a", "b"]
+    # the old instance is detached, the staging bind is gone
+    assert "images/a/p/mount" not in mounted(workDir)
+    assert not any(path.startswith("mounts/.") for path in mounted(workDir))
+
+def test_cutoverOfUnmountedPointMountsIt(workDir, point):
+    assert point.cutover("p", "b") is None
+    assert serves(workDir, point, "fb")
+
+def test_fallbackWalksBackThroughHistory(workDir, point):
+    point.mount("p")
+    point.cutover("p", "b")
+
+    result = point.fallback("p")
+
+    assert result["image"] == "a"
+    assert result["seconds"] >= 0
+    assert serves(workDir, point, "fa") and not serves(workDir, point, "fb")
+    assert point.listPoints("p")["p"]["history"] == ["a", "b"]
+    with pytest.raises(error.NotFoundException):
+        point.fallback("p")
+
+    # cutting over again moves b to the end of the history
+    point.cutover("p", "b")
+    assert point.listPoints("p")["p"]["history"] == ["a", "b"]
+    assert point.listPoints("p")["p"]["instances"] == ["a", "b"]
+
+def test_cutoverToCurrentImageRefused(point):
+    with pytest.raises(error.StacksException):
+        point.cutover("p", "a")
+
+def test_bindUsedWhenMoveRefused(workDir, point, monkeypatch):
+    point.mount("p")
+
+    def refuse(*args):
+        raise OSError("mount --move refused")
+    monkeypatch.setattr(type(point.mountBackend), "move", refuse)
+    point.cutover("p", "b")
+
+    assert serves(workDir, point, "fb")
+    assert point.listPoints("p")["p"]["current"] == "b"
+
+def test_failedSwapKeepsOldInstance(workDir, point, monkeypatch):
+    point.mount("p")
+    backend = type(point.mountBackend)
+    bind = backend.bind
+
+    def refuse(*args):
+        raise OSError("mount --move refused")
+
+    def bindOnlyStaging(self, source, target, *args, **kwargs):
+        if target == str(workDir / "mounts" / "p") and source.endswith("/b/p/mount"):
+            raise OSError("mount --bind refused")
+        return bind(self, source, target, *args, **kwargs)
+    monkeypatch.setattr(backend, "move", refuse)
+    monkeypatch.setattr(backend, "bind", bindOnlyStaging)
+
+    with pytest.raises(OSError):
+        point.cutover("p", "b")
+
+    assert serves(workDir, point, "fa") and not serves(workDir, point, "fb")
+    assert point.listPoints("p")["p"]["current"] == "a"
+    assert "images/b/p/mount" not in mounted(workDir)
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+import os
+import socket
+import stat
+import threading
+
+import pytest
+
+import daemon
+import error
+
+@pytest.fixture
+def serve(workDir, stacko):
+    servers = []
+
+    def start():
+        server = daemon.StackoServer(str(workDir / "stacko.sock"), stacko)
+        servers.append(server)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+def test_callsOverTheSocket(workDir, serve):
+    serve()
+    client = daemon.Client(str(workDir / "stacko.sock"))
+    client.newImage("a")
+
+    assert client.listImages() == ["a"]
+    with pytest.raises(error.NotFoundException):
+        client.deleteImage("b")
+    client.close()
+
+def test_socketCreatedPrivate(workDir, serve):
+    serve()
+    assert stat.S_IMODE(os.stat(str(workDir / "stacko.sock")).st_mode) == 0o600
+
+def test_liveDaemonNotReplaced(workDir, stacko, serve):
+    serve()
+    with pytest.raises(error.StacksException):
+        daemon.StackoServer(str(workDir / "stacko.sock"), stacko)
+
+    assert daemon.Client(str(workDir / "stacko.sock")).listImages() == []
+
+def test_staleSocketReplaced(workDir, serve):
+    # bound by a daemon that is gone, nothing listens on it
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(str(workDir / "stacko.sock"))
+    sock.close()
+
+    serve()
+    assert daemon.Client(str(workDir / "stacko.sock")).listImages() == []
+
+def test_otherFilesNotRemoved(workDir, stacko):
+    (workDir / "stacko.sock").write_text("not a socket")
+    with pytest.raises(error.StacksException):
+        daemon.StackoServer(str(workDir / "stacko.sock"), stacko)
+
+    assert (workDir / "stacko.sock").read_text() == "not a socket"
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+import shutil
+
+import pytest
+
+from conftest import mounted
+
+@pytest.fixture
+def tree(workDir, stacko):
+    stacko.newImage("a")
+    stacko.newImage("b", "a")
+    stacko.newPoint("p", "a")
+    stacko.cutover("p", "b")
+    return stacko
+
+def kinds(problems):
+    return sorted(problem['kind'] for problem in problems)
+
+def test_cleanTree(tree):
+    tree.mount("p")
+    assert tree.fsck() == []
+
+def test_orphanDirsTrashed(workDir, tree):
+    (workDir / "images" / "ghost").mkdir()
+    (workDir / "images" / "a" / "ghost").mkdir()
+    (workDir / "mounts" / "ghost").mkdir()
+
+    assert kinds(tree.fsck()) == ["orphan-image-dir", "orphan-instance-dir", "orphan-mount-dir"]
+    # checking alone changes nothing
+    assert (workDir / "images" / "ghost").exists()
+
+    problems = tree.fsck(repair=True)
+
+    assert all(problem['repaired'] and problem['error'] is None for problem in problems)
+    assert not (workDir / "images" / "ghost").exists()
+    assert not (workDir / "images" / "a" / "ghost").exists()
+    assert not (workDir / "mounts" / "ghost").exists()
+    assert len(list((workDir / "images" / ".trash").iterdir())) == 2
+    assert tree.fsck() == []
+
+def test_missingInstanceDroppedFromManifest(workDir, tree):
+    shutil.rmtree(str(workDir / "images" / "a" / "p"))
+
+    assert kinds(tree.fsck()) == ["dangling-history", "missing-instance-dir"]
+
+    tree.fsck(repair=True)
+
+    assert tree.listInstances("a") == {"a": []}
+    assert tree.listPoints("p")["p"]["history"] == ["b"]
+    assert tree.listPoints("p")["p"]["current"] == "b"
+    assert tree.fsck() == []
+
+def test_unrepairableProblemReported(workDir, tree):
+    shutil.rmtree(str(workDir / "images" / "a" / "p"))
+    shutil.rmtree(str(workDir / "images" / "b" / "p"))
+
+    problems = dict((problem['detail'], problem) for problem in tree.fsck(repair=True))
+
+    # the point has no instance left to use
+    failed = problems["point=p image=b"]
+    assert not failed['repaired'] and failed['error'] is not None
+    assert tree.listPoints("p")["p"]["current"] == "b"
+
+def test_staleMountUmounted(workDir, tree):
+    (workDir / "mounts" / "ghost").mkdir()
+    tree.mountBackend.bind(str(workDir / "images" / "a" / ".self" / "content"), str(workDir / "mounts" / "ghost"))
+
+    assert kinds(tree.fsck()) == ["stale-mount"]
+
+    tree.fsck(repair=True)
+
+    assert "mounts/ghost" not in mounted(workDir)
+    assert "mounts/p" in mounted(workDir)
+    assert kinds(tree.fsck()) == ["orphan-mount-dir"]
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+import quota
+import trash
+from conftest import mounted, runCli
+
+@pytest.fixture
+def quotas(monkeypatch):
+    """ Project ids cleared, as if the filesystem had project quotas """
+    cleared = []
+    monkeypatch.setattr(quota.ProjectQuotas, "isSupported", lambda self, path: True)
+    monkeypatch.setattr(quota.ProjectQuotas, "apply", lambda self, path, projectId, *limits: None)
+    monkeypatch.setattr(quota.ProjectQuotas, "clear", lambda self, path, projectId: cleared.append(projectId))
+    return cleared
+
+def test_editImageTwice(workDir, stacko):
+    stacko.newImage("a")
+    mountDir = stacko.editImage("a")
+
+    assert mountDir == str(workDir / "images" / "a" / ".self" / "mount")
+    assert stacko.editImage("a") == mountDir
+    assert stacko.editImage("a", readOnly=True) == mountDir
+    assert mounted(workDir) == ["images/a/.self/mount"]
+
+def test_editImageCommandTwice(workDir):
+    runCli(workDir, "new-image", "a")
+    first = runCli(workDir, "edit-image", "a")
+    second = runCli(workDir, "edit-image", "a")
+
+    assert second.returncode == 0
+    assert "mount-point=" in second.stdout
+    assert second.stdout == first.stdout
+
+def test_limitClearedOnlyOnceInstanceDeleted(workDir, stacko, quotas, monkeypatch):
+    stacko.newImage("a")
+    stacko.newPoint("p", "a")
+    assert stacko.setInstanceLimit("a", "p", limitBytes=1024) == 'kernel'
+    projectId = stacko.instanceLimits("a")["a"]["p"]["projectId"]
+
+    def fail(self, path, entry=None):
+        raise OSError("cannot move to the trash")
+    with monkeypatch.context() as patch:
+        patch.setattr(trash.Trash, "moveIn", fail)
+        with pytest.raises(OSError):
+            stacko.deletePoint("p")
+
+    assert quotas == []
+    assert "p" in stacko.instanceLimits("a")["a"]
+
+    stacko.deletePoint("p")
+
+    assert quotas == [projectId]
+    assert stacko.instanceLimits("a") == {"a": {}}
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+import subprocess
+import sys
+
+import pytest
+
+import error
+import point
+from conftest import stackoDir
+
+crashScript = '''
+import os, sys
+sys.path.insert(0, {stackoDir!r})
+import api, image, intentLog, point
+# die when the transaction gets to the given step, as a killed process would
+{step} = lambda self, *args: os._exit(3)
+api.Stacko().{call}
+'''
+
+def crash(workDir, step, call):
+    script = crashScript.format(stackoDir=stackoDir, step=step, call=call)
+    result = subprocess.run([sys.executable, "-c", script], cwd=str(workDir))
+    assert result.returncode == 3
+    assert (workDir / "metadata" / "intents.journal").exists()
+
+def test_deleteImageRolledBack(workDir, stacko):
+    stacko.newImage("a")
+    crash(workDir, "image.ImageManager.to_db", "deleteImage('a')")
+    assert not (workDir / "images" / "a").exists()
+
+    # gc without the manifest lock must not reap what recovery puts back
+    stacko.gc()
+    stacko.newImage("b")
+
+    assert stacko.listImages() == ["a", "b"]
+    assert (workDir / "images" / "a" / ".self" / "content").is_dir()
+    assert [name for name, direction, errors in stacko.recovered] == ["deleteImage"]
+    assert not (workDir / "metadata" / "intents.journal").exists()
+
+def test_newPointRolledBackAfterPartialSave(workDir, stacko):
+    stacko.newImage("a")
+    # the image record (with the new instance) is saved, the point is not
+    crash(workDir, "point.PointManager.to_db", "newPoint('p', 'a')")
+
+    stacko.newImage("b")
+
+    assert stacko.recovered == [("newPoint", "back", [])]
+    assert stacko.listPoints() == {}
+    assert "p" not in stacko.listInstances("a")["a"]
+    assert not (workDir / "images" / "a" / "p").exists()
+    assert not (workDir / "mounts" / "p").exists()
+
+def test_deletePointRolledForward(workDir, stacko):
+    stacko.newImage("a")
+    stacko.newPoint("p", "a")
+    # both stores are saved, only removing the log is left
+    crash(workDir, "intentLog.IntentLog.commit", "deletePoint('p')")
+
+    stacko.newImage("b")
+
+    assert stacko.recovered == [("deletePoint", "forward", [])]
+    assert stacko.listPoints() == {}
+    assert "p" not in stacko.listInstances("a")["a"]
+    assert not (workDir / "mounts" / "p").exists()
+    assert not (workDir / "metadata" / "intents.journal").exists()
+
+def test_failedOperationUndoneAtOnce(workDir, stacko, monkeypatch):
+    stacko.newImage("a")
+
+    def fail(self, *args, **kwargs):
+        raise error.StacksException("failed halfway")
+    # newPoint has created the mount dir and the instance when the point
+    # record is written
+    monkeypatch.setattr(point, "Point", fail)
+    with pytest.raises(error.StacksException):
+        stacko.newPoint("p", "a")
+
+    assert not (workDir / "images" / "a" / "p").exists()
+    assert not (workDir / "mounts" / "p").exists()
+    assert not (workDir / "metadata" / "intents.journal").exists()
+    monkeypatch.undo()
+    stacko.newPoint("p", "a")
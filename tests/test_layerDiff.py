@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+import hashlib
+
+import pytest
+
+import api
+import blobStore
+from conftest import runCli
+
+@pytest.fixture
+def layers(workDir, stacko):
+    stacko.newImage("base")
+    stacko.newImage("app", "base")
+    base = workDir / "images" / "base" / ".self" / "content"
+    app = workDir / "images" / "app" / ".self" / "content"
+    (base / "etc").mkdir()
+    (base / "etc" / "conf").write_text("base")
+    (app / "etc").mkdir()
+    (app / "etc" / "conf").write_text("app")
+    (app / "bin").mkdir()
+    (app / "bin" / "tool").write_text("tool")
+    return app, stacko
+
+@pytest.fixture
+def hashed(monkeypatch):
+    paths = []
+    hashFile = blobStore.hashFile
+
+    def record(path):
+        paths.append(path)
+        return hashFile(path)
+    monkeypatch.setattr(blobStore, "hashFile", record)
+    return paths
+
+def test_classifiesAgainstLowerLayers(layers):
+    app, stacko = layers
+    result = stacko.diff("app", hashes=True)
+
+    assert result['added'] == ["bin/", "bin/tool"]
+    assert result['modified'] == ["etc/conf"]
+    assert result['hashes']["etc/conf"] == hashlib.sha256(b"app").hexdigest()
+    assert result['changed'] == []
+
+def test_indexReusesHashesOfUnchangedFiles(workDir, layers, hashed):
+    app, stacko = layers
+    first = stacko.diff("app", hashes=True, useIndex=True)
+    assert len(hashed) == 2
+    assert first['changed'] == ["bin/tool", "etc/conf"]
+
+    del hashed[:]
+    second = stacko.diff("app", hashes=True, useIndex=True)
+    assert hashed == []
+    assert second['changed'] == []
+    assert second['hashes'] == first['hashes']
+
+    (app / "etc" / "conf").write_text("changed")
+    (app / "bin" / "tool").unlink()
+    third = stacko.diff("app", hashes=True, useIndex=True)
+    assert hashed == [str(app / "etc" / "conf")]
+    assert third['changed'] == ["bin/tool", "etc/conf"]
+    assert third['hashes']["etc/conf"] == hashlib.sha256(b"changed").hexdigest()
+
+def test_indexPersisted(workDir, layers, hashed):
+    app, stacko = layers
+    stacko.diff("app", hashes=True, useIndex=True)
+    del hashed[:]
+
+    other = api.Stacko(metadataDir="metadata", imagesDir="images", mountDir="mounts", locks=stacko.locks)
+    assert other.diff("app", hashes=True, useIndex=True)['changed'] == []
+    assert hashed == []
+    assert (workDir / "metadata" / "layerIndex.json.journal").exists()
+
+def test_diffCommand(workDir, layers):
+    result = runCli(workDir, "diff", "app", "--index")
+
+    assert result.returncode == 0, result.stdout
+    assert "A bin/tool" in result.stdout
+    assert "Changed since the last index: 2" in result.stdout
+    assert "Changed since the last index: 0" in runCli(workDir, "diff", "app", "--index").stdout
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+
+import pytest
+
+import api
+import error
+import layerUtils
+import mountBackend
+
+# whiteouts are character devices and the opaque marker a trusted.* xattr
+needsRoot = pytest.mark.skipif(os.geteuid() != 0, reason="whiteouts and opaque dirs need root")
+
+@pytest.fixture
+def layers(tmp_path):
+    for name in ("lower", "upper", "work", "mount", "bound"):
+        (tmp_path / name).mkdir()
+    (tmp_path / "lower" / "shared").write_text("lower")
+    (tmp_path / "lower" / "onlyLower").write_text("lower")
+    (tmp_path / "upper" / "shared").write_text("upper")
+    (tmp_path / "upper" / "onlyUpper").write_text("upper")
+    backend = mountBackend.SimulatedBackend(str(tmp_path / "mounts.json"))
+    backend.mountOverlay(str(tmp_path / "mount"), [str(tmp_path / "lower")], str(tmp_path / "upper"), str(tmp_path / "work"))
+    return tmp_path, backend
+
+def test_resolveTopmostLayer(layers):
+    tmp_path, backend = layers
+    mountDir = tmp_path / "mount"
+
+    assert backend.resolve(str(mountDir / "shared")) == str(tmp_path / "upper" / "shared")
+    assert backend.resolve(str(mountDir / "onlyLower")) == str(tmp_path / "lower" / "onlyLower")
+    assert backend.resolve(str(mountDir / "missing")) is None
+    assert backend.listdir(str(mountDir)) == ["onlyLower", "onlyUpper", "shared"]
+
+def test_bindAndMove(layers):
+    tmp_path, backend = layers
+    backend.bind(str(tmp_path / "mount"), str(tmp_path / "bound"))
+
+    assert backend.resolve(str(tmp_path / "bound" / "onlyLower")) == str(tmp_path / "lower" / "onlyLower")
+
+    backend.umount(str(tmp_path / "bound"))
+    assert not backend.isMounted(str(tmp_path / "bound"))
+    assert backend.listdir(str(tmp_path / "bound")) == []
+
+def test_stateSharedBetweenInstances(layers):
+    tmp_path, backend = layers
+    other = mountBackend.SimulatedBackend(str(tmp_path / "mounts.json"))
+
+    assert other.isMounted(str(tmp_path / "mount"))
+    assert other.get(str(tmp_path / "mount")).options == 'rw'
+    with pytest.raises(OSError):
+        other.mountOverlay(str(tmp_path / "mount"), [str(tmp_path / "lower")], str(tmp_path / "upper"), str(tmp_path / "work"))
+
+@needsRoot
+def test_whiteoutHidesLower(layers):
+    tmp_path, backend = layers
+    layerUtils.makeWhiteout(str(tmp_path / "upper" / "onlyLower"))
+
+    assert backend.resolve(str(tmp_path / "mount" / "onlyLower")) is None
+    assert backend.listdir(str(tmp_path / "mount")) == ["onlyUpper", "shared"]
+
+@needsRoot
+def test_opaqueDirHidesLower(layers):
+    tmp_path, backend = layers
+    (tmp_path / "lower" / "dir").mkdir()
+    (tmp_path / "lower" / "dir" / "old").write_text("lower")
+    (tmp_path / "upper" / "dir").mkdir()
+    (tmp_path / "upper" / "dir" / "new").write_text("upper")
+    layerUtils.setOpaque(str(tmp_path / "upper" / "dir"))
+
+    assert backend.listdir(str(tmp_path / "mount" / "dir")) == ["new"]
+    assert backend.resolve(str(tmp_path / "mount" / "dir" / "old")) is None
+
+def test_commandGivenUp():
+    start = time.monotonic()
+    with pytest.raises(error.MountTimeoutException):
+        mountBackend.runCommand(["sleep", "5"], timeout=0.2)
+    assert time.monotonic() - start < 2
+
+    with pytest.raises(error.StacksException) as failure:
+        mountBackend.runCommand(["sh", "-c", "echo no such device >&2; exit 32"])
+    assert "no such device" in str(failure.value)
+
+class HangingBackend(mountBackend.SimulatedBackend):
+    """ The overlay mounts of one point never return """
+
+    def mountOverlay(self, directory, *args, **kwargs):
+        if "/hangs/" in directory:
+            mountBackend.runCommand(["sleep", "5"], self.timeout)
+        return super(HangingBackend, self).mountOverlay(directory, *args, **kwargs)
+
+def test_timedOutMountFailsItsPointOnly(workDir, stacko):
+    stacko = api.Stacko(metadataDir="metadata", imagesDir="images", mountDir="mounts", locks=stacko.locks,
+                        backend=HangingBackend(str(workDir / "metadata" / mountBackend.simulatedFilename)))
+    stacko.newImage("a")
+    stacko.newPoint("hangs", "a")
+    stacko.newPoint("works", "a")
+
+    start = time.monotonic()
+    results = dict((result['name'], result) for result in stacko.mountAll(timeout=0.2))
+
+    assert time.monotonic() - start < 2
+    assert results["works"]['error'] is None
+    assert "Timed out" in results["hangs"]['error']
+    assert stacko.mountBackend.timeout == mountBackend.defaultTimeout
+    with pytest.raises(error.MountTimeoutException):
+        stacko.mount("hangs", timeout=0.2)
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+import mountEngine
+
+class Recorder(object):
+    """ Mount steps that log what they did """
+
+    def __init__(self):
+        self.guard = threading.Lock()
+        self.log = []
+
+    def record(self, entry):
+        with self.guard:
+            self.log.append(entry)
+
+    def steps(self, key, fail=False, present=False, delay=0):
+        def mount():
+            time.sleep(delay)
+            if fail:
+                raise OSError("cannot mount " + key)
+            self.record("mount " + key)
+            return not present
+
+        def umount():
+            self.record("umount " + key)
+        return mount, umount
+
+def test_dependenciesFirstAndShared():
+    recorder = Recorder()
+    graph = mountEngine.MountGraph()
+    root = graph.add("root", "p1", *recorder.steps("root", delay=0.05))
+    graph.add("root", "p2", *recorder.steps("root"))
+    graph.add("p1", "p1", *recorder.steps("p1"), deps=[root])
+    graph.add("p2", "p2", *recorder.steps("p2"), deps=[root])
+
+    results = mountEngine.MountEngine(workers=4).run(graph)
+
+    assert [(target, exc) for target, seconds, exc in results] == [("p1", None), ("p2", None)]
+    assert recorder.log[0] == "mount root"
+    assert sorted(recorder.log) == ["mount p1", "mount p2", "mount root"]
+
+def test_rollbackOnlyWhatFailedTargetsNeed():
+    recorder = Recorder()
+    graph = mountEngine.MountGraph()
+    root = graph.add("root", "p1", *recorder.steps("root"))
+    graph.add("root", "p2", *recorder.steps("root"))
+    lower = graph.add("lower", "p1", *recorder.steps("lower"), deps=[root])
+    graph.add("top", "p1", *recorder.steps("top", fail=True), deps=[lower])
+    graph.add("p2", "p2", *recorder.steps("p2"), deps=[root])
+
+    results = dict((target, exc) for target, seconds, exc in mountEngine.MountEngine().run(graph))
+
+    assert isinstance(results["p1"], OSError)
+    assert results["p2"] is None
+    # root is still needed by p2
+    assert "umount lower" in recorder.log
+    assert "umount root" not in recorder.log
+    assert "umount p2" not in recorder.log
+
+def test_dependentsOfFailedMountsSkipped():
+    recorder = Recorder()
+    graph = mountEngine.MountGraph()
+    root = graph.add("root", "p1", *recorder.steps("root", fail=True))
+    graph.add("top", "p1", *recorder.steps("top"), deps=[root])
+
+    results = mountEngine.MountEngine().run(graph)
+
+    assert isinstance(results[0][2], OSError)
+    assert graph.nodes["top"].state == 'skipped'
+    assert recorder.log == []
+
+def test_presentMountsNeverUndone():
+    recorder = Recorder()
+    graph = mountEngine.MountGraph()
+    root = graph.add("root", "p1", *recorder.steps("root", present=True))
+    graph.add("top", "p1", *recorder.steps("top", fail=True), deps=[root])
+
+    mountEngine.MountEngine().run(graph)
+
+    assert recorder.log == ["mount root"]
+
+def test_runWaitsForEveryMount():
+    # no mount is left running once run() returns, so rollback and the
+    # caller's transaction see every result
+    recorder = Recorder()
+    graph = mountEngine.MountGraph()
+    graph.add("slow", "p1", *recorder.steps("slow", delay=0.2))
+    graph.add("fast", "p2", *recorder.steps("fast", fail=True))
+
+    mountEngine.MountEngine(workers=2).run(graph)
+
+    assert recorder.log == ["mount slow"]
+    assert threading.active_count() == 1
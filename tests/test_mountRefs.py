@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+import classDb
+
+import error
+import image
+from conftest import mounted, runCli
+
+@pytest.fixture
+def chain(stacko, legacy):
+    stacko.newImage("base")
+    stacko.newImage("mid", "base")
+    stacko.newImage("app", "mid")
+    stacko.newPoint("p1", "app")
+    stacko.newPoint("p2", "app")
+    return stacko
+
+def holders(stacko):
+    with stacko.transaction(shared=True):
+        refs = stacko.imageManager._updateMountRefs(lambda refs: dict(refs.db.items()))
+    return dict((name, sorted(ref.holders)) for name, ref in refs.items())
+
+def test_countsHolders(workDir, chain):
+    chain.mountAll()
+
+    assert holders(chain) == {
+        "app": ["instance:p1", "instance:p2"],
+        "mid": ["image:app"],
+        "base": ["image:mid"],
+    }
+    with pytest.raises(error.InUseException):
+        chain.closeImage("app")
+
+def test_idleMountsStayForTheGracePeriod(workDir, chain):
+    chain.mountAll()
+    chain.umount("p1")
+    chain.umount("p2")
+
+    assert holders(chain)["app"] == []
+    assert "images/app/.self/mount" in mounted(workDir)
+    assert chain.reapMounts() == []
+
+def test_reapCascadesUpTheChain(workDir, chain):
+    chain.mount("p1")
+    chain.mount("p2")
+    chain.umount("p1")
+
+    assert chain.reapMounts(0) == []
+
+    chain.umount("p2")
+    assert chain.reapMounts(0) == ["app", "mid", "base"]
+    assert mounted(workDir) == []
+    assert holders(chain) == {}
+
+def test_remountAfterReap(workDir, chain):
+    chain.mount("p1")
+    chain.umount("p1")
+    chain.reapMounts(0)
+    chain.mount("p1")
+
+    assert holders(chain)["app"] == ["instance:p1"]
+    assert "mounts/p1" in mounted(workDir)
+
+def test_untrackedMountsNeverReaped(workDir, chain, monkeypatch):
+    # p1 mounted by a stacko without counts
+    with monkeypatch.context() as patch:
+        patch.setattr(image.ImageManager, "_updateMountRefs", lambda self, func: None)
+        chain.mount("p1")
+    chain.mount("p2")
+    chain.umount("p2")
+
+    assert chain.reapMounts(0) == []
+    assert "images/app/.self/mount" in mounted(workDir)
+    assert "images/app/p1/mount" in mounted(workDir)
+
+def test_lostCountDoesNotReapMountInUse(workDir, chain):
+    chain.mount("p1")
+    # as if the process died between the mount and counting it
+    with chain.transaction(shared=True):
+        chain.imageManager._updateMountRefs(lambda refs: refs.release("app", "instance:p1"))
+
+    assert chain.reapMounts(0) == []
+    assert "images/app/.self/mount" in mounted(workDir)
+    assert holders(chain)["app"] == ["instance:p1"]
+
+def test_staleHolderDropped(workDir, chain):
+    chain.mount("p1")
+    # umounted behind stacko's back
+    backend = chain.mountBackend
+    backend.umount(str(workDir / "mounts" / "p1"))
+    backend.umount(str(workDir / "images" / "app" / "p1" / "mount"))
+
+    assert chain.reapMounts(0) == []
+    chain.closeImage("app")
+
+    assert "images/app/.self/mount" not in mounted(workDir)
+    assert "app" not in holders(chain)
+
+def test_countsMigrated(workDir, chain):
+    chain.mountAll()
+    before = holders(chain)
+
+    assert runCli(workDir, "migrate-db", "sqlite").returncode == 0
+    assert classDb.detectBackend("metadata") == 'sqlite'
+    assert holders(chain) == before
+    chain.umount("p1")
+    chain.umount("p2")
+    assert chain.reapMounts(0) == ["app", "mid", "base"]